@@ -0,0 +1,214 @@
+"""
+End-to-end benchmark of the scrape -> parse -> load path against local stand-ins.
+
+Serves a synthetic j-archive corpus over a local HTTP stub, stores pages in a moto
+S3 server and loads clues into a local mongod, running the real flows and tasks
+against them through a temporary Prefect server:
+
+    refresh_games                 crawl game pages into S3 (pages/s)
+    load_clues_from_all_games_s3  list, read, parse and load every game (clues/s)
+    load_clues_from_set_s3        the same for an explicit set of game ids (clues/s)
+
+Results, including wall time and peak RSS, are printed as JSON so runs can be
+compared across commits. Needs `pip install -r bench_requirements.txt` and a
+mongod to point --mongo-uri at (mongomock has no AsyncMongoClient):
+
+    python -m benchmarks.run_pipeline_benchmark --games-per-season 200 --output bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import time
+from datetime import datetime, timezone
+
+import boto3
+from moto.server import ThreadedMotoServer
+from prefect import flow
+from prefect.blocks.system import Secret
+from prefect.logging import get_run_logger
+from prefect.settings import PREFECT_API_URL
+from prefect.testing.utilities import prefect_test_harness
+from prefect_aws import AwsCredentials
+from pymongo import MongoClient
+
+from benchmarks.synthetic_corpus import build_corpus, serve_corpus
+
+BENCH_BUCKET = "cluebase-bench"
+BENCH_DATABASE = "cluebase_bench"
+MONGO_SECRET_BLOCK = "mongo-connection-string"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def peak_rss_mb():
+    # Linux reports KiB. This is the peak of the whole process so far, so stages
+    # later in the run include the earlier ones' peak.
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@flow
+def crawl_corpus(bucket_name, season_ids):
+    from workflows.scrape.shared import (
+        refresh_all_seasons,
+        refresh_games,
+        refresh_season_list,
+    )
+
+    logger = get_run_logger()
+    refresh_season_list(bucket_name, overwrite=True, logger=logger)
+    refresh_all_seasons(bucket_name, overwrite=True, sleep=0, logger=logger)
+
+    game_ids = []
+    for season_id in season_ids:
+        game_ids += refresh_games(
+            season_id, bucket_name, overwrite=True, sleep=0, logger=logger
+        )
+
+    return game_ids
+
+
+def run_stage(results, name, fn, pages=0, count_clues=None):
+    start_time = time.perf_counter()
+    value = fn()
+    wall_time = time.perf_counter() - start_time
+
+    stage = {"wall_s": round(wall_time, 3), "peak_rss_mb": peak_rss_mb()}
+    if pages:
+        stage["pages"] = pages
+        stage["pages_per_s"] = round(pages / wall_time, 2)
+    if count_clues:
+        clues = count_clues()
+        stage["clues"] = clues
+        stage["clues_per_s"] = round(clues / wall_time, 2)
+
+    results[name] = stage
+    print(f"{name}: {stage}")
+    return value
+
+
+def run_benchmark(n_seasons, games_per_season, mongo_uri, seed=0):
+    seasons = build_corpus(n_seasons, games_per_season)
+    n_games = n_seasons * games_per_season
+    corpus_server, base_url = serve_corpus(seasons, seed)
+
+    s3_port = free_port()
+    s3_server = ThreadedMotoServer(ip_address="127.0.0.1", port=s3_port)
+    s3_server.start()
+    s3_url = f"http://127.0.0.1:{s3_port}"
+
+    for variable in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"]:
+        os.environ.setdefault(variable, "testing")
+
+    mongo = MongoClient(mongo_uri)
+    db = mongo.get_database(BENCH_DATABASE)
+    count_clues = db.clues.estimated_document_count
+
+    results = {}
+    try:
+        with prefect_test_harness():
+            AwsCredentials(
+                aws_access_key_id="testing",
+                aws_secret_access_key="testing",
+                region_name="us-east-1",
+                aws_client_parameters={"endpoint_url": s3_url},
+            ).save("cluebase-credentials", overwrite=True)
+            Secret(value=mongo_uri).save(MONGO_SECRET_BLOCK, overwrite=True)
+            # The load's parse processes find the temporary server in the environment
+            os.environ["PREFECT_API_URL"] = PREFECT_API_URL.value()
+
+            boto3.client(
+                "s3", endpoint_url=s3_url, region_name="us-east-1"
+            ).create_bucket(Bucket=BENCH_BUCKET)
+
+            # Imported once the credential blocks exist, src.io_utils loads them
+            import src.scrape_raw
+            from workflows.load_to_mongo.load_clues import load_clues_from_all_games_s3
+            from workflows.load_to_mongo.load_clues_set import load_clues_from_set_s3
+
+            src.scrape_raw.BASE_URL = base_url
+
+            game_ids = run_stage(
+                results,
+                "refresh_games",
+                lambda: crawl_corpus(BENCH_BUCKET, list(seasons)),
+                pages=1 + n_seasons + n_games,
+            )
+
+            mongo.drop_database(BENCH_DATABASE)
+            run_stage(
+                results,
+                "load_clues_from_all_games_s3",
+                lambda: load_clues_from_all_games_s3(
+                    BENCH_BUCKET, "raw/games", MONGO_SECRET_BLOCK, BENCH_DATABASE
+                ),
+                pages=n_games,
+                count_clues=count_clues,
+            )
+
+            mongo.drop_database(BENCH_DATABASE)
+            run_stage(
+                results,
+                "load_clues_from_set_s3",
+                lambda: load_clues_from_set_s3(
+                    game_ids,
+                    BENCH_BUCKET,
+                    "raw/games",
+                    MONGO_SECRET_BLOCK,
+                    BENCH_DATABASE,
+                ),
+                pages=n_games,
+                count_clues=count_clues,
+            )
+    finally:
+        mongo.drop_database(BENCH_DATABASE)
+        s3_server.stop()
+        corpus_server.shutdown()
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "params": {
+            "seasons": n_seasons,
+            "games_per_season": games_per_season,
+            "seed": seed,
+        },
+        "stages": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--seasons", type=int, default=2)
+    parser.add_argument("--games-per-season", type=int, default=100)
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    report = run_benchmark(
+        args.seasons, args.games_per_season, args.mongo_uri, seed=args.seed
+    )
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w+") as f:
+            json.dump(report, f, indent=2)
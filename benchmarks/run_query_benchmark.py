@@ -0,0 +1,244 @@
+"""
+Latency benchmark of the columnar ClueStore against the same queries on Mongo.
+
+Generates a synthetic clue corpus, loads it into a ClueStore and, with --mongo-uri,
+into a scratch Mongo database with an index per filtered field. Then runs filtered
+finds, random samples and whole-game lookups on both, checking that the filtered
+finds return the same clues, and prints p50/p99 latency per query type as JSON:
+
+    python -m benchmarks.run_query_benchmark --games 8000 --mongo-uri mongodb://localhost:27017/
+"""
+
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from pymongo import ASCENDING, MongoClient
+
+from src.query_engine import INDEXED_FIELDS, ClueStore
+
+BENCH_DATABASE = "cluebase_query_bench"
+
+DOMAINS = (
+    "Arts_and_Entertainment Books_and_Literature Food_and_Drink Games Health "
+    "Law_and_Government News People_and_Society Science Sports Travel_and_Transportation"
+).split()
+
+
+def synthetic_clues(n_games, n_categories=20_000, seed=0):
+    """
+    Clues shaped like parse_clues_from_game's, with a domain like classify_domains',
+    for n_games games of 61 clues aired on consecutive days.
+    """
+    rng = random.Random(seed)
+    categories = [f"CATEGORY {i}" for i in range(n_categories)]
+    first_air_date = datetime(1984, 9, 10)
+
+    clues = []
+    for game_id in range(1, n_games + 1):
+        air_date = first_air_date + timedelta(days=game_id)
+        board = [(round_number, 6, 5) for round_number in (1, 2)] + [(3, 1, 1)]
+        for round_number, n_board_categories, n_rows in board:
+            for category_index in range(n_board_categories):
+                category = rng.choice(categories)
+                for row in range(n_rows):
+                    difficulty = 5 if round_number == 3 else row
+                    # Same shape as src.clues.build_clue_dict, which can't be
+                    # imported without the Prefect AWS credentials block
+                    clues.append(
+                        {
+                            "_id": f"{game_id:06}-{round_number}-{category_index}-{difficulty}",
+                            "clueText": f"Clue {game_id} {round_number} {category_index} {row}",
+                            "solution": f"Solution {rng.randrange(1_000_000)}",
+                            "category": category,
+                            "difficulty": difficulty,
+                            "airDate": air_date,
+                            "gameId": str(game_id),
+                            "roundNumber": round_number,
+                            "categoryIndex": category_index,
+                            "domain": rng.choice(DOMAINS),
+                        }
+                    )
+
+    return clues
+
+
+def benchmark_queries(clues, n_queries, seed=0):
+    """
+    Filters of each query type, with values drawn from the corpus.
+    """
+    rng = random.Random(seed)
+    air_dates = sorted({clue["airDate"] for clue in clues})
+
+    def random_clue():
+        return clues[rng.randrange(len(clues))]
+
+    def air_date_range(days):
+        start = rng.randrange(len(air_dates) - days)
+        return {"$gte": air_dates[start], "$lt": air_dates[start + days]}
+
+    return {
+        "category": [{"category": random_clue()["category"]} for _ in range(n_queries)],
+        "category_round": [
+            {
+                "category": clue["category"],
+                "roundNumber": {"$in": [1, 2]},
+            }
+            for clue in (random_clue() for _ in range(n_queries))
+        ],
+        "air_date_week_difficulty": [
+            {"airDate": air_date_range(7), "difficulty": rng.randrange(5)}
+            for _ in range(n_queries)
+        ],
+        "domain_year_round": [
+            {
+                "domain": rng.choice(DOMAINS),
+                "airDate": air_date_range(365),
+                "roundNumber": 3,
+            }
+            for _ in range(n_queries)
+        ],
+    }
+
+
+def latency_summary(latencies):
+    latencies = np.array(latencies) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(latencies, 50)), 4),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 4),
+    }
+
+
+def timed_calls(fn, args_list):
+    latencies = []
+    results = []
+    for args in args_list:
+        start_time = time.perf_counter()
+        results.append(fn(args))
+        latencies.append(time.perf_counter() - start_time)
+
+    return results, latencies
+
+
+def load_mongo(mongo_uri, clues):
+    mongo_client = MongoClient(mongo_uri)
+    mongo_client.drop_database(BENCH_DATABASE)
+    collection = mongo_client.get_database(BENCH_DATABASE).clues
+
+    collection.insert_many(clues, ordered=False)
+    for field in INDEXED_FIELDS:
+        collection.create_index([(field, ASCENDING)])
+
+    return mongo_client, collection
+
+
+def run_benchmark(n_games, n_queries, sample_size, mongo_uri=None, seed=0):
+    clues = synthetic_clues(n_games, seed=seed)
+    print(f"Generated {len(clues)} clues")
+
+    start_time = time.time()
+    store = ClueStore(clues)
+    results = {
+        "clues": len(store),
+        "store_build_s": round(time.time() - start_time, 2),
+        "store_mb": round(store.nbytes / 1e6, 1),
+        "queries": {},
+    }
+
+    queries = benchmark_queries(clues, n_queries, seed)
+    rng = np.random.default_rng(seed)
+    game_ids = [str(game_id) for game_id in rng.integers(1, n_games + 1, n_queries)]
+
+    store_results = {}
+    for name, filters in queries.items():
+        store_results[name], latencies = timed_calls(store.find, filters)
+        results["queries"][name] = {
+            "mean_results": round(
+                float(np.mean([len(found) for found in store_results[name]])), 1
+            ),
+            "store": latency_summary(latencies),
+        }
+
+    _found, latencies = timed_calls(
+        lambda _: store.sample(sample_size, rng=rng), range(n_queries)
+    )
+    results["queries"]["sample"] = {"store": latency_summary(latencies)}
+
+    _found, latencies = timed_calls(
+        lambda filter: store.sample(sample_size, filter, rng=rng),
+        queries["domain_year_round"],
+    )
+    results["queries"]["sample_filtered"] = {"store": latency_summary(latencies)}
+
+    _found, latencies = timed_calls(store.game, game_ids)
+    results["queries"]["game"] = {"store": latency_summary(latencies)}
+
+    if mongo_uri is None:
+        return results
+
+    start_time = time.time()
+    mongo_client, collection = load_mongo(mongo_uri, clues)
+    results["mongo_load_s"] = round(time.time() - start_time, 2)
+
+    for name, filters in queries.items():
+        mongo_results, latencies = timed_calls(
+            lambda filter: list(collection.find(filter).sort("_id", ASCENDING)), filters
+        )
+        results["queries"][name]["mongo"] = latency_summary(latencies)
+        results["queries"][name]["same_results"] = all(
+            [clue["_id"] for clue in found] == [clue["_id"] for clue in expected]
+            for found, expected in zip(store_results[name], mongo_results)
+        )
+
+    _found, latencies = timed_calls(
+        lambda _: list(collection.aggregate([{"$sample": {"size": sample_size}}])),
+        range(n_queries),
+    )
+    results["queries"]["sample"]["mongo"] = latency_summary(latencies)
+
+    _found, latencies = timed_calls(
+        lambda filter: list(
+            collection.aggregate(
+                [{"$match": filter}, {"$sample": {"size": sample_size}}]
+            )
+        ),
+        queries["domain_year_round"],
+    )
+    results["queries"]["sample_filtered"]["mongo"] = latency_summary(latencies)
+
+    _found, latencies = timed_calls(
+        lambda game_id: list(
+            collection.find({"gameId": game_id}).sort("_id", ASCENDING)
+        ),
+        game_ids,
+    )
+    results["queries"]["game"]["mongo"] = latency_summary(latencies)
+
+    mongo_client.drop_database(BENCH_DATABASE)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--games", type=int, default=8000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--sample-size", type=int, default=10)
+    parser.add_argument(
+        "--mongo-uri", help="Also run the queries on Mongo, in a scratch database"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        args.games, args.queries, args.sample_size, args.mongo_uri, args.seed
+    )
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w+") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,146 @@
+"""
+Synthetic j-archive-shaped pages, and a local HTTP stub serving them.
+
+Pages only have the structure the scrapers and parsers in src/ look at: the season
+list table, season tables of game links, and game pages with a dated title, two
+6x5 rounds and Final Jeopardy.
+"""
+
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+WORDS = (
+    "capital river author painter opera element treaty empire novel island "
+    "composer planet volcano senator poem desert mountain inventor kingdom saint"
+).split()
+
+
+def sentence(rng, n_words):
+    return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def clue_cell(rng, round_prefix, category, row):
+    # Every ~30th cell is unrevealed, like real boards
+    if rng.random() < 1 / 30:
+        return '<td class="clue"></td>'
+
+    clue_id = f"clue_{round_prefix}_{category + 1}_{row + 1}"
+    return (
+        '<td class="clue"><table>'
+        f'<tr><td class="clue_value">${(row + 1) * 200}</td></tr>'
+        f'<tr><td id="{clue_id}" class="clue_text">{sentence(rng, 14)}</td></tr>'
+        f'<tr><td id="{clue_id}_r" class="clue_text" style="display:none;">'
+        f'<em class="correct_response">{sentence(rng, 2)}</em></td></tr>'
+        "</table></td>"
+    )
+
+
+def round_table(rng, round_prefix):
+    categories = "".join(
+        f'<td class="category"><table><tr><td class="category_name">'
+        f"{sentence(rng, 2).upper()}</td></tr></table></td>"
+        for _ in range(6)
+    )
+    rows = "".join(
+        "<tr>"
+        + "".join(clue_cell(rng, round_prefix, category, row) for category in range(6))
+        + "</tr>"
+        for row in range(5)
+    )
+    return f'<table class="round"><tr>{categories}</tr>{rows}</table>'
+
+
+def game_page(game_id, seed=0):
+    rng = random.Random(f"{seed}-{game_id}")
+    air_date = (
+        f"{rng.randint(1984, 2024)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+    )
+
+    return (
+        "<html><head>"
+        f"<title>J! Archive - Show #{game_id}, aired {air_date}</title>"
+        "</head><body>"
+        f'<div id="jeopardy_round">{round_table(rng, "J")}</div>'
+        f'<div id="double_jeopardy_round">{round_table(rng, "DJ")}</div>'
+        '<div id="final_jeopardy_round"><table class="final_round">'
+        f'<tr><td class="category"><table><tr><td class="category_name">'
+        f"{sentence(rng, 2).upper()}</td></tr></table></td></tr>"
+        f'<tr><td id="clue_FJ" class="clue_text">{sentence(rng, 14)}</td></tr>'
+        f'<tr><td id="clue_FJ_r" class="clue_text" style="display:none;">'
+        f'<em class="correct_response">{sentence(rng, 2)}</em></td></tr>'
+        "</table></div></body></html>"
+    )
+
+
+def season_page(game_ids):
+    links = "".join(
+        f'<tr><td><a href="showgame.php?game_id={game_id}">#{game_id}</a></td></tr>'
+        for game_id in game_ids
+    )
+    return f"<html><body><table>{links}</table></body></html>"
+
+
+def list_seasons_page(season_ids):
+    links = "".join(
+        f'<tr><td><a href="showseason.php?season={season_id}">Season {season_id}</a>'
+        "</td></tr>"
+        for season_id in season_ids
+    )
+    return f"<html><body><table>{links}</table></body></html>"
+
+
+def build_corpus(n_seasons=2, games_per_season=50):
+    """
+    Season id -> list of game ids, newest season first like the real season list.
+    """
+    seasons = {}
+    next_game_id = 1
+    for season_id in range(n_seasons, 0, -1):
+        seasons[str(season_id)] = [
+            str(game_id)
+            for game_id in range(next_game_id, next_game_id + games_per_season)
+        ]
+        next_game_id += games_per_season
+
+    return seasons
+
+
+def serve_corpus(seasons, seed=0, host="127.0.0.1", port=0):
+    """
+    Serve the corpus on a background thread. Returns (server, base_url).
+    """
+
+    class CorpusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+
+            if url.path == "/listseasons.php":
+                body = list_seasons_page(list(seasons))
+            elif (
+                url.path == "/showseason.php"
+                and query.get("season", [""])[0] in seasons
+            ):
+                body = season_page(seasons[query["season"][0]])
+            elif url.path == "/showgame.php" and "game_id" in query:
+                body = game_page(query["game_id"][0], seed)
+            else:
+                self.send_error(404)
+                return
+
+            payload = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), CorpusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://{host}:{server.server_address[1]}"
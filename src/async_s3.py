@@ -0,0 +1,113 @@
+"""
+Natively async S3 access with aiobotocore.
+
+`read_s3_object_async` and `ls_s3_prefix` otherwise run blocking boto3 calls in the
+event loop's default thread pool, which caps concurrency at its few dozen threads.
+Inside `async with async_s3_client(credentials):` they instead share one aiobotocore
+client with its own connection pool, and a semaphore bounding the requests in
+flight, so hundreds of GETs can run concurrently on the event loop.
+
+aiobotocore is only imported once a client is opened, since the ML deployments that
+import src.io_utils don't install it.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from prefect_aws import AwsCredentials
+
+MAX_POOL_CONNECTIONS = 256
+MAX_IN_FLIGHT = 256
+
+# The client opened by the innermost async_s3_client block, if any
+current_async_s3 = ContextVar("current_async_s3", default=None)
+
+
+class AsyncS3:
+    def __init__(self, client, max_in_flight=MAX_IN_FLIGHT):
+        self.client = client
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def get_object(self, bucket_name: str, key: str, **kwargs) -> tuple:
+        """
+        (etag, bytes) of an object. kwargs go to GetObject, e.g. IfNoneMatch.
+        """
+        async with self.semaphore:
+            response = await self.client.get_object(
+                Bucket=bucket_name, Key=key, **kwargs
+            )
+            async with response["Body"] as stream:
+                data = await stream.read()
+
+        return response["ETag"].strip('"'), data
+
+    async def list_objects(
+        self,
+        bucket_name: str,
+        prefix: str,
+        delimiter: str = "",
+        page_size: Optional[int] = None,
+        max_items: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        paginator = self.client.get_paginator("list_objects_v2")
+
+        objects = []
+        async with self.semaphore:
+            async for page in paginator.paginate(
+                Bucket=bucket_name,
+                Prefix=prefix,
+                Delimiter=delimiter,
+                PaginationConfig={"PageSize": page_size, "MaxItems": max_items},
+            ):
+                objects += page.get("Contents", [])
+
+        return objects
+
+
+@asynccontextmanager
+async def async_s3_client(
+    credentials: AwsCredentials,
+    max_pool_connections: int = MAX_POOL_CONNECTIONS,
+    max_in_flight: int = MAX_IN_FLIGHT,
+):
+    """
+    An aiobotocore S3 client built from the same AwsCredentials block as the sync
+    helpers, used by the async S3 helpers within the block.
+    """
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+
+    session = get_session()
+    if credentials.profile_name:
+        session.set_config_variable("profile", credentials.profile_name)
+
+    client_kwargs = {
+        "region_name": credentials.region_name,
+        "aws_access_key_id": credentials.aws_access_key_id,
+        "aws_secret_access_key": (
+            credentials.aws_secret_access_key.get_secret_value()
+            if credentials.aws_secret_access_key
+            else None
+        ),
+        "aws_session_token": credentials.aws_session_token,
+    }
+    client_parameters = credentials.aws_client_parameters
+    if client_parameters.endpoint_url:
+        client_kwargs["endpoint_url"] = client_parameters.endpoint_url
+    if client_parameters.verify_cert_path:
+        client_kwargs["verify"] = client_parameters.verify_cert_path
+    elif client_parameters.verify is not None:
+        client_kwargs["verify"] = client_parameters.verify
+    client_kwargs["use_ssl"] = client_parameters.use_ssl
+
+    config = AioConfig(max_pool_connections=max_pool_connections)
+
+    async with session.create_client("s3", config=config, **client_kwargs) as client:
+        s3 = AsyncS3(client, max_in_flight)
+        token = current_async_s3.set(s3)
+        try:
+            yield s3
+        finally:
+            current_async_s3.reset(token)
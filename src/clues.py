@@ -4,30 +4,33 @@ from datetime import datetime
 
 from bs4 import BeautifulSoup
 
-from src.io_utils import read_raw_file
+from src.io_utils import encode_clues, read_raw_file
+from src.metrics import timed
 from src.paths import RAW_GAMES_DIR
 
 
 def clue_quality_pass(clues):
-    clue_text_not_empty = lambda clue: len(clue["clueText"]) > 0
-    clue_text_not_equals = lambda clue: clue["clueText"] != "="
-    clue_text_no_preamble = lambda clue: not re.search(r"^\(.*\)", clue["clueText"])
-    clue_text_no_brackets = lambda clue: not re.search(r"\[.*\]", clue["clueText"])
-
-    filter_rules = [
-        clue_text_not_empty,
-        clue_text_not_equals,
-        clue_text_no_preamble,
-        clue_text_no_brackets,
-    ]
+    with timed("quality_pass") as timer:
+        clue_text_not_empty = lambda clue: len(clue["clueText"]) > 0
+        clue_text_not_equals = lambda clue: clue["clueText"] != "="
+        clue_text_no_preamble = lambda clue: not re.search(r"^\(.*\)", clue["clueText"])
+        clue_text_no_brackets = lambda clue: not re.search(r"\[.*\]", clue["clueText"])
+
+        filter_rules = [
+            clue_text_not_empty,
+            clue_text_not_equals,
+            clue_text_no_preamble,
+            clue_text_no_brackets,
+        ]
 
-    for rule in filter_rules:
-        clues = filter(rule, clues)
+        for rule in filter_rules:
+            clues = filter(rule, clues)
 
-    clues = list(clues)
+        clues = list(clues)
 
-    for clue in clues:
-        clue["category"] = reformat_category_commentary(clue["category"])
+        for clue in clues:
+            clue["category"] = reformat_category_commentary(clue["category"])
+        timer.items = len(clues)
 
     return clues
 
@@ -126,6 +129,13 @@ def build_clue_dict(
     }
 
 
+def clue_model_text(clue):
+    """
+    The text ML features are computed from: the clue followed by its solution.
+    """
+    return f"{clue['clueText']}: {clue['solution']}"
+
+
 def build_clues_from_row(row, row_num, categories, game_id, round_number):
     clue_tables = [td.find("table") for td in row.find_all("td", class_="clue")]
 
@@ -228,17 +238,42 @@ def parse_air_date(soup):
 
 
 def parse_clues_from_game(game_html, game_id):
-    soup = BeautifulSoup(game_html, "html.parser")
+    with timed("html_parse") as timer:
+        soup = BeautifulSoup(game_html, "html.parser")
 
-    air_date = parse_air_date(soup)
+        air_date = parse_air_date(soup)
 
-    first_round_clues = parse_first_round(soup, game_id)
-    second_round_clues = parse_second_round(soup, game_id)
-    final_jeopardy_clues = parse_final_jeopardy(soup, game_id)
+        first_round_clues = parse_first_round(soup, game_id)
+        second_round_clues = parse_second_round(soup, game_id)
+        final_jeopardy_clues = parse_final_jeopardy(soup, game_id)
 
-    all_clues = first_round_clues + second_round_clues + final_jeopardy_clues
+        all_clues = first_round_clues + second_round_clues + final_jeopardy_clues
+        timer.items = len(all_clues)
 
     for clue in all_clues:
         clue["airDate"] = air_date
 
     return all_clues
+
+
+def parse_and_encode_clues(game_html, game_id):
+    """
+    Parse a game's clues, along with their BSON documents for insert_clue_bulk.
+    """
+    clues = parse_clues_from_game(game_html, game_id)
+    return clues, encode_clues(clues)
+
+
+def parse_and_encode_games(pages):
+    """
+    parse_and_encode_clues for each of the pages, by game id. Returns the games
+    that parsed, and the errors of those that didn't.
+    """
+    clues = {}
+    failed = {}
+    for game_id, page in pages.items():
+        try:
+            clues[game_id] = parse_and_encode_clues(page, game_id)
+        except Exception as e:
+            failed[game_id] = e
+    return clues, failed
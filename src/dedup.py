@@ -0,0 +1,430 @@
+"""
+Near-duplicate clue detection with MinHash and locality-sensitive hashing.
+
+Each clue's clueText and solution are normalized and cut into overlapping character
+shingles. A clue's signature is the minimum hash of its shingles under NUM_PERM
+hash functions, so two signatures agree in about the Jaccard similarity of the
+clues' shingle sets. Signatures are split into BANDS bands, and clues that match
+in any band are candidates. Candidates whose signatures agree in at least
+DUPLICATE_THRESHOLD of their hashes are duplicates, and duplicates are joined
+transitively into groups, named by their earliest clue's _id.
+
+The SignatureIndex keeps every checked clue's signature and group. Each band's
+keys are kept sorted, so checking a new clue is a binary search per band rather
+than a comparison with every clue. It's persisted as one .npz file:
+
+    ids              clue _id of each row, as bytes
+    signatures       (rows, NUM_PERM) uint16 min-hashes
+    groups           row of each row's group, its own row if it has no duplicates
+    band_orders      (BANDS, rows) int32, each band's rows in order of their keys
+    watermark        latest updatedAt of the clues checked, if any
+"""
+
+import os
+import re
+import unicodedata
+from datetime import datetime
+from io import BytesIO
+from logging import getLogger
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from prefect_aws import S3Bucket
+
+from src.io_utils import download_object_if_changed
+
+file_logger = getLogger(__name__)
+
+DEDUP_INDEX_PATH = "dedup_index/signatures.npz"
+DEDUP_INDEX_S3_PATH = "indexes/dedup/signatures.npz"
+
+SHINGLE_SIZE = 5
+NUM_PERM = 64
+# Four 16-bit hashes per band, so each band key is one uint64. Clues with
+# similarity 0.7 share a band with probability 0.99, at 0.3 with probability 0.12
+BANDS = 16
+DUPLICATE_THRESHOLD = 0.7
+# Rows compared per band key. Larger buckets hold copies of the same clue, already
+# grouped together, so matching some of them is enough
+MAX_BUCKET_MATCHES = 64
+# Clues hashed at once, to bound the size of the shingle arrays
+SIGNATURE_CHUNK_SIZE = 20_000
+
+NON_ALPHANUMERIC_REGEX = re.compile(r"[^a-z0-9]+")
+
+# Odd multipliers and offsets of the NUM_PERM multiply-add hash functions
+_rng = np.random.default_rng(20240101)
+HASH_MULTIPLIERS = _rng.integers(0, 2**63, NUM_PERM, dtype=np.uint64) * 2 + 1
+HASH_OFFSETS = _rng.integers(0, 2**63, NUM_PERM, dtype=np.uint64)
+
+
+def normalize_clue(clue) -> str:
+    """
+    clueText and solution, lowercased, without accents, with runs of anything but
+    letters and digits as one space.
+    """
+    text = f"{clue.get('clueText') or ''} {clue.get('solution') or ''}".lower()
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(char for char in text if not unicodedata.combining(char))
+    return NON_ALPHANUMERIC_REGEX.sub(" ", text).strip()
+
+
+def shingles(texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Every SHINGLE_SIZE-character window of the texts, packed into a uint64, and
+    the index of each text's first shingle. Texts shorter than a shingle are one
+    shingle. The texts must be ASCII, as normalize_clue's are.
+    """
+    texts = [text.ljust(SHINGLE_SIZE) for text in texts]
+    lengths = np.array([len(text) for text in texts], dtype=np.int64)
+    data = np.frombuffer("".join(texts).encode("ascii"), dtype=np.uint8)
+
+    counts = lengths - SHINGLE_SIZE + 1
+    starts = np.cumsum(counts) - counts
+    # Position in data of each shingle's first character
+    positions = np.arange(counts.sum()) + np.repeat(
+        np.cumsum(lengths) - lengths - starts, counts
+    )
+
+    packed = np.zeros(len(positions), dtype=np.uint64)
+    for i in range(SHINGLE_SIZE):
+        packed |= data[positions + i].astype(np.uint64) << np.uint64(8 * i)
+
+    return packed, starts
+
+
+def minhash_signatures(texts: List[str]) -> np.ndarray:
+    """
+    (len(texts), NUM_PERM) uint16 signatures. Each min-hash is the full 64-bit
+    minimum, mixed and cut to 16 bits, so different minima rarely agree.
+    """
+    signatures = np.empty((len(texts), NUM_PERM), dtype=np.uint16)
+    for chunk_start in range(0, len(texts), SIGNATURE_CHUNK_SIZE):
+        packed, starts = shingles(
+            texts[chunk_start : chunk_start + SIGNATURE_CHUNK_SIZE]
+        )
+        rows = slice(chunk_start, chunk_start + len(starts))
+
+        with np.errstate(over="ignore"):
+            for perm in range(NUM_PERM):
+                hashes = packed * HASH_MULTIPLIERS[perm] + HASH_OFFSETS[perm]
+                minima = np.minimum.reduceat(hashes, starts)
+                minima ^= minima >> np.uint64(33)
+                minima *= np.uint64(0xFF51AFD7ED558CCD)
+                minima ^= minima >> np.uint64(29)
+                signatures[rows, perm] = minima.astype(np.uint16)
+
+    return signatures
+
+
+def find_roots(parents: np.ndarray) -> np.ndarray:
+    roots = parents.copy()
+    while True:
+        next_roots = roots[roots]
+        if np.array_equal(next_roots, roots):
+            return roots
+        roots = next_roots
+
+
+class SignatureIndex:
+    def __init__(
+        self,
+        ids=(),
+        signatures=None,
+        groups=None,
+        band_orders=None,
+        watermark: Optional[datetime] = None,
+    ):
+        # Clue _ids are ASCII, bytes take a quarter of numpy's UTF-32 strings
+        self.ids = np.asarray(ids, dtype=bytes)
+        if signatures is None:
+            signatures = np.empty((0, NUM_PERM), dtype=np.uint16)
+        self.signatures = np.ascontiguousarray(signatures, dtype=np.uint16)
+        if groups is None:
+            groups = np.arange(len(self.ids))
+        self.groups = np.asarray(groups, dtype=np.int64)
+
+        self.watermark = watermark
+
+        self.id_set = set(self.ids.tolist())
+        self._sort_bands(band_orders)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, clue_id):
+        return str(clue_id).encode("ascii") in self.id_set
+
+    @property
+    def band_keys(self) -> np.ndarray:
+        return self.signatures.view(np.uint64)
+
+    def _sort_bands(self, band_orders=None):
+        band_keys = self.band_keys
+        if band_orders is None:
+            self.band_orders = [
+                np.argsort(band_keys[:, band], kind="stable") for band in range(BANDS)
+            ]
+        else:
+            # Saved with the index, so loading it doesn't sort every band again
+            self.band_orders = list(band_orders)
+        self.sorted_band_keys = [
+            band_keys[order, band] for band, order in enumerate(self.band_orders)
+        ]
+
+    def _insert_bands(self, rows: np.ndarray):
+        """
+        Insert rows into the sorted bands, in one pass over each band rather than
+        sorting it again.
+        """
+        band_keys = self.band_keys
+        for band in range(BANDS):
+            keys = band_keys[rows, band]
+            order = np.argsort(keys, kind="stable")
+            positions = np.searchsorted(
+                self.sorted_band_keys[band], keys[order], side="right"
+            )
+            self.sorted_band_keys[band] = np.insert(
+                self.sorted_band_keys[band], positions, keys[order]
+            )
+            self.band_orders[band] = np.insert(
+                self.band_orders[band], positions, rows[order]
+            )
+
+    def group_ids(self, rows=None, groups=None) -> np.ndarray:
+        """
+        The duplicateGroup of each row, or None if it has no duplicates.
+        """
+        groups = self.groups if groups is None else groups
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        group_sizes = np.bincount(groups, minlength=len(self))
+        group_ids = self.ids[groups[rows]].astype(str).astype(object)
+        group_ids[group_sizes[groups[rows]] < 2] = None
+        return group_ids
+
+    def candidate_pairs(self, rows: np.ndarray) -> np.ndarray:
+        """
+        (row, other row) pairs, row < other row, that share a band with any of rows.
+        """
+        band_keys = self.band_keys
+        pairs = []
+        for band in range(BANDS):
+            sorted_keys = self.sorted_band_keys[band]
+            keys = band_keys[rows, band]
+            starts = np.searchsorted(sorted_keys, keys, side="left")
+            counts = np.minimum(
+                np.searchsorted(sorted_keys, keys, side="right") - starts,
+                MAX_BUCKET_MATCHES,
+            )
+
+            offsets = np.arange(counts.sum()) - np.repeat(
+                np.cumsum(counts) - counts, counts
+            )
+            matches = self.band_orders[band][np.repeat(starts, counts) + offsets]
+            queries = np.repeat(rows, counts)
+            pairs.append(
+                np.minimum(queries, matches) * len(self) + np.maximum(queries, matches)
+            )
+
+        pairs = np.unique(np.concatenate(pairs))
+        pairs = np.stack([pairs // len(self), pairs % len(self)], axis=1)
+        return pairs[pairs[:, 0] != pairs[:, 1]]
+
+    def duplicate_pairs(self, rows: np.ndarray) -> np.ndarray:
+        pairs = self.candidate_pairs(rows)
+        similarity = np.mean(
+            self.signatures[pairs[:, 0]] == self.signatures[pairs[:, 1]], axis=1
+        )
+        return pairs[similarity >= DUPLICATE_THRESHOLD]
+
+    def add(self, clues: Iterable[dict], logger=file_logger) -> Dict[str, str]:
+        """
+        Add the clues that aren't in the index yet and group them with their
+        duplicates. Returns the new duplicateGroup of every clue whose group
+        changed, including clues already in the index that were joined by a new
+        clue or whose group was merged into another.
+        """
+        texts = {}
+        for clue in clues:
+            if clue["_id"] not in self and (text := normalize_clue(clue)):
+                texts[clue["_id"]] = text
+        if not texts:
+            return {}
+
+        old_size = len(self)
+        self.ids = np.concatenate([self.ids, np.array(list(texts), dtype=bytes)])
+        self.id_set.update(self.ids[old_size:].tolist())
+        self.signatures = np.concatenate(
+            [self.signatures, minhash_signatures(list(texts.values()))]
+        )
+        self.groups = np.concatenate([self.groups, np.arange(old_size, len(self))])
+        self._insert_bands(np.arange(old_size, len(self)))
+
+        duplicates = np.concatenate(
+            [
+                self.duplicate_pairs(
+                    np.arange(start, min(start + SIGNATURE_CHUNK_SIZE, len(self)))
+                )
+                for start in range(old_size, len(self), SIGNATURE_CHUNK_SIZE)
+            ]
+        )
+        logger.info(f"{len(duplicates)} duplicate pairs with {len(texts)} new clues")
+
+        # Only the groups the new duplicates joined can have changed
+        old_groups = self.groups
+        self.union(duplicates)
+        rows = np.flatnonzero(np.isin(self.groups, self.groups[duplicates.ravel()]))
+        group_ids = self.group_ids(rows)
+        changed = group_ids != self.group_ids(rows, old_groups)
+        return dict(
+            zip(
+                self.ids[rows[changed]].astype(str).tolist(),
+                group_ids[changed].tolist(),
+            )
+        )
+
+    def remove(
+        self, clue_ids: Iterable[str], logger=file_logger
+    ) -> Dict[str, Optional[str]]:
+        """
+        Remove clues, deleted ones or ones whose text changed, and regroup the rest
+        of their groups without them. Returns the new duplicateGroup of every
+        remaining clue whose group changed, None for clues left without duplicates.
+        """
+        remove_ids = {str(clue_id).encode("ascii") for clue_id in clue_ids}
+        remove_ids &= self.id_set
+        if not remove_ids:
+            return {}
+
+        removed = np.isin(self.ids, np.array(list(remove_ids), dtype=bytes))
+        keep = ~removed
+        # Every duplicate of a removed clue is in its group, so only the rest of
+        # those groups can split
+        regroup = np.isin(self.groups, self.groups[removed]) & keep
+        old_group_ids = self.group_ids()[keep]
+
+        new_rows = np.cumsum(keep) - 1
+        for band in range(BANDS):
+            kept = keep[self.band_orders[band]]
+            self.band_orders[band] = new_rows[self.band_orders[band][kept]]
+            self.sorted_band_keys[band] = self.sorted_band_keys[band][kept]
+        self.ids = self.ids[keep]
+        self.id_set -= remove_ids
+        self.signatures = self.signatures[keep]
+        self.groups = new_rows[np.where(regroup, np.arange(len(keep)), self.groups)]
+        self.groups = self.groups[keep]
+
+        rows = np.flatnonzero(regroup[keep])
+        if len(rows):
+            self.union(
+                np.concatenate(
+                    [
+                        self.duplicate_pairs(rows[start : start + SIGNATURE_CHUNK_SIZE])
+                        for start in range(0, len(rows), SIGNATURE_CHUNK_SIZE)
+                    ]
+                )
+            )
+        logger.info(f"Removed {len(remove_ids)} clues, regrouped {len(rows)} clues")
+
+        group_ids = self.group_ids(rows)
+        changed = group_ids != old_group_ids[rows]
+        return dict(
+            zip(
+                self.ids[rows[changed]].astype(str).tolist(),
+                group_ids[changed].tolist(),
+            )
+        )
+
+    def union(self, pairs: np.ndarray):
+        """
+        Join the groups of each pair. A group's root is its smallest _id, the
+        earliest game's clue.
+        """
+        parents = self.groups.tolist()
+
+        def find(row):
+            while parents[row] != row:
+                parents[row] = parents[parents[row]]
+                row = parents[row]
+            return row
+
+        for row, other_row in pairs.tolist():
+            root, other_root = find(row), find(other_row)
+            if root == other_root:
+                continue
+            if self.ids[other_root] < self.ids[root]:
+                root, other_root = other_root, root
+            parents[other_root] = root
+
+        self.groups = find_roots(np.array(parents, dtype=np.int64))
+
+    def to_bytes(self) -> bytes:
+        arrays = {
+            "ids": self.ids,
+            "signatures": self.signatures,
+            "groups": self.groups,
+            "band_orders": np.array(self.band_orders, dtype=np.int32).reshape(
+                BANDS, len(self)
+            ),
+        }
+        if self.watermark is not None:
+            arrays["watermark"] = np.datetime64(self.watermark, "ms")
+
+        f = BytesIO()
+        np.savez(f, **arrays)
+        return f.getvalue()
+
+    def save(self, path=DEDUP_INDEX_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.to_bytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=DEDUP_INDEX_PATH) -> "SignatureIndex":
+        if not os.path.exists(path):
+            return cls()
+
+        with np.load(path) as arrays:
+            return cls(
+                arrays["ids"],
+                arrays["signatures"],
+                arrays["groups"],
+                arrays["band_orders"] if "band_orders" in arrays else None,
+                arrays["watermark"].item() if "watermark" in arrays else None,
+            )
+
+
+# *****************************************************
+# S3 persistence
+# *****************************************************
+
+
+def download_signature_index(
+    bucket: S3Bucket,
+    local_path=DEDUP_INDEX_PATH,
+    s3_path=DEDUP_INDEX_S3_PATH,
+    logger=file_logger,
+) -> SignatureIndex:
+    """
+    The signature index in S3, or an empty one if there isn't one yet.
+    """
+    os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+    if not bucket.list_objects(s3_path, _sync=True):
+        logger.info(f"No signature index at {s3_path}, starting empty")
+        return SignatureIndex()
+
+    download_object_if_changed(bucket, s3_path, local_path, logger=logger)
+    index = SignatureIndex.load(local_path)
+    logger.info(f"Loaded signatures of {len(index)} clues")
+    return index
+
+
+def upload_signature_index(
+    bucket: S3Bucket, index: SignatureIndex, s3_path=DEDUP_INDEX_S3_PATH
+) -> str:
+    return bucket.upload_from_file_object(
+        BytesIO(index.to_bytes()), s3_path, _sync=True
+    )
@@ -1,25 +1,61 @@
 import asyncio
+import hashlib
 import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from functools import cache, partial
 from io import BytesIO
 from logging import getLogger
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Set, Tuple
 
+import bson
 import requests
+from botocore.exceptions import ClientError
+from bson.raw_bson import RawBSONDocument
 from prefect.utilities.asyncutils import run_sync_in_worker_thread
 from prefect_aws import AwsCredentials, S3Bucket
-from pymongo import AsyncMongoClient, MongoClient
+from pymongo import AsyncMongoClient, MongoClient, UpdateOne
 from pymongo.database import Database
 
+from src.async_s3 import current_async_s3
+from src.metrics import timed
+from src.s3_cache import (
+    listed_etags,
+    read_s3_object_cached,
+    read_s3_object_cached_async,
+    remember_etags,
+)
+
 file_logger = getLogger(__name__)
 
+# Tags of the tasks that hold S3 or Mongo connections, for tag concurrency limits.
+# Their limits are set in workflows/create_deployments.py
+S3_TAG = "s3"
+MONGO_TAG = "mongo"
+
+# Metadata key of an uploaded object's MD5, see upload_object
+CONTENT_MD5_METADATA = "content-md5"
+
+# The clue text that domains, relevant links, embeddings and duplicate groups are
+# computed from, see clue_model_text
+MODEL_TEXT_FIELDS = ("clueText", "solution")
+# Fields computed from a clue's text after loading, cleared when the text changes
+DERIVED_CLUE_FIELDS = ("domain", "relevantLinks", "duplicateGroup")
+# Stores kept outside the clues collection, which drop or redo the clues queued in
+# clue_changes. See record_clue_changes
+CLUE_CHANGE_CONSUMERS = ("dedup", "embeddings", "text_index")
+# Fields replace_game_clues doesn't compare or overwrite
+UNCOMPARED_CLUE_FIELDS = ("_id", "createdAt", "updatedAt")
+
 
 def download_html(url, write_path, overwrite=False, logger=file_logger):
     if os.path.exists(write_path) and not overwrite:
         logger.debug(f"{write_path} exists, skipping download")
         return False
 
-    r = requests.get(url)
+    with timed("http_fetch", items=1):
+        r = requests.get(url)
 
     if r.ok:
         logger.info(f"Writing to {write_path}")
@@ -57,13 +93,173 @@ async def get_db(client: AsyncMongoClient, db_name: str = "cluebase") -> Databas
 
 
 async def insert_clue(db, clue_dict):
-    result = await db.clues.insert_one(clue_dict)
+    with timed("mongo_write", items=1):
+        result = await db.clues.insert_one(clue_dict)
     return result.inserted_id
 
 
-async def insert_clue_bulk(db, clue_list):
-    result = await db.clues.insert_many(clue_list, ordered=False)
-    return result.inserted_ids
+def encode_clues(clue_list: List[dict]) -> List[RawBSONDocument]:
+    """
+    BSON-encode clues ahead of inserting them, so the parse workers do the encoding
+    instead of insert_many on the event loop.
+    """
+    with timed("bson_encode", items=len(clue_list)):
+        return [RawBSONDocument(bson.encode(clue)) for clue in clue_list]
+
+
+async def insert_clue_bulk(db, clue_list, documents=None):
+    """
+    Insert the clues, sending their pre-encoded documents from encode_clues instead
+    where given. Returns the inserted ids.
+    """
+    with timed("mongo_write", items=len(clue_list)):
+        result = await db.clues.insert_many(
+            clue_list if documents is None else documents, ordered=False
+        )
+    if documents is None:
+        return result.inserted_ids
+    # insert_many doesn't report the ids of raw documents
+    return [clue["_id"] for clue in clue_list]
+
+
+async def replace_game_clues(db, game_ids, clue_list) -> Tuple[List, List]:
+    """
+    Write the clues of games whose page changed, and delete the games' clues that
+    are no longer on their pages. Clues whose parsed fields are unchanged aren't
+    written, and fields added after loading are kept unless the clue's text
+    changed. Changed and deleted clues are queued in clue_changes for the stores
+    derived from them. Returns the ids of the games' clues, and of the clues
+    deleted.
+    """
+    existing = {
+        clue["_id"]: clue
+        async for clue in db.clues.find({"gameId": {"$in": list(game_ids)}})
+    }
+    new_ids = {clue["_id"] for clue in clue_list}
+
+    update_requests = []
+    changed_ids = []
+    for clue in clue_list:
+        fields = {k: v for k, v in clue.items() if k not in UNCOMPARED_CLUE_FIELDS}
+        old_clue = existing.get(clue["_id"])
+        if old_clue is None:
+            update = {
+                "$set": {**fields, "updatedAt": clue["updatedAt"]},
+                "$setOnInsert": {"createdAt": clue["createdAt"]},
+            }
+            # May have been deleted before, and still be queued as deleted
+            changed_ids.append(clue["_id"])
+        elif any(old_clue.get(k) != v for k, v in fields.items()):
+            update = {"$set": fields}
+            if any(old_clue.get(k) != clue.get(k) for k in MODEL_TEXT_FIELDS):
+                update["$set"]["updatedAt"] = clue["updatedAt"]
+                update["$unset"] = {k: "" for k in DERIVED_CLUE_FIELDS}
+                changed_ids.append(clue["_id"])
+        else:
+            continue
+        update_requests.append(UpdateOne({"_id": clue["_id"]}, update, upsert=True))
+    deleted_ids = [clue_id for clue_id in existing if clue_id not in new_ids]
+
+    with timed("mongo_write", items=len(clue_list)):
+        if update_requests:
+            await db.clues.bulk_write(update_requests, ordered=False)
+        if deleted_ids:
+            await db.clues.delete_many({"_id": {"$in": deleted_ids}})
+        await record_clue_changes(db, changed_ids, deleted=False)
+        await record_clue_changes(db, deleted_ids, deleted=True)
+    return [clue["_id"] for clue in clue_list], deleted_ids
+
+
+async def record_clue_changes(db, clue_ids, deleted: bool):
+    """
+    Queue clues whose text changed, or that were deleted, for each of the
+    CLUE_CHANGE_CONSUMERS to drop or redo. A clue stays queued for a consumer until
+    it calls ack_clue_changes.
+    """
+    if not clue_ids:
+        return
+    now = datetime.now()
+    await db.clue_changes.bulk_write(
+        [
+            UpdateOne(
+                {"_id": clue_id},
+                {
+                    "$set": {"changedAt": now, "deleted": deleted},
+                    "$addToSet": {"pending": {"$each": list(CLUE_CHANGE_CONSUMERS)}},
+                },
+                upsert=True,
+            )
+            for clue_id in clue_ids
+        ],
+        ordered=False,
+    )
+
+
+def pending_clue_changes(db, consumer: str) -> Dict[str, dict]:
+    """
+    The clue changes queued for a consumer, by clue id, from a synchronous client.
+    """
+    return {
+        change["_id"]: change
+        for change in db.clue_changes.find(
+            {"pending": consumer}, {"changedAt": 1, "deleted": 1}
+        )
+    }
+
+
+def ack_clue_changes(db, consumer: str, changes: Dict[str, dict]):
+    """
+    Dequeue the changes a consumer has applied, from a synchronous client. A clue
+    that changed again since pending_clue_changes stays queued.
+    """
+    if not changes:
+        return
+    db.clue_changes.bulk_write(
+        [
+            UpdateOne(
+                {"_id": clue_id, "changedAt": change["changedAt"]},
+                {"$pull": {"pending": consumer}},
+            )
+            for clue_id, change in changes.items()
+        ],
+        ordered=False,
+    )
+    db.clue_changes.delete_many({"pending": {"$size": 0}})
+
+
+async def quarantine_game(db, game_id, error: Exception, source: Optional[str] = None):
+    """
+    Record a game that failed to load, replacing any earlier failure of the game.
+    """
+    now = datetime.now()
+    await db.quarantine.update_one(
+        {"_id": str(game_id)},
+        {
+            "$set": {
+                "error": repr(error),
+                "traceback": "".join(traceback.format_exception(error)),
+                "source": source,
+                "updatedAt": now,
+            },
+            "$setOnInsert": {"createdAt": now},
+            "$inc": {"attempts": 1},
+        },
+        upsert=True,
+    )
+
+
+async def release_quarantined_games(db, game_ids):
+    game_ids = [str(game_id) for game_id in game_ids]
+    if game_ids:
+        await db.quarantine.delete_many({"_id": {"$in": game_ids}})
+
+
+async def get_quarantined_game_ids(db) -> List[str]:
+    return [doc["_id"] async for doc in db.quarantine.find({}, {"_id": 1})]
+
+
+async def get_loaded_game_ids(db) -> Set[str]:
+    return set(await db.clues.distinct("gameId"))
 
 
 # *****************************************************
@@ -85,8 +281,18 @@ def object_exists(bucket: S3Bucket, path: str) -> bool:
 
 
 def upload_object(bucket: S3Bucket, path: str, content: str) -> str:
-    bytes_content = BytesIO(bytes(content, "utf-8"))
-    result_path = bucket.upload_from_file_object(bytes_content, path)
+    data = bytes(content, "utf-8")
+    # Kept in the object's metadata, since the ETag of an SSE-KMS or SSE-C object
+    # isn't its MD5
+    metadata = {CONTENT_MD5_METADATA: hashlib.md5(data).hexdigest()}
+    with timed("s3_put", items=1):
+        # _sync, because prefect-aws would otherwise return a coroutine when called
+        # from a thread of an async task
+        result_path = bucket.upload_from_file_object(
+            BytesIO(data), path, ExtraArgs={"Metadata": metadata}, _sync=True
+        )
+    # The listed ETag is out of date now
+    listed_etags.pop((bucket.bucket_name, result_path), None)
     return result_path
 
 
@@ -97,35 +303,267 @@ def download_html_to_s3(
         logger.debug(f"{write_path} exists, skipping download")
         return None
 
-    r = requests.get(url)
+    _html, path = fetch_html_to_s3(url, bucket, write_path, logger=logger)
 
-    if r.ok:
-        logger.info(f"Writing to {write_path}")
-        path = upload_object(bucket, write_path, r.text)
+    return path
 
-        return path
-    else:
-        logger.error("Error {r.status_code} downloading page {url}")
+
+def fetch_html_to_s3(
+    url: str, bucket: S3Bucket, write_path: str, logger=file_logger
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Download a page to S3. Returns the page's HTML (None if the download failed), and
+    the path it was written to (None if the page was unchanged or failed).
+    """
+    with timed("http_fetch", items=1):
+        r = requests.get(url)
+
+    if not r.ok:
+        logger.error(f"Error {r.status_code} downloading page {url}")
         logger.error(r)
-        return None
+        return None, None
+
+    # Pages that haven't changed since they were listed keep their object. Small
+    # uploads are single-part, so their ETag is the MD5 of the content, unless the
+    # bucket encrypts with KMS. Only then is the object's stored MD5 read.
+    key = bucket._resolve_path(write_path)
+    listed_etag = listed_etags.get((bucket.bucket_name, key))
+    md5 = hashlib.md5(r.text.encode("utf-8")).hexdigest()
+    if listed_etag == md5 or (
+        listed_etag is not None
+        and not bucket_etags_are_md5(bucket)
+        and stored_md5(bucket, key) == md5
+    ):
+        logger.debug(f"{write_path} unchanged, skipping upload")
+        return r.text, None
+
+    logger.info(f"Writing to {write_path}")
+    path = upload_object(bucket, write_path, r.text)
+
+    return r.text, path
 
 
 def read_s3_object(bucket: S3Bucket, path: str) -> str:
-    return bucket.read_path(path)
+    with timed("s3_get", items=1):
+        return read_s3_object_cached(bucket, path)
 
 
 async def read_s3_object_async(bucket: S3Bucket, path: str) -> str:
+    # Inside async_s3_client, read on the event loop instead of in a thread
+    s3 = current_async_s3.get()
+    if s3 is not None:
+        with timed("s3_get", items=1):
+            return await read_s3_object_cached_async(s3, bucket, path)
+
     loop = asyncio.get_event_loop()
 
-    read_object_partial = partial(bucket.read_path, path)
+    read_object_partial = partial(read_s3_object_cached, bucket, path)
+
+    with timed("s3_get", items=1):
+        return await loop.run_in_executor(None, read_object_partial)
+
+
+def etag_is_md5(head: Dict[str, Any]) -> bool:
+    """
+    Whether a HEAD response's ETag is derived from the MD5 of the content, which it
+    is for unencrypted and SSE-S3 objects only.
+    """
+    return (
+        head.get("ServerSideEncryption") in (None, "AES256")
+        and "SSECustomerAlgorithm" not in head
+    )
+
+
+@cache
+def _bucket_etags_are_md5(bucket_name: str, credentials: AwsCredentials) -> bool:
+    client = credentials.get_s3_client()
+    try:
+        encryption = client.get_bucket_encryption(Bucket=bucket_name)
+    except ClientError as e:
+        code = e.response.get("Error", {}).get("Code")
+        # No default encryption, so objects are stored unencrypted
+        if code == "ServerSideEncryptionConfigurationNotFoundError":
+            return True
+        # Can't tell, so don't rely on the ETag
+        file_logger.warning(f"Could not read the encryption of {bucket_name}: {e}")
+        return False
+    rules = encryption["ServerSideEncryptionConfiguration"]["Rules"]
+    return all(
+        rule["ApplyServerSideEncryptionByDefault"]["SSEAlgorithm"] == "AES256"
+        for rule in rules
+    )
+
+
+def bucket_etags_are_md5(bucket: S3Bucket) -> bool:
+    """
+    Whether the bucket's objects, as upload_object writes them, have the MD5 of
+    their content as their ETag. True unless the bucket encrypts with KMS by
+    default. Cached per bucket.
+    """
+    return _bucket_etags_are_md5(bucket.bucket_name, bucket.credentials)
+
+
+def stored_md5(bucket: S3Bucket, key: str) -> Optional[str]:
+    """
+    MD5 of an object's content, from the metadata upload_object stores. None if
+    the object or its metadata is missing.
+    """
+    client = bucket.credentials.get_s3_client()
+    try:
+        head = client.head_object(Bucket=bucket.bucket_name, Key=key)
+    except ClientError as e:
+        if is_missing_object(e):
+            return None
+        raise
+    return head.get("Metadata", {}).get(CONTENT_MD5_METADATA)
+
+
+def is_missing_object(error: BaseException) -> bool:
+    """
+    Whether a read failed because the object doesn't exist, rather than S3 failing.
+    """
+    if not isinstance(error, ClientError):
+        return False
+    return error.response.get("Error", {}).get("Code") in ("NoSuchKey", "404")
+
+
+DOWNLOAD_PART_SIZE = 64 * 1024 * 1024
+# boto3 clients keep 10 pooled connections by default
+DOWNLOAD_WORKERS = 10
+# What boto3's managed uploads (S3Bucket.upload_from_path) use for multipart parts
+UPLOAD_PART_SIZE = 8 * 1024 * 1024
+
 
-    return await loop.run_in_executor(None, read_object_partial)
+def compute_local_etag(file_path: str, part_size: Optional[int] = None) -> str:
+    """
+    S3-style ETag of a local file: the MD5 for single-part uploads, the MD5 of the
+    part MD5s plus "-<parts>" for multipart uploads.
+    """
+    with open(file_path, "rb") as f:
+        if part_size is None:
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                md5.update(chunk)
+            return md5.hexdigest()
+
+        part_digests = [
+            hashlib.md5(part).digest() for part in iter(lambda: f.read(part_size), b"")
+        ]
+
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+def etag_matches(file_path: str, etag: str) -> Optional[bool]:
+    """
+    Check a local file against an S3 ETag. None when the ETag can't be reproduced,
+    e.g. a multipart upload with an unknown part size.
+    """
+    if "-" not in etag:
+        return compute_local_etag(file_path) == etag
+
+    parts = int(etag.split("-")[-1])
+    size = os.path.getsize(file_path)
+    mib = 1024 * 1024
+    candidate_part_sizes = {UPLOAD_PART_SIZE, -(-size // parts // mib) * mib}
+    for part_size in candidate_part_sizes:
+        if -(-size // part_size) == parts:
+            if compute_local_etag(file_path, part_size) == etag:
+                return True
+
+    return None
+
+
+def download_object_if_changed(
+    bucket: S3Bucket,
+    path: str,
+    local_path: str,
+    part_size: int = DOWNLOAD_PART_SIZE,
+    max_workers: int = DOWNLOAD_WORKERS,
+    logger=file_logger,
+) -> bool:
+    """
+    Download an S3 object unless local_path already holds the same version.
+
+    The ETag of the last download is kept in a `<local_path>.etag` sidecar and
+    compared, along with the size, against a HEAD of the object. Downloads use
+    parallel ranged GETs into a temp file, which is checked against the ETag and
+    then moved into place, so an interrupted download never leaves a partial file
+    at local_path. Returns True if the file was downloaded.
+    """
+    client = bucket.credentials.get_s3_client()
+    key = bucket._resolve_path(path)
+
+    head = client.head_object(Bucket=bucket.bucket_name, Key=key)
+    etag = head["ETag"].strip('"')
+    size = head["ContentLength"]
+
+    etag_path = f"{local_path}.etag"
+    if os.path.exists(local_path) and os.path.exists(etag_path):
+        with open(etag_path, "r") as f:
+            local_etag = f.read().strip()
+
+        if local_etag == etag and os.path.getsize(local_path) == size:
+            logger.info(f"{local_path} matches s3://{bucket.bucket_name}/{key}")
+            return False
+
+    logger.info(f"Downloading s3://{bucket.bucket_name}/{key} ({size} bytes)")
+    tmp_path = f"{local_path}.part"
+    with open(tmp_path, "wb") as f:
+        f.truncate(size)
+
+    def download_range(start):
+        end = min(start + part_size, size) - 1
+        response = client.get_object(
+            Bucket=bucket.bucket_name,
+            Key=key,
+            Range=f"bytes={start}-{end}",
+            IfMatch=etag,
+        )
+        with open(tmp_path, "r+b") as f:
+            f.seek(start)
+            for chunk in response["Body"].iter_chunks(1024 * 1024):
+                f.write(chunk)
+
+    try:
+        # Items are bytes for this stage
+        with timed("s3_download", items=size), ThreadPoolExecutor(
+            max_workers=max_workers
+        ) as pool:
+            # list() so that a failed range raises here
+            list(pool.map(download_range, range(0, size, part_size)))
+
+        if etag_is_md5(head):
+            verified = etag_matches(tmp_path, etag)
+        elif CONTENT_MD5_METADATA in head.get("Metadata", {}):
+            verified = (
+                compute_local_etag(tmp_path) == head["Metadata"][CONTENT_MD5_METADATA]
+            )
+        else:
+            # The ETag of an SSE-KMS or SSE-C object isn't derived from its MD5
+            verified = None
+        if verified is False:
+            raise IOError(f"Checksum mismatch downloading {key} to {local_path}")
+        if verified is None:
+            logger.warning(f"Could not verify ETag {etag}, size matches")
+
+        os.replace(tmp_path, local_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    with open(f"{etag_path}.tmp", "w+") as f:
+        f.write(etag)
+    os.replace(f"{etag_path}.tmp", etag_path)
+
+    return True
 
 
 @cache
 def ls_s3(bucket_name: str, path: str) -> str:
     bucket = get_s3_bucket(bucket_name)
-    response = bucket.list_objects(path)
+    response = bucket.list_objects(path, _sync=True)
+    remember_etags(bucket_name, response)
 
     return tuple(s3_object["Key"] for s3_object in response)
 
@@ -141,6 +579,17 @@ async def ls_s3_prefix(
     logger=file_logger,
 ) -> List[Dict[str, Any]]:
     bucket_path = bucket._join_bucket_folder(folder) + "/" + prefix
+
+    s3 = current_async_s3.get()
+    if s3 is not None and not jmespath_query:
+        logger.info(f"Listing objects in bucket {bucket_path}.")
+        objects = await s3.list_objects(
+            bucket.bucket_name, bucket_path, delimiter, page_size, max_items
+        )
+        remember_etags(bucket.bucket_name, objects)
+
+        return tuple(s3_object["Key"] for s3_object in objects)
+
     client = bucket.credentials.get_s3_client()
     paginator = client.get_paginator("list_objects_v2")
     page_iterator = paginator.paginate(
@@ -154,5 +603,6 @@ async def ls_s3_prefix(
 
     logger.info(f"Listing objects in bucket {bucket_path}.")
     objects = await run_sync_in_worker_thread(bucket._list_objects_sync, page_iterator)
+    remember_etags(bucket.bucket_name, objects)
 
     return tuple(s3_object["Key"] for s3_object in objects)
@@ -0,0 +1,345 @@
+"""
+Opt-in memory profiling of the heavy stages, and a memory budget for streaming ones.
+
+With CLUEBASE_MEMORY_PROFILE=1, a stage wrapped in `profile_memory("stage")` traces
+Python allocations with tracemalloc while it runs, and reports its peak traced
+memory, RSS before, after and at peak, and its top allocation sites as a Prefect
+markdown artifact (or to the log, outside a flow run). tracemalloc slows
+allocation-heavy code down, hence opt-in. Sites are taken from the largest of the
+snapshots the stage checkpoints, and from the end of the stage.
+
+CLUEBASE_MEMORY_BUDGET ("2GB", "512MiB", or bytes) is how much memory the process
+may use. Streaming stages ask `get_memory_budget()` how many items fit in what's
+left, and wait for headroom before taking on more work, rather than being
+OOM-killed at the container's limit.
+"""
+
+import asyncio
+import ctypes
+import gc
+import os
+import re
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import cache
+from logging import getLogger
+from typing import Optional
+
+from prefect.artifacts import create_markdown_artifact
+from prefect.context import get_run_context
+from prefect.exceptions import MissingContextError
+from prefect.runtime import flow_run
+
+file_logger = getLogger(__name__)
+
+PROFILE_ENV = "CLUEBASE_MEMORY_PROFILE"
+BUDGET_ENV = "CLUEBASE_MEMORY_BUDGET"
+
+TOP_ALLOCATION_SITES = 15
+# Fraction of the budget that streaming stages keep RSS under
+HIGH_WATER_MARK = 0.8
+# Backpressure gives up waiting after this long, memory freed by Python isn't
+# always returned to the OS, so RSS may not drop however much is drained
+MAX_WAIT_SECONDS = 30
+POLL_SECONDS = 0.5
+
+SIZE_UNITS = {
+    "": 1,
+    "b": 1,
+    "kb": 1000,
+    "mb": 1000**2,
+    "gb": 1000**3,
+    "kib": 1024,
+    "mib": 1024**2,
+    "gib": 1024**3,
+}
+SIZE_REGEX = re.compile(r"^\s*([0-9.]+)\s*([a-z]*)\s*$")
+
+
+def parse_size(size: str) -> int:
+    match = SIZE_REGEX.match(size.lower())
+    if not match or match.group(2) not in SIZE_UNITS:
+        raise ValueError(f"Can't parse memory size {size!r}")
+
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def format_size(n_bytes: int) -> str:
+    return f"{n_bytes / 1024**2:,.1f} MiB"
+
+
+def read_proc_status(field: str) -> Optional[int]:
+    """
+    A kB field of /proc/self/status in bytes, None where there's no /proc.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def max_rss_bytes() -> int:
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def rss_bytes() -> int:
+    rss = read_proc_status("VmRSS")
+    return max_rss_bytes() if rss is None else rss
+
+
+def peak_rss_bytes() -> int:
+    peak = read_proc_status("VmHWM")
+    return max_rss_bytes() if peak is None else peak
+
+
+def reset_peak_rss() -> bool:
+    """
+    Reset VmHWM to the current RSS, so a stage's peak isn't an earlier stage's.
+    Only Linux can, returns whether it did.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def release_free_memory():
+    """
+    Collect garbage and ask glibc to return freed heap pages to the OS, so RSS
+    reflects what's actually in use.
+    """
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def profiling_enabled() -> bool:
+    return os.environ.get(PROFILE_ENV, "").lower() in ("1", "true", "yes")
+
+
+# Profiles running, tracing stops when the last one ends unless it was already on
+active_profiles = 0
+stop_tracing_after = False
+profiles_lock = threading.Lock()
+
+
+def start_tracing():
+    global active_profiles, stop_tracing_after
+    with profiles_lock:
+        if active_profiles == 0:
+            stop_tracing_after = not tracemalloc.is_tracing()
+            if stop_tracing_after:
+                tracemalloc.start()
+        active_profiles += 1
+
+
+def stop_tracing():
+    global active_profiles
+    with profiles_lock:
+        active_profiles -= 1
+        if active_profiles == 0 and stop_tracing_after:
+            tracemalloc.stop()
+
+
+class MemoryProfile:
+    def __init__(self, stage):
+        self.stage = stage
+        self.start_snapshot = tracemalloc.take_snapshot()
+        self.largest_snapshot = None
+        self.largest_traced = -1
+
+    def checkpoint(self):
+        """
+        Snapshot the allocations now, where the stage holds the most it will.
+        """
+        traced, _peak = tracemalloc.get_traced_memory()
+        if traced > self.largest_traced:
+            self.largest_snapshot = tracemalloc.take_snapshot()
+            self.largest_traced = traced
+
+    def top_sites(self, top=TOP_ALLOCATION_SITES):
+        """
+        The allocation sites that grew the most since the stage started.
+        """
+        return self.largest_snapshot.compare_to(self.start_snapshot, "lineno")[:top]
+
+
+class NoProfile:
+    def checkpoint(self):
+        pass
+
+
+@contextmanager
+def profile_memory(stage, top=TOP_ALLOCATION_SITES, logger=file_logger):
+    """
+    Profile the block as `stage` when CLUEBASE_MEMORY_PROFILE is set. Call
+    `.checkpoint()` on the yielded profile where the stage's memory peaks.
+
+    tracemalloc and RSS are process-wide, so stages running concurrently in the
+    process are counted in each other's numbers.
+    """
+    if not profiling_enabled():
+        yield NoProfile()
+        return
+
+    start_tracing()
+    tracemalloc.reset_peak()
+    rss_before = rss_bytes()
+    peak_is_stage = reset_peak_rss()
+
+    profile = MemoryProfile(stage)
+    try:
+        yield profile
+    finally:
+        profile.checkpoint()
+        _traced, traced_peak = tracemalloc.get_traced_memory()
+        stop_tracing()
+
+        sizes = {
+            "traced_peak": traced_peak,
+            "rss_before": rss_before,
+            "rss_after": rss_bytes(),
+            # Without a reset, the process's peak so far
+            "rss_peak": peak_rss_bytes(),
+        }
+        # A reporting error mustn't replace the stage's own, or fail a stage that
+        # succeeded
+        try:
+            report_memory_profile(profile, sizes, peak_is_stage, top, logger=logger)
+        except Exception:
+            logger.exception(f"Failed to report the memory profile of {stage}")
+
+
+def report_memory_profile(profile, sizes, peak_is_stage, top, logger=file_logger):
+    sites = profile.top_sites(top)
+
+    logger.info(
+        f"Memory of {profile.stage}: "
+        + ", ".join(f"{name} {format_size(size)}" for name, size in sizes.items())
+    )
+    for site in sites[:5]:
+        logger.info(f"Memory of {profile.stage}: {site}")
+
+    try:
+        get_run_context()
+    except MissingContextError:
+        return
+
+    lines = [
+        f"# Memory of {profile.stage}",
+        "",
+        "| | |",
+        "| --- | --- |",
+        *[f"| {name} | {format_size(size)} |" for name, size in sizes.items()],
+        "",
+    ]
+    if not peak_is_stage:
+        lines += ["rss_peak is the process's peak, it couldn't be reset.", ""]
+    lines += [
+        f"## Top {len(sites)} allocation sites",
+        "",
+        "| site | size | growth | blocks |",
+        "| --- | --- | --- | --- |",
+        *[
+            f"| {site.traceback} | {format_size(site.size)} "
+            f"| {format_size(site.size_diff)} | {site.count} |"
+            for site in sites
+        ],
+    ]
+
+    flow_name = flow_run.flow_name or "local"
+    key = re.sub(r"[^a-z0-9-]+", "-", f"{flow_name}-{profile.stage}".lower())
+    create_markdown_artifact(
+        markdown="\n".join(lines),
+        key=f"{key}-memory",
+        description=f"Peak memory and top allocation sites of {profile.stage}",
+        _sync=True,
+    )
+
+
+class MemoryBudget:
+    def __init__(self, limit_bytes: int, high_water_mark=HIGH_WATER_MARK):
+        self.limit_bytes = limit_bytes
+        self.high_water_bytes = int(limit_bytes * high_water_mark)
+        self.waited_seconds = 0.0
+        self.last_release = float("-inf")
+        self.release_lock = threading.Lock()
+
+    def headroom(self) -> int:
+        """
+        Bytes left before the high-water mark, negative past it.
+        """
+        return self.high_water_bytes - rss_bytes()
+
+    def under_pressure(self) -> bool:
+        return self.headroom() <= 0
+
+    def batch_size(self, batch_size: int, item_bytes: int, min_batch_size=1) -> int:
+        """
+        batch_size, shrunk so that the batch's items fit in the headroom.
+        """
+        fits = max(self.headroom(), 0) // max(item_bytes, 1)
+        return max(min_batch_size, min(batch_size, int(fits)))
+
+    def release_free_memory(self):
+        """
+        release_free_memory at most once per POLL_SECONDS, however many stages are
+        waiting. It runs on the event loop, which has to keep draining the queues.
+        """
+        with self.release_lock:
+            now = time.monotonic()
+            if now - self.last_release < POLL_SECONDS:
+                return
+            self.last_release = now
+        release_free_memory()
+
+    async def wait_for_headroom(self, draining=None, logger=file_logger) -> bool:
+        """
+        Wait until RSS is back under the high-water mark, yielding to the event loop
+        so the stages downstream can work through what's already in flight. Stops
+        waiting once draining() says nothing is left in flight, or after
+        MAX_WAIT_SECONDS. Returns whether there's headroom.
+        """
+        if not self.under_pressure():
+            return True
+
+        start_time = time.monotonic()
+        while True:
+            self.release_free_memory()
+            if not self.under_pressure():
+                break
+            if (draining is not None and not draining()) or (
+                time.monotonic() - start_time > MAX_WAIT_SECONDS
+            ):
+                logger.warning(
+                    f"RSS {format_size(rss_bytes())} is over the memory budget's "
+                    f"high-water mark {format_size(self.high_water_bytes)}"
+                )
+                break
+            await asyncio.sleep(POLL_SECONDS)
+
+        self.waited_seconds += time.monotonic() - start_time
+        return not self.under_pressure()
+
+
+@cache
+def get_memory_budget() -> Optional[MemoryBudget]:
+    """
+    The budget set by CLUEBASE_MEMORY_BUDGET, None if there isn't one.
+    """
+    budget = os.environ.get(BUDGET_ENV)
+    return MemoryBudget(parse_size(budget)) if budget else None
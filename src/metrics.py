@@ -0,0 +1,289 @@
+"""
+Per-stage timers and counters for the hot paths of the flows.
+
+Code wraps a stage in `timed("s3_get")`, and flows decorated with
+`publish_stage_metrics` report every stage recorded during the run once it finishes:
+always as Prefect table artifacts, and optionally as a Prometheus textfile (set
+CLUEBASE_METRICS_TEXTFILE_DIR to node_exporter's textfile collector directory) and
+as OpenTelemetry histograms (set CLUEBASE_METRICS_OTEL=1, they go to whichever
+MeterProvider is configured).
+
+Stages are recorded process-wide, so flow runs served concurrently from one process
+share their samples. Work sent to another process records its stages there, so run
+it through `call_with_stage_metrics` and merge them with `stage_metrics.merge`.
+Nested stages (quality_pass inside html_parse) each count their full time.
+"""
+
+import bisect
+import functools
+import math
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from logging import getLogger
+
+from prefect.artifacts import create_table_artifact
+from prefect.logging import get_run_logger
+from prefect.runtime import deployment, flow_run
+
+file_logger = getLogger(__name__)
+
+# Upper bounds in seconds, the Prometheus client's default buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+TEXTFILE_DIR_ENV = "CLUEBASE_METRICS_TEXTFILE_DIR"
+OTEL_ENV = "CLUEBASE_METRICS_OTEL"
+
+
+class StageMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.durations = defaultdict(list)
+            self.items = defaultdict(int)
+
+    def record(self, stage, seconds, items=0):
+        with self.lock:
+            self.durations[stage].append(seconds)
+            self.items[stage] += items
+
+    def merge(self, durations, items):
+        """
+        Add the stages of a snapshot, taken in another process.
+        """
+        with self.lock:
+            for stage, stage_durations in durations.items():
+                self.durations[stage] += stage_durations
+            for stage, stage_items in items.items():
+                self.items[stage] += stage_items
+
+    def snapshot(self):
+        """
+        Stage -> sorted durations, and stage -> items.
+        """
+        with self.lock:
+            return (
+                {stage: sorted(d) for stage, d in self.durations.items()},
+                dict(self.items),
+            )
+
+    def summary(self):
+        """
+        One row per stage: calls, items, total and percentile latencies.
+        """
+        durations, items = self.snapshot()
+
+        rows = []
+        for stage, stage_durations in sorted(durations.items()):
+            total = sum(stage_durations)
+            rows.append(
+                {
+                    "stage": stage,
+                    "calls": len(stage_durations),
+                    "items": items[stage],
+                    "total_s": round(total, 3),
+                    "mean_ms": round(total / len(stage_durations) * 1000, 2),
+                    "p50_ms": round(percentile(stage_durations, 50) * 1000, 2),
+                    "p90_ms": round(percentile(stage_durations, 90) * 1000, 2),
+                    "p99_ms": round(percentile(stage_durations, 99) * 1000, 2),
+                    "max_ms": round(stage_durations[-1] * 1000, 2),
+                    "items_per_s": round(items[stage] / total, 1) if total else None,
+                }
+            )
+
+        return rows
+
+    def histograms(self):
+        """
+        Stage -> cumulative call counts at each of BUCKETS.
+        """
+        durations, _items = self.snapshot()
+
+        return {
+            stage: [bisect.bisect_right(stage_durations, le) for le in BUCKETS]
+            for stage, stage_durations in sorted(durations.items())
+        }
+
+
+def percentile(sorted_values, q):
+    # Nearest-rank percentile
+    rank = math.ceil(len(sorted_values) * q / 100)
+    return sorted_values[max(rank, 1) - 1]
+
+
+stage_metrics = StageMetrics()
+
+
+@contextmanager
+def timed(stage, items=0):
+    """
+    Time the block as one call of `stage`. Set `.items` on the yielded timer when
+    the item count is only known at the end.
+    """
+    timer = Timer(items)
+    start_time = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        stage_metrics.record(stage, time.perf_counter() - start_time, timer.items)
+
+
+class Timer:
+    def __init__(self, items=0):
+        self.items = items
+
+
+def call_with_stage_metrics(fn, *args):
+    """
+    Call fn in a worker process, returning its result and a snapshot of the stages
+    it recorded, for the calling process to merge.
+    """
+    stage_metrics.reset()
+    return fn(*args), stage_metrics.snapshot()
+
+
+def publish_stage_metrics(flow_fn):
+    """
+    Decorate a flow function (under @flow) to reset stage metrics when it starts and
+    report them when it ends. Subflows leave it to their parent flow.
+    """
+
+    @functools.wraps(flow_fn)
+    def wrapper(*args, **kwargs):
+        if flow_run.parent_flow_run_id:
+            return flow_fn(*args, **kwargs)
+
+        stage_metrics.reset()
+        try:
+            return flow_fn(*args, **kwargs)
+        finally:
+            logger = get_run_logger()
+            # A reporting error mustn't replace the flow's own, or fail a flow that
+            # succeeded
+            try:
+                report_stage_metrics(logger=logger)
+            except Exception:
+                logger.exception("Failed to report stage metrics")
+
+    return wrapper
+
+
+def report_stage_metrics(metrics=stage_metrics, logger=file_logger):
+    rows = metrics.summary()
+    if not rows:
+        return
+
+    for row in rows:
+        logger.info(f"Stage metrics: {row}")
+
+    flow_name = flow_run.flow_name or "local"
+    key = re.sub(r"[^a-z0-9-]+", "-", flow_name.lower())
+
+    create_table_artifact(
+        table=rows,
+        key=f"{key}-stage-metrics",
+        description=f"Per-stage throughput and latency of {flow_name}",
+    )
+
+    histograms = metrics.histograms()
+    create_table_artifact(
+        table=[
+            {"stage": stage, **{bucket_label(le): n for le, n in zip(BUCKETS, counts)}}
+            for stage, counts in histograms.items()
+        ],
+        key=f"{key}-stage-latency-histogram",
+        description=f"Calls of each stage of {flow_name} finishing within each latency",
+    )
+
+    labels = {"flow": flow_name, "deployment": deployment.name or ""}
+
+    textfile_dir = os.environ.get(TEXTFILE_DIR_ENV)
+    if textfile_dir:
+        path = os.path.join(textfile_dir, f"cluebase_{key.replace('-', '_')}.prom")
+        write_prometheus_textfile(metrics, path, labels)
+        logger.info(f"Wrote stage metrics to {path}")
+
+    if os.environ.get(OTEL_ENV):
+        export_otel(metrics, labels, logger=logger)
+
+
+def bucket_label(le):
+    return "+Inf" if le == float("inf") else f"<={le}s"
+
+
+def write_prometheus_textfile(metrics, path, labels):
+    """
+    Write the histograms in the Prometheus text format, atomically so the textfile
+    collector never reads a partial file.
+    """
+    durations, items = metrics.snapshot()
+    histograms = metrics.histograms()
+
+    lines = [
+        "# HELP cluebase_stage_duration_seconds Latency of each call of a flow stage.",
+        "# TYPE cluebase_stage_duration_seconds histogram",
+    ]
+    for stage, counts in histograms.items():
+        stage_labels = prometheus_labels({**labels, "stage": stage})
+        for le, count in zip(BUCKETS, counts):
+            bucket = "+Inf" if le == float("inf") else repr(float(le))
+            lines.append(
+                "cluebase_stage_duration_seconds_bucket"
+                f'{{{stage_labels},le="{bucket}"}} {count}'
+            )
+        lines.append(
+            f"cluebase_stage_duration_seconds_sum{{{stage_labels}}} "
+            f"{sum(durations[stage])}"
+        )
+        lines.append(
+            f"cluebase_stage_duration_seconds_count{{{stage_labels}}} "
+            f"{len(durations[stage])}"
+        )
+
+    lines += [
+        "# HELP cluebase_stage_items Items processed by a flow stage in the last run.",
+        "# TYPE cluebase_stage_items gauge",
+    ]
+    for stage in histograms:
+        stage_labels = prometheus_labels({**labels, "stage": stage})
+        lines.append(f"cluebase_stage_items{{{stage_labels}}} {items[stage]}")
+
+    with open(f"{path}.tmp", "w+") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(f"{path}.tmp", path)
+
+
+def prometheus_labels(labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return ",".join(f'{name}="{escape(value)}"' for name, value in labels.items())
+
+
+def export_otel(metrics, labels, logger=file_logger):
+    try:
+        from opentelemetry import metrics as otel_metrics
+    except ImportError:
+        logger.warning(f"{OTEL_ENV} is set but opentelemetry-api isn't installed")
+        return
+
+    meter = otel_metrics.get_meter("cluebase")
+    duration_histogram = meter.create_histogram(
+        "cluebase.stage.duration", unit="s", description="Latency of a flow stage"
+    )
+    items_counter = meter.create_counter(
+        "cluebase.stage.items", description="Items processed by a flow stage"
+    )
+
+    durations, items = metrics.snapshot()
+    for stage, stage_durations in durations.items():
+        attributes = {**labels, "stage": stage}
+        for seconds in stage_durations:
+            duration_histogram.record(seconds, attributes)
+        items_counter.add(items[stage], attributes)
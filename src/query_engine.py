@@ -0,0 +1,457 @@
+"""
+In-memory columnar clue store for serving lookups.
+
+The corpus is held as one array per field instead of one dict per clue: clue text
+and solutions as UTF-8 bytes with offsets, category, domain and gameId as integer
+codes into a dictionary of their distinct values, air dates as days since the epoch,
+and the small integer fields as int8. Rows are sorted by _id, so a game's clues are
+contiguous and in board order.
+
+Every indexed field keeps a secondary index: the row numbers sorted by the field's
+value, plus those values, so an equality or range match is two binary searches
+giving a slice of row numbers. A query starts from its most selective condition's
+slice and checks the other conditions against the columns of just those rows.
+
+Filters use a subset of Mongo's query syntax, so the same filter can be run against
+the clues collection:
+
+    store.find({"category": "SCIENCE", "airDate": {"$gte": datetime(2020, 1, 1)}})
+    store.find({"roundNumber": {"$in": [1, 2]}, "difficulty": 4}, limit=10)
+"""
+
+from datetime import datetime, timedelta
+from logging import getLogger
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+from bson import json_util
+from pymongo import MongoClient
+
+file_logger = getLogger(__name__)
+
+DICTIONARY_FIELDS = ("gameId", "category", "domain")
+INDEXED_FIELDS = (
+    "gameId",
+    "airDate",
+    "category",
+    "roundNumber",
+    "difficulty",
+    "domain",
+)
+RANGE_OPERATORS = ("$gt", "$gte", "$lt", "$lte")
+SUPPORTED_OPERATORS = ("$eq", "$in") + RANGE_OPERATORS
+
+EPOCH = datetime(1970, 1, 1)
+# airDate of clues without one
+MISSING_DAY = np.iinfo(np.int32).min
+
+MONGO_PROJECTION = {
+    "clueText": 1,
+    "solution": 1,
+    "category": 1,
+    "difficulty": 1,
+    "airDate": 1,
+    "gameId": 1,
+    "roundNumber": 1,
+    "categoryIndex": 1,
+    "domain": 1,
+}
+
+
+class StringColumn:
+    """
+    Strings concatenated as UTF-8, with row i at data[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, values: Iterable[str]):
+        encoded = [(value or "").encode("utf-8") for value in values]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=self.offsets[1:])
+        self.data = b"".join(encoded)
+
+    def __getitem__(self, row: int) -> str:
+        return self.data[self.offsets[row] : self.offsets[row + 1]].decode("utf-8")
+
+    def take(self, rows: np.ndarray) -> List[str]:
+        data = self.data
+        return [
+            data[start:end].decode("utf-8")
+            for start, end in zip(
+                self.offsets[rows].tolist(), self.offsets[rows + 1].tolist()
+            )
+        ]
+
+    @property
+    def nbytes(self):
+        return len(self.data) + self.offsets.nbytes
+
+
+class DictionaryColumn:
+    """
+    Values as int32 codes into the sorted distinct values. None gets code 0.
+    Values keep their type, so like Mongo, 1 doesn't match "1".
+    """
+
+    def __init__(self, values: Iterable[Any]):
+        values = list(values)
+        # Sorted by type then value, since a field may mix types
+        self.dictionary = [None] + sorted(
+            {value for value in values} - {None},
+            key=lambda value: (type(value).__name__, value),
+        )
+        self.codes_by_value = {
+            value: code for code, value in enumerate(self.dictionary)
+        }
+        self.codes = np.fromiter(
+            (self.codes_by_value[value] for value in values),
+            dtype=np.int32,
+            count=len(values),
+        )
+
+    def encode(self, value) -> int:
+        # -1 matches no row
+        return self.codes_by_value.get(value, -1)
+
+    def __getitem__(self, row: int):
+        return self.dictionary[self.codes[row]]
+
+    def take(self, rows: np.ndarray) -> List[Any]:
+        dictionary = self.dictionary
+        return [dictionary[code] for code in self.codes[rows].tolist()]
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+
+class SortedIndex:
+    """
+    Row numbers sorted by a column's (integer) values, for equality and range
+    lookups by binary search.
+    """
+
+    def __init__(self, values: np.ndarray):
+        self.rows = np.argsort(values, kind="stable").astype(np.int32)
+        self.values = values[self.rows]
+
+    def span(self, low=None, high=None):
+        """
+        Positions in the index of the values from low to high, both inclusive.
+        """
+        # Searching with a key of another dtype would cast the whole array first
+        info = np.iinfo(self.values.dtype)
+        low = info.min if low is None else max(low, info.min)
+        high = info.max if high is None else min(high, info.max)
+        if low > high:
+            return 0, 0
+
+        dtype = self.values.dtype.type
+        start = np.searchsorted(self.values, dtype(low), "left")
+        end = np.searchsorted(self.values, dtype(high), "right")
+        return start, end
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.values.nbytes
+
+
+def to_datetime(value) -> datetime:
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def to_day(value) -> int:
+    if value is None:
+        return MISSING_DAY
+    value = to_datetime(value)
+    return (datetime(value.year, value.month, value.day) - EPOCH).days
+
+
+def is_midnight(value) -> bool:
+    """
+    Whether a datetime falls on a day boundary, as the stored air dates all do.
+    """
+    value = to_datetime(value)
+    return value == datetime(value.year, value.month, value.day, tzinfo=value.tzinfo)
+
+
+def from_day(day: int) -> Optional[datetime]:
+    if day == MISSING_DAY:
+        return None
+    return EPOCH + timedelta(days=int(day))
+
+
+class ClueStore:
+    def __init__(self, clues: Iterable[Dict[str, Any]]):
+        clues = sorted(clues, key=lambda clue: clue["_id"])
+
+        self.ids = StringColumn(clue["_id"] for clue in clues)
+        self.clue_text = StringColumn(clue.get("clueText") for clue in clues)
+        self.solution = StringColumn(clue.get("solution") for clue in clues)
+        self.dictionaries = {
+            field: DictionaryColumn(clue.get(field) for clue in clues)
+            for field in DICTIONARY_FIELDS
+        }
+        self.columns = {
+            field: column.codes for field, column in self.dictionaries.items()
+        }
+        self.columns["airDate"] = np.fromiter(
+            (to_day(clue.get("airDate")) for clue in clues),
+            dtype=np.int32,
+            count=len(clues),
+        )
+        for field in ("roundNumber", "difficulty", "categoryIndex"):
+            self.columns[field] = np.fromiter(
+                (clue.get(field, -1) for clue in clues), dtype=np.int8, count=len(clues)
+            )
+
+        self.indexes = {
+            field: SortedIndex(self.columns[field]) for field in INDEXED_FIELDS
+        }
+
+    def __len__(self):
+        return len(self.ids.offsets) - 1
+
+    @property
+    def nbytes(self):
+        return (
+            self.ids.nbytes
+            + self.clue_text.nbytes
+            + self.solution.nbytes
+            + sum(column.nbytes for column in self.columns.values())
+            + sum(index.nbytes for index in self.indexes.values())
+        )
+
+    def clue(self, row: int) -> Dict[str, Any]:
+        """
+        The clue at a row, shaped like its Mongo document.
+        """
+        return self.take(np.array([row]))[0]
+
+    def take(self, rows: np.ndarray) -> List[Dict[str, Any]]:
+        """
+        The clues at rows. Each column is gathered once for all the rows, rather than
+        indexing the arrays clue by clue.
+        """
+        fields = {
+            "_id": self.ids.take(rows),
+            "clueText": self.clue_text.take(rows),
+            "solution": self.solution.take(rows),
+            "category": self.dictionaries["category"].take(rows),
+            "difficulty": self.columns["difficulty"][rows].tolist(),
+            "airDate": [
+                from_day(day) for day in self.columns["airDate"][rows].tolist()
+            ],
+            "gameId": self.dictionaries["gameId"].take(rows),
+            "roundNumber": self.columns["roundNumber"][rows].tolist(),
+            "categoryIndex": self.columns["categoryIndex"][rows].tolist(),
+        }
+        domains = self.dictionaries["domain"].take(rows)
+
+        clues = [dict(zip(fields, values)) for values in zip(*fields.values())]
+        for clue, domain in zip(clues, domains):
+            if domain is not None:
+                clue["domain"] = domain
+
+        return clues
+
+    def conditions(self, query: Dict[str, Any]):
+        """
+        A filter as (field, values, low, high) conditions on the encoded columns,
+        matching rows whose value is in values, or else from low to high inclusive.
+        All the range operators on a field make up one condition.
+        """
+        conditions = []
+        for field, condition in query.items():
+            if field not in INDEXED_FIELDS:
+                raise ValueError(
+                    f"Can't filter on {field}, expected one of {INDEXED_FIELDS}"
+                )
+
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+
+            # Clues without an air date match no range
+            low = MISSING_DAY + 1 if field == "airDate" else None
+            high = None
+            for operator, value in condition.items():
+                if operator not in SUPPORTED_OPERATORS:
+                    raise ValueError(
+                        f"Unsupported operator {operator}, expected one of "
+                        f"{SUPPORTED_OPERATORS}"
+                    )
+                if operator in RANGE_OPERATORS and field in DICTIONARY_FIELDS:
+                    raise ValueError(f"Range queries on {field} aren't supported")
+
+                # Air dates are stored as days. An air date equals no time within
+                # a day, so it matches nothing
+                if operator == "$in":
+                    values = np.unique(
+                        [
+                            self.encode(field, v)
+                            for v in value
+                            if field != "airDate" or v is None or is_midnight(v)
+                        ]
+                    )
+                    conditions.append((field, values, None, None))
+                    continue
+
+                # Encoded values are integers, so every bound can be inclusive
+                within_day = (
+                    field == "airDate" and value is not None and not is_midnight(value)
+                )
+                value = self.encode(field, value)
+                if operator == "$eq":
+                    if within_day:
+                        conditions.append((field, np.empty(0, np.int32), None, None))
+                    else:
+                        conditions.append((field, None, value, value))
+                elif operator in ("$gt", "$gte"):
+                    # Days after a time within a day start from the next day
+                    bound = value + 1 if operator == "$gt" or within_day else value
+                    low = bound if low is None else max(low, bound)
+                else:
+                    # Days before a time within a day include that day
+                    bound = value - 1 if operator == "$lt" and not within_day else value
+                    high = bound if high is None else min(high, bound)
+
+            if any(operator in RANGE_OPERATORS for operator in condition):
+                conditions.append((field, None, low, high))
+
+        return conditions
+
+    def encode(self, field, value) -> int:
+        if field in DICTIONARY_FIELDS:
+            return self.dictionaries[field].encode(value)
+        if field == "airDate":
+            return to_day(value)
+        return int(value)
+
+    def spans(self, field, values, low, high):
+        index = self.indexes[field]
+        if values is None:
+            return [index.span(low, high)]
+        return [index.span(value, value) for value in values]
+
+    def candidate_rows(self, field, values, low, high) -> np.ndarray:
+        """
+        Row numbers matching one condition, through the field's index.
+        """
+        rows = self.indexes[field].rows
+        spans = self.spans(field, values, low, high)
+        if len(spans) == 1:
+            start, end = spans[0]
+            return rows[start:end]
+
+        return np.concatenate(
+            [rows[start:end] for start, end in spans] or [np.empty(0, np.int32)]
+        )
+
+    def condition_size(self, field, values, low, high) -> int:
+        return sum(end - start for start, end in self.spans(field, values, low, high))
+
+    def matching_rows(self, query: Optional[Dict[str, Any]] = None) -> np.ndarray:
+        """
+        Sorted row numbers matching a filter.
+        """
+        conditions = self.conditions(query or {})
+        if not conditions:
+            return np.arange(len(self), dtype=np.int32)
+
+        # Start from the most selective condition, check the rest on its rows
+        conditions.sort(key=lambda condition: self.condition_size(*condition))
+        rows = self.candidate_rows(*conditions[0])
+        for field, values, low, high in conditions[1:]:
+            if not len(rows):
+                break
+
+            column = self.columns[field][rows]
+            if values is not None:
+                rows = rows[np.isin(column, values)]
+            elif low == high:
+                rows = rows[column == low]
+            else:
+                matches = np.ones(len(rows), dtype=bool)
+                if low is not None:
+                    matches &= column >= low
+                if high is not None:
+                    matches &= column <= high
+                rows = rows[matches]
+
+        return np.sort(rows)
+
+    def find(
+        self,
+        query: Optional[Dict[str, Any]] = None,
+        limit: Optional[int] = None,
+        skip: int = 0,
+    ) -> List[Dict[str, Any]]:
+        """
+        Clues matching a filter, in _id order.
+        """
+        rows = self.matching_rows(query)[skip:]
+        if limit is not None:
+            rows = rows[:limit]
+
+        return self.take(rows)
+
+    def count(self, query: Optional[Dict[str, Any]] = None) -> int:
+        conditions = self.conditions(query or {})
+        if len(conditions) == 1:
+            return int(self.condition_size(*conditions[0]))
+        return len(self.matching_rows(query))
+
+    def sample(
+        self,
+        n: int = 1,
+        query: Optional[Dict[str, Any]] = None,
+        rng: Optional[np.random.Generator] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        n random clues matching a filter, without replacement.
+        """
+        rng = rng or np.random.default_rng()
+
+        if not query:
+            rows = rng.choice(len(self), size=min(n, len(self)), replace=False)
+        else:
+            rows = self.matching_rows(query)
+            rows = rng.choice(rows, size=min(n, len(rows)), replace=False)
+
+        return self.take(rows)
+
+    def game(self, game_id) -> List[Dict[str, Any]]:
+        """
+        Every clue of a game, in board order: round, category, then difficulty.
+        """
+        return self.find({"gameId": game_id})
+
+    @classmethod
+    def from_mongo(
+        cls,
+        mongo_conn_str: str,
+        database_name: str = "cluebase",
+        batch_size: int = 10_000,
+        logger=file_logger,
+    ) -> "ClueStore":
+        mongo_client = MongoClient(mongo_conn_str)
+        db = mongo_client.get_database(database_name)
+
+        logger.info(f"Loading clues from {database_name}.clues")
+        clues = list(db.clues.find({}, MONGO_PROJECTION, batch_size=batch_size))
+        store = cls(clues)
+        logger.info(f"Loaded {len(store)} clues into {store.nbytes / 1e6:.1f} MB")
+
+        return store
+
+    @classmethod
+    def from_export(cls, path: str, logger=file_logger) -> "ClueStore":
+        """
+        Load a `mongoexport` of the clues collection, one extended JSON doc per line.
+        """
+        logger.info(f"Loading clues from {path}")
+        with open(path, "r") as f:
+            clues = [json_util.loads(line) for line in f if line.strip()]
+        store = cls(clues)
+        logger.info(f"Loaded {len(store)} clues into {store.nbytes / 1e6:.1f} MB")
+
+        return store
@@ -0,0 +1,273 @@
+"""
+Read-through local disk cache for S3 objects.
+
+Each cached object is one file, named by a hash of its bucket and key, holding the
+object's ETag on the first line followed by its bytes. A read is served from disk
+without touching S3 when the ETag is already known from a listing (ls_s3 and
+ls_s3_prefix remember them), and otherwise with a conditional GET that only
+transfers the body if the object changed.
+
+Files are written to a temp file and renamed into place, and eviction holds an
+flock, so processes on one host can share a cache directory. Hits bump the file's
+mtime and eviction removes the least recently used files once the directory grows
+past its byte budget. The budget is enforced approximately: each process counts its
+own writes on top of the size it saw when it opened the cache.
+
+    CLUEBASE_S3_CACHE_DIR        cache directory (default ~/.cache/cluebase/s3)
+    CLUEBASE_S3_CACHE_MAX_BYTES  byte budget (default 2 GiB), 0 disables the cache
+"""
+
+import fcntl
+import hashlib
+import os
+import threading
+import time
+import uuid
+from functools import cache
+from logging import getLogger
+
+from botocore.exceptions import ClientError
+from prefect_aws import S3Bucket
+
+from src.metrics import timed
+
+file_logger = getLogger(__name__)
+
+CACHE_DIR_ENV = "CLUEBASE_S3_CACHE_DIR"
+MAX_BYTES_ENV = "CLUEBASE_S3_CACHE_MAX_BYTES"
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cluebase", "s3")
+DEFAULT_MAX_BYTES = 2 * 1024**3
+# Evict down to this fraction of the budget, so eviction doesn't run on every write
+EVICT_TO = 0.9
+# Temp files this old are left over from a crashed write
+STALE_TMP_SECONDS = 3600
+
+# (bucket, key) -> ETag, from listings
+listed_etags = {}
+
+
+def remember_etags(bucket_name, s3_objects):
+    for s3_object in s3_objects:
+        if "ETag" in s3_object:
+            listed_etags[(bucket_name, s3_object["Key"])] = s3_object["ETag"].strip('"')
+
+
+class S3ObjectCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock_path = os.path.join(cache_dir, ".lock")
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.approx_bytes = sum(size for _mtime, size, _path in self.entries())
+
+    def path(self, bucket_name, key):
+        name = hashlib.sha256(f"{bucket_name}/{key}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, name[:2], name)
+
+    def entries(self):
+        """
+        (mtime, size, path) of every cached object, removing stale temp files.
+        """
+        entries = []
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                if entry.name.endswith(".tmp"):
+                    if time.time() - stat.st_mtime > STALE_TMP_SECONDS:
+                        remove_if_exists(entry.path)
+                    continue
+
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        return entries
+
+    def get(self, bucket_name, key, etag=None):
+        """
+        Cached (etag, bytes) of an object, or None. With an etag, only a cached copy
+        of that version is returned.
+        """
+        path = self.path(bucket_name, key)
+        try:
+            with open(path, "rb") as f:
+                cached_etag = f.readline().rstrip(b"\n").decode("utf-8")
+                if etag is not None and cached_etag != etag:
+                    return None
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # Not cached, or evicted by another process
+            return None
+
+        return cached_etag, data
+
+    def cached_etag(self, bucket_name, key):
+        try:
+            with open(self.path(bucket_name, key), "rb") as f:
+                return f.readline().rstrip(b"\n").decode("utf-8")
+        except FileNotFoundError:
+            return None
+
+    def put(self, bucket_name, key, etag, data):
+        path = self.path(bucket_name, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(f"{etag}\n".encode("utf-8"))
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.approx_bytes += len(data)
+            over_budget = self.approx_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def evict(self, logger=file_logger):
+        with open(self.lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another process is already evicting
+                return
+
+            entries = sorted(self.entries())
+            total = sum(size for _mtime, size, _path in entries)
+            target = self.max_bytes * EVICT_TO
+
+            evicted = 0
+            for _mtime, size, path in entries:
+                if total <= target:
+                    break
+                remove_if_exists(path)
+                total -= size
+                evicted += 1
+
+            with self.lock:
+                self.approx_bytes = total
+            logger.info(
+                f"Evicted {evicted} objects from the S3 cache, {total} bytes left"
+            )
+
+    def read(self, bucket: S3Bucket, path: str) -> bytes:
+        """
+        Object contents, from disk when the cached copy is current.
+        """
+        key = bucket._resolve_path(path)
+        bucket_name = bucket.bucket_name
+
+        listed_etag = listed_etags.get((bucket_name, key))
+        if listed_etag is not None:
+            with timed("s3_cache_read", items=1):
+                cached = self.get(bucket_name, key, listed_etag)
+            if cached is not None:
+                return cached[1]
+
+        client = bucket.credentials.get_s3_client()
+        cached_etag = self.cached_etag(bucket_name, key)
+        if cached_etag is not None:
+            try:
+                response = client.get_object(
+                    Bucket=bucket_name, Key=key, IfNoneMatch=f'"{cached_etag}"'
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in ("304", "NotModified"):
+                    raise
+
+                with timed("s3_cache_read", items=1):
+                    cached = self.get(bucket_name, key, cached_etag)
+                if cached is not None:
+                    return cached[1]
+
+                # Evicted since the conditional GET, fetch it again
+                response = client.get_object(Bucket=bucket_name, Key=key)
+        else:
+            response = client.get_object(Bucket=bucket_name, Key=key)
+
+        data = response["Body"].read()
+        self.put(bucket_name, key, response["ETag"].strip('"'), data)
+
+        return data
+
+    async def read_async(self, s3, bucket_name: str, key: str) -> bytes:
+        """
+        `read` through an AsyncS3 client. The cache files are small local reads and
+        writes, so they stay on the event loop.
+        """
+        listed_etag = listed_etags.get((bucket_name, key))
+        if listed_etag is not None:
+            with timed("s3_cache_read", items=1):
+                cached = self.get(bucket_name, key, listed_etag)
+            if cached is not None:
+                return cached[1]
+
+        cached_etag = self.cached_etag(bucket_name, key)
+        if cached_etag is not None:
+            try:
+                etag, data = await s3.get_object(
+                    bucket_name, key, IfNoneMatch=f'"{cached_etag}"'
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in ("304", "NotModified"):
+                    raise
+
+                with timed("s3_cache_read", items=1):
+                    cached = self.get(bucket_name, key, cached_etag)
+                if cached is not None:
+                    return cached[1]
+
+                # Evicted since the conditional GET, fetch it again
+                etag, data = await s3.get_object(bucket_name, key)
+        else:
+            etag, data = await s3.get_object(bucket_name, key)
+
+        self.put(bucket_name, key, etag, data)
+
+        return data
+
+
+def remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+@cache
+def get_s3_object_cache():
+    """
+    The configured cache, or None if it's disabled.
+    """
+    max_bytes = int(os.environ.get(MAX_BYTES_ENV, DEFAULT_MAX_BYTES))
+    if max_bytes <= 0:
+        return None
+
+    return S3ObjectCache(os.environ.get(CACHE_DIR_ENV, DEFAULT_CACHE_DIR), max_bytes)
+
+
+def read_s3_object_cached(bucket: S3Bucket, path: str) -> bytes:
+    s3_cache = get_s3_object_cache()
+    if s3_cache is None:
+        return bucket.read_path(path, _sync=True)
+
+    return s3_cache.read(bucket, path)
+
+
+async def read_s3_object_cached_async(s3, bucket: S3Bucket, path: str) -> bytes:
+    key = bucket._resolve_path(path)
+
+    s3_cache = get_s3_object_cache()
+    if s3_cache is None:
+        _etag, data = await s3.get_object(bucket.bucket_name, key)
+        return data
+
+    return await s3_cache.read_async(s3, bucket.bucket_name, key)
@@ -4,7 +4,13 @@ from typing import List
 
 from bs4 import BeautifulSoup
 
-from src.io_utils import download_html, download_html_to_s3, ls_s3, read_s3_object
+from src.io_utils import (
+    download_html,
+    download_html_to_s3,
+    fetch_html_to_s3,
+    ls_s3,
+    read_s3_object,
+)
 from src.paths import (
     RAW_DIR,
     RAW_GAMES_DIR,
@@ -197,3 +203,19 @@ def download_game_page_to_s3(
         overwrite=overwrite,
         logger=logger,
     )
+
+
+def fetch_game_page_to_s3(
+    game_id, bucket, target_dir=RAW_GAMES_DIR, logger=file_logger
+):
+    """
+    Download Game page to s3 bucket, returning (html, written path) like
+    `fetch_html_to_s3`.
+    """
+
+    return fetch_html_to_s3(
+        f"{BASE_URL}{GAME}{game_id}",
+        bucket,
+        os.path.join(target_dir, f"{game_id}.html"),
+        logger=logger,
+    )
@@ -0,0 +1,166 @@
+import random
+from collections import Counter
+
+import numpy as np
+import pytest
+from prefect.testing.utilities import prefect_test_harness
+from prefect_aws import AwsCredentials
+
+WORDS = [f"word{i}" for i in range(60)]
+
+
+@pytest.fixture(scope="module")
+def text_index():
+    # src.io_utils loads the S3 credentials block on import
+    with prefect_test_harness():
+        AwsCredentials().save("cluebase-credentials", overwrite=True)
+        from src import text_index
+
+        yield text_index
+
+
+def random_clue(rng, clue_id):
+    # Skewed towards the first words, so terms have a range of frequencies
+    words = [WORDS[int(rng.paretovariate(1.2)) % len(WORDS)] for _ in range(12)]
+    return {
+        "_id": clue_id,
+        "clueText": " ".join(words[: rng.randint(1, 9)]),
+        "solution": " ".join(words[9 : rng.randint(9, 12)]),
+        "category": rng.choice(["science", "history", "word play"]),
+    }
+
+
+def random_segments(text_index, rng, n_segments=5, clues_per_segment=80):
+    """
+    Segments that re-index and delete some of their earlier segments' clues.
+    Returns them with the latest version of each clue that isn't deleted.
+    """
+    segments = []
+    latest = {}
+    for segment_number in range(n_segments):
+        clues = [
+            random_clue(rng, f"{rng.randrange(300):06}")
+            for _ in range(clues_per_segment)
+        ]
+        deleted_ids = rng.sample(sorted(latest), min(len(latest), 5))
+        for clue_id in deleted_ids:
+            del latest[clue_id]
+        latest.update((clue["_id"], clue) for clue in clues)
+        segments.append(
+            text_index.Segment.from_clues(
+                clues, name=f"{segment_number}.npz", deleted_ids=deleted_ids
+            )
+        )
+    return segments, list(latest.values())
+
+
+def brute_force_bm25(text_index, clues, query):
+    documents = {clue["_id"]: Counter(text_index.clue_tokens(clue)) for clue in clues}
+    avg_length = sum(sum(tokens.values()) for tokens in documents.values()) / len(
+        documents
+    )
+
+    scores = {}
+    for term in dict.fromkeys(text_index.tokenize(query)):
+        df = sum(term in tokens for tokens in documents.values())
+        idf = np.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+        for clue_id, tokens in documents.items():
+            if term not in tokens:
+                continue
+            length_norm = text_index.BM25_K1 * (
+                1
+                - text_index.BM25_B
+                + text_index.BM25_B * sum(tokens.values()) / avg_length
+            )
+            scores[clue_id] = scores.get(clue_id, 0) + idf * tokens[term] * (
+                text_index.BM25_K1 + 1
+            ) / (tokens[term] + length_norm)
+
+    return sorted(scores.items(), key=lambda result: (-result[1], result[0]))
+
+
+def assert_same_results(results, expected_results, k=10):
+    """
+    results are the top k of the expected results. Clues tied at the cut can be
+    either, so each result's score is looked up in all of them.
+    """
+    assert [score for _, score in results] == pytest.approx(
+        [score for _, score in expected_results[:k]]
+    )
+    expected_scores = dict(expected_results)
+    for clue_id, score in results:
+        assert score == pytest.approx(expected_scores.get(clue_id, -1))
+
+
+def test_varints_round_trip(text_index):
+    rng = np.random.default_rng(0)
+    values = np.concatenate(
+        [
+            rng.integers(0, 2**7, 500),
+            rng.integers(2**7, 2**14, 500),
+            rng.integers(2**14, 2**35, 500),
+            [0, 127, 128, 16383, 16384, 2**63 - 1],
+        ]
+    )
+    rng.shuffle(values)
+
+    encoded = text_index.encode_varints(values)
+
+    assert encoded.dtype == np.uint8
+    assert len(encoded) == text_index.varint_lengths(values.astype(np.uint64)).sum()
+    assert np.array_equal(text_index.decode_varints(encoded), values)
+
+
+def test_postings_round_trip(text_index):
+    rng = np.random.default_rng(1)
+    # Gaps up to several varint bytes wide
+    gaps = rng.integers(1, 2**21, 1000)
+    frequencies = rng.integers(1, 300, 1000)
+    interleaved = np.empty(2 * len(gaps), dtype=np.int64)
+    interleaved[0::2] = gaps
+    interleaved[1::2] = frequencies
+
+    docs, decoded_frequencies = text_index.decode_postings(
+        text_index.encode_varints(interleaved)
+    )
+
+    assert np.array_equal(docs, np.cumsum(gaps))
+    assert np.array_equal(decoded_frequencies, frequencies)
+
+
+def test_search_matches_brute_force_bm25(text_index):
+    rng = random.Random(2)
+    segments, clues = random_segments(text_index, rng)
+    index = text_index.TextIndex(segments)
+
+    assert len(index) == len(clues)
+    for _ in range(50):
+        query = " ".join(rng.sample(WORDS[:20], rng.randint(1, 3)))
+        assert_same_results(
+            index.search(query, k=10), brute_force_bm25(text_index, clues, query)
+        )
+
+
+def test_merged_segments_match_unmerged(text_index):
+    rng = random.Random(3)
+    segments, clues = random_segments(text_index, rng)
+    index = text_index.TextIndex(segments)
+    merged = text_index.TextIndex([text_index.merge_segments(segments)])
+
+    assert len(merged.segments[0]) == len(clues)
+    for _ in range(50):
+        query = " ".join(rng.sample(WORDS[:20], rng.randint(1, 3)))
+        assert_same_results(
+            merged.search(query, k=10), index.search(query, k=len(index))
+        )
+
+
+def test_superseded_documents_dont_match(text_index):
+    index = text_index.TextIndex()
+    index.add([{"_id": "a", "clueText": "zebra"}, {"_id": "b", "clueText": "zebra"}])
+    index.add([{"_id": "a", "clueText": "lion"}])
+    index.add_segment(text_index.Segment.from_clues([], deleted_ids=["b"]))
+
+    assert index.search("zebra") == []
+    assert [clue_id for clue_id, _ in index.search("lion")] == ["a"]
+    assert len(index) == 1
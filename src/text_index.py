@@ -0,0 +1,589 @@
+"""
+Keyword search over clue text, solutions and categories.
+
+An inverted index ranked with BM25, made of immutable segments. Each load flow
+writes the clues it inserted as a new segment to S3 under a unique name, so
+concurrent loads never write the same object; the compact_text_index flow merges
+the segments back into one. A search ranks each segment with corpus-wide term
+statistics and merges the results.
+
+Segments are ordered by name, oldest first. A clue indexed again, or deleted, in a
+later segment is superseded in the earlier ones: loading the index masks its
+documents there, so searches and merges only see a clue's latest document, and a
+deleted clue's tombstone hides it until compaction drops both.
+
+Within a segment, each term's postings are the gaps between its sorted document
+numbers interleaved with the term frequencies, as LEB128 varints, so most postings
+take two bytes. Encoding and decoding are vectorized with numpy. A segment is one
+.npz file:
+
+    doc_ids          clue _id of each document, as bytes
+    doc_lengths      tokens per document
+    terms            sorted vocabulary
+    offsets          start of each term's postings in postings, plus the end
+    postings         uint8 varints
+    deleted_ids      tombstones, clue _ids deleted as of this segment, if any
+"""
+
+import os
+import re
+import unicodedata
+import uuid
+from datetime import datetime
+from io import BytesIO
+from logging import getLogger
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from prefect_aws import S3Bucket
+
+from src.io_utils import download_object_if_changed
+
+file_logger = getLogger(__name__)
+
+TEXT_INDEX_DIR = "text_index"
+TEXT_INDEX_S3_PREFIX = "indexes/text"
+INDEXED_FIELDS = ("clueText", "solution", "category")
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_REGEX = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has he her his in is it its of on or she "
+    "that the this to was were with".split()
+)
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """
+    Lowercase alphanumeric tokens, with accents removed and stopwords dropped.
+    """
+    if not text:
+        return []
+
+    text = text.lower()
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(char for char in text if not unicodedata.combining(char))
+    return [token for token in TOKEN_REGEX.findall(text) if token not in STOPWORDS]
+
+
+def clue_tokens(clue) -> List[str]:
+    return [token for field in INDEXED_FIELDS for token in tokenize(clue.get(field))]
+
+
+def varint_lengths(values: np.ndarray) -> np.ndarray:
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        n_bytes += values >= np.uint64(1 << shift)
+    return n_bytes
+
+
+def encode_varints(values: np.ndarray) -> np.ndarray:
+    """
+    LEB128: 7 bits per byte, low bits first, high bit set on all but the last byte.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    if not len(values):
+        return np.empty(0, dtype=np.uint8)
+
+    n_bytes = varint_lengths(values)
+    ends = np.cumsum(n_bytes)
+    starts = ends - n_bytes
+
+    encoded = np.empty(ends[-1], dtype=np.uint8)
+    for i in range(int(n_bytes.max())):
+        has_byte = n_bytes > i
+        low_bits = (values[has_byte] >> np.uint64(7 * i)) & np.uint64(0x7F)
+        continues = (n_bytes[has_byte] > i + 1).astype(np.uint64) << np.uint64(7)
+        encoded[starts[has_byte] + i] = low_bits | continues
+
+    return encoded
+
+
+def decode_varints(encoded: np.ndarray) -> np.ndarray:
+    if not len(encoded) or encoded.max() < 0x80:
+        # Every varint is one byte, as for the postings of common terms
+        return encoded.astype(np.int64)
+
+    low_bits = (encoded & 0x7F).astype(np.int64)
+    ends = np.flatnonzero(encoded < 0x80)
+
+    starts = np.empty(len(ends), dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+
+    values = low_bits[starts]
+    for i in range(1, int(lengths.max())):
+        longer = np.flatnonzero(lengths > i)
+        values[longer] |= low_bits[starts[longer] + i] << (7 * i)
+
+    return values
+
+
+def decode_postings(encoded: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    values = decode_varints(encoded)
+    return np.cumsum(values[0::2]), values[1::2]
+
+
+class Segment:
+    def __init__(
+        self,
+        doc_ids,
+        doc_lengths,
+        terms,
+        offsets,
+        postings,
+        name=None,
+        deleted_ids=(),
+    ):
+        self.name = name
+        # Clue _ids are ASCII, bytes take a quarter of numpy's UTF-32 strings
+        self.doc_ids = np.asarray(doc_ids, dtype=bytes)
+        self.doc_lengths = np.asarray(doc_lengths, dtype=np.int32)
+        self.terms = np.asarray(terms, dtype=str)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.postings = np.asarray(postings, dtype=np.uint8)
+        self.deleted_ids = np.asarray(deleted_ids, dtype=bytes)
+        self.term_numbers = {term: i for i, term in enumerate(self.terms.tolist())}
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    @classmethod
+    def from_arrays(
+        cls,
+        doc_ids: List[str],
+        doc_lengths: List[int],
+        terms: List[str],
+        posting_terms: np.ndarray,
+        posting_docs: np.ndarray,
+        frequencies: np.ndarray,
+        name=None,
+        deleted_ids=(),
+    ) -> "Segment":
+        """
+        Build a segment from its postings as (term number, doc number, frequency)
+        arrays, sorted by term number then doc number. terms must be sorted.
+        """
+        term_starts = np.flatnonzero(np.diff(posting_terms, prepend=-1))
+
+        gaps = np.diff(posting_docs, prepend=0)
+        gaps[term_starts] = posting_docs[term_starts]
+        interleaved = np.empty(2 * len(gaps), dtype=np.uint64)
+        interleaved[0::2] = gaps
+        interleaved[1::2] = frequencies
+
+        # Every term has postings, so each term's offset is where its first starts
+        value_lengths = varint_lengths(interleaved)
+        value_starts = np.cumsum(value_lengths) - value_lengths
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[posting_terms[term_starts]] = value_starts[2 * term_starts]
+        offsets[-1] = value_lengths.sum()
+
+        return cls(
+            doc_ids,
+            doc_lengths,
+            terms,
+            offsets,
+            encode_varints(interleaved),
+            name,
+            deleted_ids,
+        )
+
+    @classmethod
+    def from_postings(
+        cls,
+        doc_ids: List[str],
+        doc_lengths: List[int],
+        postings_by_term: Dict[str, Tuple[np.ndarray, np.ndarray]],
+        name=None,
+        deleted_ids=(),
+    ) -> "Segment":
+        """
+        Build a segment from each term's (sorted doc numbers, term frequencies).
+        """
+        terms = sorted(postings_by_term)
+        sizes = [len(postings_by_term[term][0]) for term in terms]
+        return cls.from_arrays(
+            doc_ids,
+            doc_lengths,
+            terms,
+            np.repeat(np.arange(len(terms)), sizes),
+            np.concatenate([postings_by_term[term][0] for term in terms] or [[]]),
+            np.concatenate([postings_by_term[term][1] for term in terms] or [[]]),
+            name,
+            deleted_ids,
+        )
+
+    @classmethod
+    def from_clues(cls, clues: Iterable[dict], name=None, deleted_ids=()) -> "Segment":
+        doc_ids = []
+        doc_lengths = []
+        term_numbers = {}
+        token_terms = []
+        for clue in clues:
+            tokens = clue_tokens(clue)
+            doc_ids.append(clue["_id"])
+            doc_lengths.append(len(tokens))
+            token_terms += [
+                term_numbers.setdefault(token, len(term_numbers)) for token in tokens
+            ]
+
+        # Renumber the terms alphabetically, then count each (term, doc) pair
+        terms = sorted(term_numbers)
+        ranks = np.empty(len(terms), dtype=np.int64)
+        ranks[[term_numbers[term] for term in terms]] = np.arange(len(terms))
+        token_docs = np.repeat(np.arange(len(doc_ids)), doc_lengths)
+        pairs, frequencies = np.unique(
+            ranks[np.array(token_terms, dtype=np.int64)] * len(doc_ids) + token_docs,
+            return_counts=True,
+        )
+
+        return cls.from_arrays(
+            doc_ids,
+            doc_lengths,
+            terms,
+            pairs // len(doc_ids),
+            pairs % len(doc_ids),
+            frequencies,
+            name,
+            deleted_ids,
+        )
+
+    def term_postings(self, term) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        term_number = self.term_numbers.get(term)
+        if term_number is None:
+            return None
+
+        start, end = self.offsets[term_number], self.offsets[term_number + 1]
+        return decode_postings(self.postings[start:end])
+
+    def to_bytes(self) -> bytes:
+        arrays = {
+            "doc_ids": self.doc_ids,
+            "doc_lengths": self.doc_lengths,
+            "terms": self.terms,
+            "offsets": self.offsets,
+            "postings": self.postings,
+        }
+        if len(self.deleted_ids):
+            arrays["deleted_ids"] = self.deleted_ids
+
+        f = BytesIO()
+        np.savez(f, **arrays)
+        return f.getvalue()
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.to_bytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path) -> "Segment":
+        with np.load(path) as arrays:
+            return cls(
+                arrays["doc_ids"],
+                arrays["doc_lengths"],
+                arrays["terms"],
+                arrays["offsets"],
+                arrays["postings"],
+                name=os.path.basename(path),
+                deleted_ids=arrays["deleted_ids"] if "deleted_ids" in arrays else (),
+            )
+
+
+def new_segment_name() -> str:
+    # Sorts by creation time, so later segments win when a clue is indexed twice
+    return f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:8]}.npz"
+
+
+def merge_segments(
+    segments: List[Segment], name=None, deleted_ids: Iterable[str] = ()
+) -> Segment:
+    """
+    One segment with the documents of the segments that aren't superseded, in
+    order, so each clue keeps only its latest document. Clues deleted by a
+    tombstone, or in deleted_ids, are dropped with their tombstones.
+    """
+    deleted_ids = [str(clue_id) for clue_id in deleted_ids]
+    tombstones = Segment([], [], [], [0], [], deleted_ids=deleted_ids)
+    index = TextIndex(segments + [tombstones] if deleted_ids else segments)
+
+    # Old doc number -> merged doc number, or -1 if superseded
+    doc_maps = []
+    doc_ids = []
+    doc_lengths = []
+    for segment, live in zip(segments, index.live):
+        keep = np.ones(len(segment), dtype=bool) if live is None else live
+        doc_map = np.full(len(segment), -1, dtype=np.int64)
+        doc_map[keep] = np.arange(len(doc_ids), len(doc_ids) + keep.sum())
+        doc_maps.append(doc_map)
+        doc_ids += segment.doc_ids[keep].tolist()
+        doc_lengths += segment.doc_lengths[keep].tolist()
+
+    postings_by_term = {}
+    for term in sorted(set().union(*(segment.term_numbers for segment in segments))):
+        docs = []
+        frequencies = []
+        for segment, doc_map in zip(segments, doc_maps):
+            postings = segment.term_postings(term)
+            if postings is None:
+                continue
+            merged_docs = doc_map[postings[0]]
+            kept = merged_docs >= 0
+            docs.append(merged_docs[kept])
+            frequencies.append(postings[1][kept])
+
+        docs = np.concatenate(docs)
+        if len(docs):
+            postings_by_term[term] = (docs, np.concatenate(frequencies))
+
+    return Segment.from_postings(doc_ids, doc_lengths, postings_by_term, name)
+
+
+class TextIndex:
+    def __init__(self, segments: Optional[List[Segment]] = None):
+        self.segments = []
+        # Per segment, which documents aren't superseded, or None if all of them
+        self.live = []
+        # Clue _id -> (segment number, doc number) of its latest document
+        self.latest = {}
+        self.n_docs = 0
+        self.total_length = 0
+        for segment in segments or []:
+            self.add_segment(segment)
+
+    def add_segment(self, segment: Segment):
+        """
+        Add a segment newer than the others, superseding the earlier documents of
+        its clues and of its tombstones.
+        """
+        segment_number = len(self.segments)
+        self.segments.append(segment)
+        self.live.append(None)
+
+        for doc_id in segment.deleted_ids.tolist():
+            self._supersede(doc_id)
+        for doc_number, doc_id in enumerate(segment.doc_ids.tolist()):
+            self._supersede(doc_id)
+            self.latest[doc_id] = (segment_number, doc_number)
+
+        self.n_docs += len(segment)
+        self.total_length += int(segment.doc_lengths.sum())
+
+    def _supersede(self, doc_id: bytes):
+        location = self.latest.pop(doc_id, None)
+        if location is None:
+            return
+
+        segment_number, doc_number = location
+        segment = self.segments[segment_number]
+        if self.live[segment_number] is None:
+            self.live[segment_number] = np.ones(len(segment), dtype=bool)
+        self.live[segment_number][doc_number] = False
+        self.n_docs -= 1
+        self.total_length -= int(segment.doc_lengths[doc_number])
+
+    def add(self, clues: Iterable[dict]) -> Segment:
+        segment = Segment.from_clues(clues, name=new_segment_name())
+        self.add_segment(segment)
+        return segment
+
+    def __len__(self):
+        return self.n_docs
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        """
+        The k best (clue _id, BM25 score) matches for any of the query's terms.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.n_docs:
+            return []
+
+        avg_length = self.total_length / self.n_docs
+        postings = [
+            [self._live_postings(segment_number, term) for term in terms]
+            for segment_number in range(len(self.segments))
+        ]
+        document_frequencies = [
+            sum(0 if p is None else len(p[0]) for p in term_postings)
+            for term_postings in zip(*postings)
+        ]
+        idfs = [
+            np.log(1 + (self.n_docs - df + 0.5) / (df + 0.5))
+            for df in document_frequencies
+        ]
+
+        results = []
+        for segment, segment_postings in zip(self.segments, postings):
+            docs = []
+            weights = []
+            for idf, term_postings in zip(idfs, segment_postings):
+                if term_postings is None:
+                    continue
+                term_docs, frequencies = term_postings
+                length_norm = BM25_K1 * (
+                    1 - BM25_B + BM25_B * segment.doc_lengths[term_docs] / avg_length
+                )
+                docs.append(term_docs)
+                weights.append(
+                    idf * frequencies * (BM25_K1 + 1) / (frequencies + length_norm)
+                )
+            if not docs:
+                continue
+
+            if len(docs) == 1:
+                # One term's postings are already one score per document
+                matches, scores = docs[0], weights[0]
+            elif sum(len(term_docs) for term_docs in docs) < len(segment) // 16:
+                # Few postings, sum them without a score for every document
+                matches, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+                scores = np.bincount(inverse, np.concatenate(weights))
+            else:
+                scores = np.bincount(np.concatenate(docs), np.concatenate(weights))
+                matches = np.flatnonzero(scores)
+                scores = scores[matches]
+            if len(matches) > k:
+                # Ties with the kth score too, so the cut doesn't depend on how
+                # the clues are split into segments
+                kth_score = np.partition(scores, len(scores) - k)[len(scores) - k]
+                top = scores >= kth_score
+                matches, scores = matches[top], scores[top]
+            results += zip(
+                segment.doc_ids[matches].astype(str).tolist(), scores.tolist()
+            )
+
+        # Superseded documents were masked, so each clue is in at most one segment.
+        # Ties go to the smaller _id
+        return sorted(results, key=lambda result: (-result[1], result[0]))[:k]
+
+    def _live_postings(
+        self, segment_number: int, term: str
+    ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        postings = self.segments[segment_number].term_postings(term)
+        live = self.live[segment_number]
+        if postings is None or live is None:
+            return postings
+
+        docs, frequencies = postings
+        kept = live[docs]
+        if not kept.any():
+            return None
+        return docs[kept], frequencies[kept]
+
+    @classmethod
+    def load(cls, index_dir=TEXT_INDEX_DIR) -> "TextIndex":
+        if not os.path.isdir(index_dir):
+            return cls()
+
+        return cls(
+            [
+                Segment.load(os.path.join(index_dir, filename))
+                for filename in sorted(os.listdir(index_dir))
+                if filename.endswith(".npz")
+            ]
+        )
+
+
+# *****************************************************
+# S3 persistence
+# *****************************************************
+
+
+def list_text_index_segments(
+    bucket: S3Bucket, s3_prefix=TEXT_INDEX_S3_PREFIX
+) -> List[str]:
+    return sorted(
+        os.path.basename(s3_object["Key"])
+        for s3_object in bucket.list_objects(s3_prefix, _sync=True)
+        if s3_object["Key"].endswith(".npz")
+    )
+
+
+def upload_text_index_segment(
+    bucket: S3Bucket, segment: Segment, s3_prefix=TEXT_INDEX_S3_PREFIX
+) -> str:
+    return bucket.upload_from_file_object(
+        BytesIO(segment.to_bytes()), f"{s3_prefix}/{segment.name}", _sync=True
+    )
+
+
+def loaded_clues(clues: List[dict], bulk_write_error=None) -> List[dict]:
+    """
+    The clues an unordered insert_many actually inserted.
+    """
+    if bulk_write_error is None:
+        return clues
+
+    failed = {
+        write_error["index"] for write_error in bulk_write_error.details["writeErrors"]
+    }
+    return [clue for i, clue in enumerate(clues) if i not in failed]
+
+
+def index_loaded_clues(
+    bucket: S3Bucket,
+    clues: List[dict],
+    bulk_write_error=None,
+    deleted_ids: Iterable[str] = (),
+    s3_prefix=TEXT_INDEX_S3_PREFIX,
+    logger=file_logger,
+) -> Optional[str]:
+    """
+    Write the clues an insert_many loaded as a new segment, with tombstones for
+    deleted_ids. A failed index write is logged rather than failing the load,
+    compact_text_index drops the clues deleted since, or can rebuild.
+    """
+    clues = loaded_clues(clues, bulk_write_error)
+    deleted_ids = list(deleted_ids)
+    if not clues and not deleted_ids:
+        return None
+
+    try:
+        segment = Segment.from_clues(
+            clues, name=new_segment_name(), deleted_ids=deleted_ids
+        )
+        path = upload_text_index_segment(bucket, segment, s3_prefix)
+    except Exception as e:
+        logger.error(f"Failed to index {len(clues)} loaded clues: {e!r}")
+        return None
+
+    logger.info(f"Indexed {len(clues)} clues in {path}")
+    return path
+
+
+def download_text_index(
+    bucket: S3Bucket,
+    index_dir=TEXT_INDEX_DIR,
+    s3_prefix=TEXT_INDEX_S3_PREFIX,
+    logger=file_logger,
+) -> TextIndex:
+    """
+    Sync index_dir with the segments in S3, then load it. Segments are immutable,
+    so only new ones are downloaded.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    segment_names = list_text_index_segments(bucket, s3_prefix)
+
+    for filename in os.listdir(index_dir):
+        # Segments merged away by compaction, and their .etag sidecars
+        if filename.removesuffix(".etag") not in segment_names:
+            os.remove(os.path.join(index_dir, filename))
+
+    for segment_name in segment_names:
+        if os.path.exists(os.path.join(index_dir, segment_name)):
+            continue
+        download_object_if_changed(
+            bucket,
+            f"{s3_prefix}/{segment_name}",
+            os.path.join(index_dir, segment_name),
+            logger=logger,
+        )
+
+    index = TextIndex.load(index_dir)
+    logger.info(f"Loaded {len(index.segments)} segments, {len(index)} clues")
+    return index
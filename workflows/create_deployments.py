@@ -1,12 +1,21 @@
 from prefect import flow
+from prefect.client.orchestration import get_client
 from prefect.runner.storage import GitRepository
 from prefect_github import GitHubCredentials
 
 SOURCE_REPO = "https://github.com/lukelavin/jeop-db-2"
 
+# Task runs holding each tag at once, across every flow run and worker. The tags
+# are S3_TAG and MONGO_TAG of src/io_utils.py, which CI can't import to deploy
+TAG_CONCURRENCY_LIMITS = {"s3": 16, "mongo": 4}
+
 
 if __name__ == "__main__":
 
+    with get_client(sync_client=True) as client:
+        for tag, concurrency_limit in TAG_CONCURRENCY_LIMITS.items():
+            client.create_concurrency_limit(tag, concurrency_limit)
+
     github_repo = GitRepository(
         # configured token in github and then created github credentials block in prefect UI
         url=SOURCE_REPO,
@@ -39,6 +48,15 @@ if __name__ == "__main__":
         job_variables={"pip_packages": pip_packages},
     )
 
+    flow.from_source(
+        source=github_repo,
+        entrypoint="workflows/refresh_load_all.py:refresh_and_load_all",
+    ).deploy(
+        name="refresh-load-all-main",
+        work_pool_name="my-work-pool",
+        job_variables={"pip_packages": pip_packages},
+    )
+
     flow.from_source(
         source=github_repo,
         entrypoint="workflows/load_to_mongo/load_clues.py:load_clues_from_all_games_s3",
@@ -57,6 +75,34 @@ if __name__ == "__main__":
         job_variables={"pip_packages": pip_packages},
     )
 
+    flow.from_source(
+        source=github_repo,
+        entrypoint="workflows/load_to_mongo/load_clues_set.py:load_quarantined_games_s3",
+    ).deploy(
+        name="load-quarantined-games-main",
+        work_pool_name="my-work-pool",
+        job_variables={"pip_packages": pip_packages},
+    )
+
+    flow.from_source(
+        source=github_repo,
+        entrypoint="workflows/text_search.py:compact_text_index",
+    ).deploy(
+        name="compact-text-index-main",
+        work_pool_name="my-work-pool",
+        cron="0 4 * * *",
+        job_variables={"pip_packages": pip_packages},
+    )
+
+    flow.from_source(
+        source=github_repo,
+        entrypoint="workflows/dedup_clues.py:dedup_clues",
+    ).deploy(
+        name="dedup-clues-main",
+        work_pool_name="my-work-pool",
+        job_variables={"pip_packages": pip_packages},
+    )
+
     flow.from_source(
         source=github_repo,
         entrypoint="workflows/parse_load_latest_season.py:parse_and_load_latest_season",
@@ -76,6 +122,15 @@ if __name__ == "__main__":
         job_variables={"pip_packages": ml_pip_packages},
     )
 
+    flow.from_source(
+        source=github_repo,
+        entrypoint="workflows/ml_features/embed_clues.py:embed_clues",
+    ).deploy(
+        name="embed-clues-main",
+        work_pool_name="my-work-pool",
+        job_variables={"pip_packages": ml_pip_packages},
+    )
+
     flow.from_source(
         source=github_repo,
         entrypoint="workflows/ml_features/classify_domain.py:classify_domains",
@@ -0,0 +1,148 @@
+"""
+Flow linking near-duplicate clues with a shared duplicateGroup, see src/dedup.py.
+
+Each run only checks the clues updated since the index's watermark that aren't in
+it yet, against the whole index, so the nightly load only pays for its new games.
+Clues queued in
+clue_changes, because their text changed or they were deleted, are removed from
+the index first, and those still in Mongo are checked again as new.
+"""
+
+from datetime import timedelta
+from logging import getLogger
+
+from prefect import flow, task
+from prefect.blocks.system import Secret
+from prefect.logging import get_run_logger
+from pymongo import MongoClient, UpdateOne
+
+from src.dedup import (
+    DEDUP_INDEX_PATH,
+    DEDUP_INDEX_S3_PATH,
+    SignatureIndex,
+    download_signature_index,
+    upload_signature_index,
+)
+from src.io_utils import ack_clue_changes, get_s3_bucket, pending_clue_changes
+from src.metrics import publish_stage_metrics, timed
+
+file_logger = getLogger(__name__)
+
+# Clues read with one $in, and updates per bulk_write
+MONGO_BATCH_SIZE = 1000
+# This flow's name in clue_changes, see src/io_utils.py
+DEDUP_CONSUMER = "dedup"
+# A clue's updatedAt is when its page was parsed, a little before it's inserted,
+# so each run looks back this far before the watermark. Clues in the index are
+# skipped
+WATERMARK_LOOKBACK = timedelta(days=1)
+
+
+@flow
+@publish_stage_metrics
+def dedup_clues(
+    bucket_name="cluebase",
+    rebuild: bool = False,
+    mongo_secret_block="mongo-connection-string",
+    database_name="cluebase",
+):
+    """
+    Group the clues updated since the signature index's watermark that aren't in
+    it yet with their duplicates, and regroup the clues whose text changed or that
+    were deleted. rebuild starts from an empty index, and clears every
+    duplicateGroup first.
+    """
+    return dedup_new_clues(bucket_name, rebuild, mongo_secret_block, database_name)
+
+
+@task
+def dedup_new_clues(
+    bucket_name="cluebase",
+    rebuild=False,
+    mongo_secret_block="mongo-connection-string",
+    database_name="cluebase",
+    local_path=DEDUP_INDEX_PATH,
+    s3_path=DEDUP_INDEX_S3_PATH,
+):
+    logger = get_run_logger()
+    bucket = get_s3_bucket(bucket_name)
+
+    if rebuild:
+        index = SignatureIndex()
+    else:
+        index = download_signature_index(bucket, local_path, s3_path, logger=logger)
+
+    logger.info(f"Getting Mongo connection using secret block {mongo_secret_block}")
+    mongo_conn_str = Secret.load(mongo_secret_block).get()
+    mongo_client = MongoClient(mongo_conn_str)
+    db = mongo_client.get_database(database_name)
+
+    changes = pending_clue_changes(db, DEDUP_CONSUMER)
+    logger.info(f"Removing {len(changes)} changed or deleted clues")
+    with timed("dedup", items=len(changes)):
+        group_updates = index.remove(changes, logger=logger)
+
+    db.clues.create_index("updatedAt")
+    if index.watermark is None:
+        updated_filter = {}
+    else:
+        updated_filter = {"updatedAt": {"$gt": index.watermark - WATERMARK_LOOKBACK}}
+    updated = list(db.clues.find(updated_filter, {"updatedAt": 1}))
+    new_ids = [clue["_id"] for clue in updated if clue["_id"] not in index]
+    logger.info(
+        f"{len(new_ids)} of {len(updated)} clues updated since {index.watermark} "
+        "not checked for duplicates yet"
+    )
+    # Set on the index, so it's only saved with the clues it covers
+    latest = max(
+        (clue["updatedAt"] for clue in updated if clue.get("updatedAt")), default=None
+    )
+    if latest is not None and (index.watermark is None or latest > index.watermark):
+        index.watermark = latest
+    if not new_ids and not changes:
+        return 0
+
+    clues = []
+    for start in range(0, len(new_ids), MONGO_BATCH_SIZE):
+        clues += db.clues.find(
+            {"_id": {"$in": new_ids[start : start + MONGO_BATCH_SIZE]}},
+            {"clueText": 1, "solution": 1},
+        )
+
+    with timed("dedup", items=len(clues)):
+        group_updates.update(index.add(clues, logger=logger))
+
+    if rebuild:
+        result = db.clues.update_many(
+            {"duplicateGroup": {"$exists": True}}, {"$unset": {"duplicateGroup": ""}}
+        )
+        logger.info(f"Cleared duplicateGroup of {result.modified_count} clues")
+    write_duplicate_groups(db, group_updates, logger=logger)
+
+    # Only once Mongo has the groups, so clues whose write failed are checked again
+    logger.info(f"Uploading signatures of {len(index)} clues to {s3_path}")
+    upload_signature_index(bucket, index, s3_path)
+    ack_clue_changes(db, DEDUP_CONSUMER, changes)
+
+    return len(group_updates)
+
+
+def write_duplicate_groups(db, group_updates, logger=file_logger):
+    # None for clues left without duplicates
+    update_requests = [
+        UpdateOne(
+            {"_id": clue_id},
+            (
+                {"$set": {"duplicateGroup": group_id}}
+                if group_id is not None
+                else {"$unset": {"duplicateGroup": ""}}
+            ),
+        )
+        for clue_id, group_id in group_updates.items()
+    ]
+    logger.info(f"Setting duplicateGroup of {len(update_requests)} clues")
+
+    for start in range(0, len(update_requests), MONGO_BATCH_SIZE):
+        batch = update_requests[start : start + MONGO_BATCH_SIZE]
+        with timed("mongo_write", items=len(batch)):
+            db.clues.bulk_write(batch, ordered=False)
@@ -1,100 +1,62 @@
 import asyncio
-import itertools
-import os
 from logging import getLogger
+from typing import List
 
-import pymongo
 from prefect import flow, task
-from prefect.blocks.system import Secret
-from prefect.logging import get_logger, get_run_logger
+from prefect.logging import get_run_logger
+from prefect.task_runners import ThreadPoolTaskRunner
 
-from src.clues import parse_clues_from_game
-from src.io_utils import (
-    get_mongo_client,
-    get_s3_bucket,
-    insert_clue_bulk,
-    ls_s3_prefix,
-    read_s3_object_async,
-)
+from src.async_s3 import async_s3_client
+from src.io_utils import get_s3_bucket, ls_s3_prefix
+from src.metrics import publish_stage_metrics
 from src.paths import RAW_GAMES_DIR
+from workflows.load_to_mongo.load_clues_set import (
+    LOAD_CHUNK_SIZE,
+    LOAD_WORKERS,
+    load_game_chunks,
+)
 
 file_logger = getLogger(__name__)
 
 
-async def read_and_parse_clues(bucket, s3_path, logger=get_logger()):
-    game_html = await read_s3_object_async(bucket, s3_path)
-
-    game_id = s3_path.split("/")[-1].split(".")[0]
-    logger.debug(f"Loading clues from game: {game_id}")
-
-    return parse_clues_from_game(game_html, game_id)
-
-
 @task
-async def load_clues_batch_s3(
-    s3_bucket_name: str = "cluebase",
-    games_dir: str = RAW_GAMES_DIR,
-    game_file_prefix: str = "",
-    mongo_secret_block: str = "mongo-connection-string",
-    database_name: str = "cluebase",
-):
-    logger = get_run_logger()
-    logger.info(
-        f"Loading clues from s3:/{s3_bucket_name}/{games_dir}/{game_file_prefix}*"
-    )
-
+async def list_game_ids(
+    s3_bucket_name: str = "cluebase", games_dir: str = RAW_GAMES_DIR
+) -> List[str]:
     bucket = get_s3_bucket(s3_bucket_name)
-    game_paths = await ls_s3_prefix(bucket, games_dir, prefix=game_file_prefix)
-    logger.info(f"Found {len(game_paths)} games to load")
-
-    clue_lists = await asyncio.gather(
-        *[read_and_parse_clues(bucket, s3_path, logger) for s3_path in game_paths]
-    )
-
-    clues = list(itertools.chain.from_iterable(clue_lists))
-    logger.info(f"Clues parsed: {len(clues)}")
-
-    logger.info(f"Getting Mongo connection using secret block {mongo_secret_block}")
-    mongo_conn_str = (await Secret.load(mongo_secret_block)).get()
-    mongo_client = await get_mongo_client(mongo_conn_str)
-    db = mongo_client.get_database(database_name)
-
-    logger.info(f"Attempting to load clues into collection")
-    try:
-        loaded = await insert_clue_bulk(db, clues)
-        logger.info(
-            f"Loaded {len(loaded)} clues from s3:/{s3_bucket_name}/{games_dir}/{game_file_prefix}*"
-        )
-        logger.info(loaded)
-        return loaded
-    except pymongo.errors.BulkWriteError as e:
-        logger.info(
-            f"Loaded {e.details['nInserted']} clues from s3:/{s3_bucket_name}/{games_dir}/{game_file_prefix}*"
-        )
-        logger.warning(e)
-        return e.details["writeErrors"]
-
-
-@task
-async def load_all_game_files_batched_s3(
-    s3_bucket_name: str = "cluebase",
-    games_dir: str = RAW_GAMES_DIR,
-    mongo_secret_block: str = "mongo-connection-string",
+    async with async_s3_client(bucket.credentials):
+        game_paths = await ls_s3_prefix(bucket, games_dir)
+
+    return [
+        s3_path.split("/")[-1].split(".")[0]
+        for s3_path in game_paths
+        if s3_path.endswith(".html")
+    ]
+
+
+@flow(task_runner=ThreadPoolTaskRunner(max_workers=LOAD_WORKERS))
+@publish_stage_metrics
+def load_clues_from_all_games_s3(
+    s3_bucket_name="cluebase",
+    s3_games_path="raw/games",
+    mongo_secret_block="mongo-connection-string",
+    database_name="cluebase",
+    chunk_size: int = LOAD_CHUNK_SIZE,
 ):
+    """
+    Load every game in s3, as chunks mapped over tasks with their own retries.
+    """
     logger = get_run_logger()
-    logger.info("Loading clues batched from all game files")
-
-    batch_runs = []
-    for batch_prefix in range(1, 10):
-        batch_runs.append(
-            load_clues_batch_s3.submit(
-                s3_bucket_name, games_dir, str(batch_prefix), mongo_secret_block
-            )
-        )
-
-    results = [run.result() for run in batch_runs]
 
-
-@flow
-def load_clues_from_all_games_s3(s3_bucket_name="cluebase", s3_games_path="raw/games"):
-    asyncio.run(load_all_game_files_batched_s3(s3_bucket_name, s3_games_path))
+    game_ids = asyncio.run(list_game_ids(s3_bucket_name, s3_games_path))
+    logger.info(f"Found {len(game_ids)} games to load")
+
+    return load_game_chunks(
+        game_ids,
+        s3_bucket_name,
+        s3_games_path,
+        mongo_secret_block,
+        database_name,
+        chunk_size,
+        logger=logger,
+    )
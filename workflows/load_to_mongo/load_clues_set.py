@@ -1,85 +1,416 @@
 import asyncio
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import cache
 from logging import getLogger
-from typing import List
+from typing import Dict, List, Tuple
 
 import pymongo
-from prefect import flow, task
+from bson.raw_bson import RawBSONDocument
+from prefect import flow, task, unmapped
 from prefect.blocks.system import Secret
-from prefect.logging import get_logger, get_run_logger
+from prefect.logging import get_run_logger
+from prefect.task_runners import ThreadPoolTaskRunner
 
-from src.clues import parse_clues_from_game
+from src.async_s3 import async_s3_client
+from src.clues import parse_and_encode_games
 from src.io_utils import (
+    MONGO_TAG,
+    S3_TAG,
     get_mongo_client,
+    get_quarantined_game_ids,
     get_s3_bucket,
     insert_clue_bulk,
+    is_missing_object,
+    quarantine_game,
     read_s3_object_async,
+    release_quarantined_games,
+    replace_game_clues,
 )
+from src.memory import get_memory_budget, profile_memory
+from src.metrics import call_with_stage_metrics, publish_stage_metrics, stage_metrics
 from src.paths import RAW_GAMES_DIR
+from src.text_index import index_loaded_clues
 
 file_logger = getLogger(__name__)
 
+# Games per mapped task run. A chunk is retried as a whole, and holds a slot of
+# the s3 or mongo tag concurrency limit while it reads or inserts
+LOAD_CHUNK_SIZE = 25
+# Chunk tasks running at once in one flow run. The tag concurrency limits bound
+# them across every flow run and worker
+LOAD_WORKERS = 8
+CHUNK_RETRIES = 3
+CHUNK_RETRY_DELAY_SECONDS = 10
+# A game page while it's read and parsed, plus its clues until they're inserted.
+# Pages are ~100KB, the estimate leaves room for the parse and the insert buffers
+GAME_MEMORY_BYTES = 1024**2
 
-async def read_and_parse_clues(bucket, s3_path, logger=get_logger()):
-    game_html = await read_s3_object_async(bucket, s3_path)
 
-    game_id = s3_path.split("/")[-1].split(".")[0]
-    logger.debug(f"Loading clues from game: {game_id}")
+@cache
+def get_parse_pool() -> ProcessPoolExecutor:
+    """
+    Processes that parse game pages, one per CPU, shared by the process's chunk
+    tasks. Parsing holds the GIL, so the task runner's threads can't parse in
+    parallel. The processes import src.io_utils, so they need PREFECT_API_URL in
+    the environment, as flow runs started by a worker have.
+    """
+    # spawn rather than fork, the flow's threads and event loops don't survive a fork
+    return ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
 
-    return parse_clues_from_game(game_html, game_id)
+
+@task(
+    tags=[S3_TAG],
+    retries=CHUNK_RETRIES,
+    retry_delay_seconds=CHUNK_RETRY_DELAY_SECONDS,
+)
+async def read_game_chunk(
+    game_ids: List[str],
+    s3_bucket_name: str = "cluebase",
+    games_dir: str = RAW_GAMES_DIR,
+    mongo_secret_block: str = "mongo-connection-string",
+    database_name: str = "cluebase",
+) -> Dict[str, str]:
+    """
+    Read a chunk of game pages, by game id. Missing pages are quarantined, any
+    other error fails the chunk so that it's retried.
+    """
+    logger = get_run_logger()
+    bucket = get_s3_bucket(s3_bucket_name)
+    game_paths = [os.path.join(games_dir, f"{game_id}.html") for game_id in game_ids]
+
+    # One pooled async S3 client for the chunk's reads
+    async with async_s3_client(bucket.credentials):
+        pages = await asyncio.gather(
+            *[read_s3_object_async(bucket, game_path) for game_path in game_paths],
+            return_exceptions=True,
+        )
+
+    missing = {}
+    for game_id, game_path, page in zip(game_ids, game_paths, pages):
+        if is_missing_object(page):
+            missing[game_id] = (page, game_path)
+        elif isinstance(page, BaseException):
+            raise page
+
+    if missing:
+        mongo_conn_str = (await Secret.load(mongo_secret_block)).get()
+        mongo_client = await get_mongo_client(mongo_conn_str)
+        db = mongo_client.get_database(database_name)
+        for game_id, (error, game_path) in missing.items():
+            logger.error(f"Quarantining game {game_id}: {error!r}")
+            await quarantine_game(db, game_id, error, game_path)
+
+    logger.info(f"Read {len(game_ids) - len(missing)} games")
+    return {
+        game_id: page
+        for game_id, page in zip(game_ids, pages)
+        if game_id not in missing
+    }
 
 
 @task
-async def load_game_file_s3(
-    game_id: str,
-    s3_bucket_name: str = "cluebase",
+async def parse_game_chunk(
+    pages: Dict[str, str],
     games_dir: str = RAW_GAMES_DIR,
     mongo_secret_block: str = "mongo-connection-string",
     database_name: str = "cluebase",
-):
+) -> Dict[str, Tuple[List[dict], List[RawBSONDocument]]]:
+    """
+    Parse a chunk of game pages into their clues and the clues' BSON documents, by
+    game id, in the parse pool. Games that don't parse are quarantined.
+    """
     logger = get_run_logger()
-    logger.info(f"Loading clues from game {game_id}")
 
-    game_file_path = os.path.join(games_dir, f"{game_id}.html")
+    loop = asyncio.get_running_loop()
+    try:
+        (clues, failed), metrics = await loop.run_in_executor(
+            get_parse_pool(), call_with_stage_metrics, parse_and_encode_games, pages
+        )
+    except BrokenProcessPool:
+        # A parse process died, e.g. OOM-killed. The chunk fails, the next ones
+        # get a new pool
+        get_parse_pool.cache_clear()
+        raise
+    stage_metrics.merge(*metrics)
 
-    bucket = get_s3_bucket(s3_bucket_name)
+    if failed:
+        mongo_conn_str = (await Secret.load(mongo_secret_block)).get()
+        mongo_client = await get_mongo_client(mongo_conn_str)
+        db = mongo_client.get_database(database_name)
+        for game_id, error in failed.items():
+            logger.error(f"Quarantining game {game_id}: {error!r}")
+            await quarantine_game(
+                db, game_id, error, os.path.join(games_dir, f"{game_id}.html")
+            )
+
+    return clues
 
-    clues = await read_and_parse_clues(bucket, game_file_path, logger)
-    logger.info(f"Parsed {len(clues)} clues from {game_file_path}")
 
-    logger.info(f"Getting Mongo connection using secret block {mongo_secret_block}")
+@task(
+    tags=[MONGO_TAG],
+    retries=CHUNK_RETRIES,
+    retry_delay_seconds=CHUNK_RETRY_DELAY_SECONDS,
+)
+async def insert_clue_chunk(
+    clues_by_game: Dict[str, Tuple[List[dict], List[RawBSONDocument]]],
+    s3_bucket_name: str = "cluebase",
+    mongo_secret_block: str = "mongo-connection-string",
+    database_name: str = "cluebase",
+    replace: bool = False,
+) -> int:
+    """
+    Insert a chunk's clues and index them. Clues already in Mongo are skipped, so
+    a retried chunk only inserts what its last attempt didn't. With replace, the
+    games' clues in Mongo are updated to match their pages instead.
+    """
+    logger = get_run_logger()
+    clues = [clue for game_clues, _ in clues_by_game.values() for clue in game_clues]
+    documents = [
+        document
+        for _, game_documents in clues_by_game.values()
+        for document in game_documents
+    ]
+
     mongo_conn_str = (await Secret.load(mongo_secret_block)).get()
     mongo_client = await get_mongo_client(mongo_conn_str)
     db = mongo_client.get_database(database_name)
 
-    logger.info(f"Attempting to load clues into collection")
+    deleted_ids = []
     try:
-        loaded = await insert_clue_bulk(db, clues)
-        logger.info(f"Loaded {len(loaded)} clues from {game_file_path}")
-        logger.info(loaded)
-        return loaded
+        if replace:
+            clue_ids, deleted_ids = await replace_game_clues(
+                db, list(clues_by_game), clues
+            )
+            loaded = len(clue_ids)
+        else:
+            loaded = len(await insert_clue_bulk(db, clues, documents)) if clues else 0
+        bulk_write_error = None
     except pymongo.errors.BulkWriteError as e:
-        logger.info(f"Loaded {e.details['nInserted']} clues from {game_file_path}")
-        logger.warning(e)
-        return e.details["writeErrors"]
+        logger.warning(f"{len(e.details['writeErrors'])} clues not loaded: {e}")
+        loaded = len(clues) - len(e.details["writeErrors"])
+        bulk_write_error = e
+    logger.info(f"Loaded {loaded} clues from {len(clues_by_game)} games")
+
+    await asyncio.to_thread(
+        index_loaded_clues,
+        get_s3_bucket(s3_bucket_name),
+        clues,
+        bulk_write_error,
+        deleted_ids,
+        logger=logger,
+    )
+
+    await release_quarantined_games(db, list(clues_by_game))
+    return loaded
 
 
 @task
-async def gather_load_tasks(
-    game_ids: List[str], s3_bucket_name: str, s3_games_path: str
+async def quarantine_game_chunk(
+    game_ids: List[str],
+    error: BaseException,
+    games_dir: str = RAW_GAMES_DIR,
+    mongo_secret_block: str = "mongo-connection-string",
+    database_name: str = "cluebase",
 ):
-    return await asyncio.gather(
-        *[
-            load_game_file_s3(game_id, s3_bucket_name, s3_games_path)
-            for game_id in game_ids
-        ]
+    mongo_conn_str = (await Secret.load(mongo_secret_block)).get()
+    mongo_client = await get_mongo_client(mongo_conn_str)
+    db = mongo_client.get_database(database_name)
+
+    for game_id in game_ids:
+        await quarantine_game(
+            db, game_id, error, os.path.join(games_dir, f"{game_id}.html")
+        )
+
+
+def load_game_chunks(
+    game_ids: List[str],
+    s3_bucket_name: str = "cluebase",
+    games_dir: str = RAW_GAMES_DIR,
+    mongo_secret_block: str = "mongo-connection-string",
+    database_name: str = "cluebase",
+    chunk_size: int = LOAD_CHUNK_SIZE,
+    replace: bool = False,
+    logger=file_logger,
+) -> int:
+    """
+    Map the games' chunks through read, parse and insert tasks, in the calling
+    flow's task runner. Chunks that still fail after their retries have their
+    games quarantined. replace updates clues already in Mongo, see
+    insert_clue_chunk. Returns the number of clues loaded.
+
+    With a memory budget, chunks are shrunk to fit in it, and mapped in waves of
+    as many chunks as fit in what's left, instead of all at once.
+    """
+    budget = get_memory_budget()
+    if budget is not None:
+        chunk_size = budget.batch_size(chunk_size, GAME_MEMORY_BYTES)
+    chunks = [
+        game_ids[start : start + chunk_size]
+        for start in range(0, len(game_ids), chunk_size)
+    ]
+    logger.info(f"Loading {len(game_ids)} games in {len(chunks)} chunks")
+
+    clue_count = 0
+    failed_chunks = 0
+    with profile_memory("load_game_chunks", logger=logger) as profile:
+        start = 0
+        while start < len(chunks):
+            wave_size = len(chunks) - start
+            if budget is not None:
+                # So the last wave's pages and clues, freed but not yet returned
+                # to the OS, don't count against this one
+                budget.release_free_memory()
+                wave_size = budget.batch_size(wave_size, chunk_size * GAME_MEMORY_BYTES)
+            wave = chunks[start : start + wave_size]
+            start += wave_size
+
+            loaded, failed = load_chunk_wave(
+                wave,
+                s3_bucket_name,
+                games_dir,
+                mongo_secret_block,
+                database_name,
+                replace,
+                profile,
+                logger,
+            )
+            clue_count += loaded
+            failed_chunks += failed
+
+    logger.info(
+        f"Loaded {clue_count} clues, {failed_chunks} of {len(chunks)} chunks failed"
     )
+    return clue_count
 
 
-@flow
+def load_chunk_wave(
+    chunks,
+    s3_bucket_name,
+    games_dir,
+    mongo_secret_block,
+    database_name,
+    replace,
+    profile,
+    logger=file_logger,
+) -> Tuple[int, int]:
+    """
+    Map the chunks through read, parse and insert tasks and wait for them, then
+    quarantine the games of the chunks that failed. Returns the number of clues
+    loaded and of chunks that failed.
+    """
+    pages = read_game_chunk.map(
+        chunks,
+        unmapped(s3_bucket_name),
+        unmapped(games_dir),
+        unmapped(mongo_secret_block),
+        unmapped(database_name),
+    )
+    clues = parse_game_chunk.map(
+        pages,
+        unmapped(games_dir),
+        unmapped(mongo_secret_block),
+        unmapped(database_name),
+    )
+    loaded = insert_clue_chunk.map(
+        clues,
+        unmapped(s3_bucket_name),
+        unmapped(mongo_secret_block),
+        unmapped(database_name),
+        unmapped(replace),
+    )
+    loaded.wait()
+    # The wave's pages and clues are all still held by their futures
+    profile.checkpoint()
+
+    clue_count = 0
+    failed_chunks = 0
+    for chunk, *futures in zip(chunks, pages, clues, loaded):
+        if futures[-1].state.is_completed():
+            clue_count += futures[-1].result()
+            continue
+
+        # The stage that failed, the ones after it never ran. A crashed or
+        # cancelled stage isn't failed, so fall back to the first one that didn't
+        # complete
+        failed_state = next(
+            (future.state for future in futures if future.state.is_failed()), None
+        ) or next(future.state for future in futures if not future.state.is_completed())
+        error = failed_state.result(raise_on_failure=False)
+        if not isinstance(error, BaseException):
+            error = RuntimeError(f"{failed_state.name}: {failed_state.message}")
+        logger.error(f"Quarantining chunk of {len(chunk)} games: {error!r}")
+        asyncio.run(
+            quarantine_game_chunk(
+                chunk, error, games_dir, mongo_secret_block, database_name
+            )
+        )
+        failed_chunks += 1
+
+    return clue_count, failed_chunks
+
+
+@task
+async def read_quarantined_game_ids(
+    mongo_secret_block: str = "mongo-connection-string",
+    database_name: str = "cluebase",
+):
+    mongo_conn_str = (await Secret.load(mongo_secret_block)).get()
+    mongo_client = await get_mongo_client(mongo_conn_str)
+    db = mongo_client.get_database(database_name)
+
+    return await get_quarantined_game_ids(db)
+
+
+@flow(task_runner=ThreadPoolTaskRunner(max_workers=LOAD_WORKERS))
+@publish_stage_metrics
 def load_clues_from_set_s3(
     game_ids: List[str],
     s3_bucket_name="cluebase",
     s3_games_path="raw/games",
+    mongo_secret_block="mongo-connection-string",
+    database_name="cluebase",
+    chunk_size: int = LOAD_CHUNK_SIZE,
+    replace: bool = False,
 ):
-    asyncio.run(gather_load_tasks(game_ids, s3_bucket_name, s3_games_path))
+    """
+    Load the games' clues. replace updates the clues of games already in Mongo to
+    match their pages, for games whose page changed.
+    """
+    logger = get_run_logger()
+
+    return load_game_chunks(
+        game_ids,
+        s3_bucket_name,
+        s3_games_path,
+        mongo_secret_block,
+        database_name,
+        chunk_size,
+        replace,
+        logger=logger,
+    )
+
+
+@flow
+@publish_stage_metrics
+def load_quarantined_games_s3(
+    s3_bucket_name="cluebase",
+    s3_games_path="raw/games",
+    mongo_secret_block="mongo-connection-string",
+    database_name="cluebase",
+):
+    """
+    Retry only the games that failed to load. Games that load are released from
+    quarantine, and games that fail again stay in it with their attempts counted.
+    """
+    logger = get_run_logger()
+
+    game_ids = asyncio.run(read_quarantined_game_ids(mongo_secret_block, database_name))
+    logger.info(f"Retrying {len(game_ids)} quarantined games")
+
+    if game_ids:
+        load_clues_from_set_s3(
+            game_ids, s3_bucket_name, s3_games_path, mongo_secret_block, database_name
+        )
@@ -14,7 +14,9 @@ from src.io_utils import (
     insert_clue_bulk,
     read_s3_object_async,
 )
+from src.metrics import publish_stage_metrics
 from src.paths import RAW_GAMES_DIR
+from src.text_index import index_loaded_clues
 
 file_logger = getLogger(__name__)
 
@@ -56,14 +58,22 @@ async def load_game_file_s3(
         loaded = await insert_clue_bulk(db, clues)
         logger.info(f"Loaded {len(loaded)} clues from {game_file_path}")
         logger.info(loaded)
-        return loaded
+        result = loaded
+        bulk_write_error = None
     except pymongo.errors.BulkWriteError as e:
         logger.info(f"Loaded {e.details['nInserted']} clues from {game_file_path}")
         logger.warning(e)
-        return e.details["writeErrors"]
+        result = e.details["writeErrors"]
+        bulk_write_error = e
+
+    await asyncio.to_thread(
+        index_loaded_clues, bucket, clues, bulk_write_error, logger=logger
+    )
+    return result
 
 
 @flow
+@publish_stage_metrics
 def load_clues_from_single_game_s3(
     game_id: str,
     s3_bucket_name="cluebase",
@@ -1,85 +1,327 @@
 import time
+from functools import partial
+from itertools import compress
+from typing import Optional
 
 import faiss
+import numpy as np
 import pandas as pd
 from datasets import load_dataset
 from prefect import flow, task
+from prefect.blocks.system import Secret
+from prefect.logging import get_run_logger
+from pymongo import ASCENDING, MongoClient, UpdateOne
 from sentence_transformers import SentenceTransformer
 from sentence_transformers.quantization import quantize_embeddings
 from usearch.index import Index
 
-from src.io_utils import get_s3_bucket
+from src.clues import clue_model_text
+from src.io_utils import download_object_if_changed, get_s3_bucket
+from src.metrics import publish_stage_metrics, timed
+from workflows.ml_features.binary_index import (
+    binary_index_path,
+    set_binary_search_params,
+)
+from workflows.ml_features.clue_embeddings import ClueEmbeddingStore
+from workflows.ml_features.embedding_cache import EmbeddingCache, encode_with_cache
+from workflows.ml_features.search_service import search_remote
+
+RETRIEVAL_PROMPT = "Represent this sentence for searching relevant passages: "
+# Names the embedding cache, the prompt is part of it as it changes every embedding
+EMBEDDING_MODEL = f"mixedbread-ai/mxbai-embed-large-v1:{RETRIEVAL_PROMPT}"
 
 
 @flow(log_prints=True)
-def add_relevant_links():
-    document = {
-        "_id": "000009-1-0-0",
-        "clueText": "Te Papa, the National Museum of New Zealand, is in this city, the capital",
-        "solution": "Wellington",
-        "category": "NEW ZEALAND",
-        "difficulty": 0,
-        "airDate": "2004-09-16T00:00:00.000+0000",
-        "gameId": "9",
-        "roundNumber": 1,
-        "categoryIndex": 0,
-        "createdAt": "2024-11-03T00:16:18.598+0000",
-        "updatedAt": "2024-11-03T00:16:18.598+0000",
-    }
+@publish_stage_metrics
+def add_relevant_links(
+    overwrite: bool = False,
+    top_k: int = 10,
+    rescore_multiplier: int = 4,
+    batch_size: int = 256,
+    search_service_url: Optional[str] = None,
+    binary_index_type: str = "flat",
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    embedding_cache_dir: Optional[str] = None,
+    clue_embeddings_dir: Optional[str] = None,
+    mongo_secret_block: str = "mongo-connection-string",
+):
+    """
+    Link clues to their most relevant Wikipedia passages and store the top_k
+    results on each clue as `relevantLinks`.
+
+    Only clues without relevantLinks are linked unless overwrite is set, so reruns
+    pick up newly loaded clues without rescanning the corpus.
+    """
+    # A running search service already has the model and indices loaded
+    if search_service_url:
+        search_fn = partial(
+            search_remote,
+            service_url=search_service_url,
+            top_k=top_k,
+            rescore_multiplier=rescore_multiplier,
+        )
+    else:
+        download_indices(binary_index_type=binary_index_type)
 
-    download_indices()
+        title_text_dataset, model, int8_view, binary_index = load_model_and_indices(
+            binary_index_type, nprobe=nprobe, ef_search=ef_search
+        )
 
-    title_text_dataset, model, int8_view, binary_index = load_model_and_indices()
+        embedding_cache = (
+            EmbeddingCache(embedding_cache_dir, EMBEDDING_MODEL)
+            if embedding_cache_dir
+            else None
+        )
 
-    print(
-        search(
-            'In an attempt to come to grips with Shakespeare\'s "Richard III", this actor directed "Looking for Richard": Al Pacino',
-            title_text_dataset,
-            model,
-            binary_index,
-            int8_view,
+        search_fn = partial(
+            search_batch,
+            title_text_dataset=title_text_dataset,
+            model=model,
+            int8_view=int8_view,
+            binary_index=binary_index,
+            top_k=top_k,
+            rescore_multiplier=rescore_multiplier,
+            batch_size=batch_size,
+            embedding_cache=embedding_cache,
         )
+
+    clue_embeddings = (
+        ClueEmbeddingStore(clue_embeddings_dir) if clue_embeddings_dir else None
+    )
+
+    link_all_clues(
+        search_fn,
+        clue_embeddings=clue_embeddings,
+        mongo_secret_block=mongo_secret_block,
+        overwrite=overwrite,
+        batch_size=batch_size,
     )
 
 
 @task
-def download_indices(bucket_name="cluebase"):
-    # Download the model and indexes
+def link_all_clues(
+    search_fn,
+    clue_embeddings: Optional[ClueEmbeddingStore] = None,
+    mongo_secret_block="mongo-connection-string",
+    overwrite=False,
+    batch_size=256,
+    write_batch_size=1000,
+):
+    logger = get_run_logger()
+
+    logger.info(f"Getting Mongo connection using secret block {mongo_secret_block}")
+    mongo_conn_str = Secret.load(mongo_secret_block).get()
+    mongo_client = MongoClient(mongo_conn_str)
+    db = mongo_client.cluebase
+
+    exists_filter = {"relevantLinks": {"$exists": False}}
+    if overwrite:
+        exists_filter = {}
+
+    clue_count = db.clues.count_documents(exists_filter)
+    logger.info(f"Linking {clue_count} clues")
+
+    linked = 0
+    update_requests = []
+    last_id = None
+    while True:
+        # Page by _id rather than holding one cursor open while its results change
+        page_filter = dict(exists_filter)
+        if last_id is not None:
+            page_filter["_id"] = {"$gt": last_id}
+
+        batch_clues = list(
+            db.clues.find(page_filter, {"clueText": 1, "solution": 1})
+            .sort("_id", ASCENDING)
+            .limit(batch_size)
+        )
+        if not batch_clues:
+            break
+        last_id = batch_clues[-1]["_id"]
+
+        clue_ids = [clue["_id"] for clue in batch_clues]
+        search_kwargs = {}
+        if clue_embeddings is not None and all(
+            clue_id in clue_embeddings for clue_id in clue_ids
+        ):
+            search_kwargs["query_embeddings"] = clue_embeddings.get(clue_ids)
+
+        results, timings = search_fn(
+            [clue_model_text(clue) for clue in batch_clues], **search_kwargs
+        )
+        logger.debug(timings)
+
+        update_requests += [
+            UpdateOne(
+                {"_id": clue_id}, {"$set": {"relevantLinks": relevant_links(result)}}
+            )
+            for clue_id, result in zip(clue_ids, results)
+        ]
+
+        if len(update_requests) >= write_batch_size:
+            with timed("mongo_write", items=len(update_requests)):
+                db.clues.bulk_write(update_requests, ordered=False)
+            update_requests = []
+
+        linked += len(batch_clues)
+        logger.info(f"Linked {linked}/{clue_count} clues")
+
+    if update_requests:
+        with timed("mongo_write", items=len(update_requests)):
+            db.clues.bulk_write(update_requests, ordered=False)
+
+    return linked
+
+
+def relevant_links(result):
+    # Compact form stored on the clue, the passage text stays in the dataset
+    return [
+        {"title": title, "indexId": int(index_id), "score": float(score)}
+        for title, index_id, score in zip(
+            result["Title"], result["Id"], result["Score"]
+        )
+    ]
+
+
+@task
+def download_indices(bucket_name="cluebase", binary_index_type="flat"):
+    # Download the model and indexes, skipping any that are already up to date
     bucket = get_s3_bucket(bucket_name)
 
-    bucket.download_object_to_path(
-        "models/wikipedia_int8_usearch_1m.index", "wikipedia_int8_usearch_1m.index"
-    )
+    for index_path in [
+        "wikipedia_int8_usearch_1m.index",
+        binary_index_path(binary_index_type),
+    ]:
+        downloaded = download_object_if_changed(
+            bucket, f"models/{index_path}", index_path
+        )
+        print(f"{'Downloaded' if downloaded else 'Up to date'}: {index_path}")
+
 
-    bucket.download_object_to_path(
-        "models/wikipedia_ubinary_faiss_1m.index", "wikipedia_ubinary_faiss_1m.index"
+def load_embedding_model():
+    return SentenceTransformer(
+        "mixedbread-ai/mxbai-embed-large-v1",
+        prompts={
+            "retrieval": RETRIEVAL_PROMPT,
+        },
+        default_prompt_name="retrieval",
     )
 
 
 @task
-def load_model_and_indices():
+def load_model_and_indices(
+    binary_index_type="flat",
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+):
 
     # Load titles and texts
     title_text_dataset = load_dataset(
         "mixedbread-ai/wikipedia-data-en-2023-11", split="train", num_proc=4
     ).select_columns(["title", "text"])
 
-    model = SentenceTransformer(
-        "mixedbread-ai/mxbai-embed-large-v1",
-        prompts={
-            "retrieval": "Represent this sentence for searching relevant passages: ",
-        },
-        default_prompt_name="retrieval",
-    )
+    model = load_embedding_model()
 
     # Load the int8 and binary indices. Int8 is loaded as a view to save memory, as we never actually perform search with it.
     int8_view = Index.restore("wikipedia_int8_usearch_1m.index", view=True)
-    binary_index: faiss.IndexBinaryFlat = faiss.read_index_binary(
-        "wikipedia_ubinary_faiss_1m.index"
+    # The binary index is memory-mapped rather than read into RAM, so its pages are
+    # shared with the OS page cache. IO_FLAG_MMAP_IFC is the zero-copy flag for flat
+    # codes, older faiss builds only have IO_FLAG_MMAP.
+    binary_index: faiss.IndexBinary = faiss.read_index_binary(
+        binary_index_path(binary_index_type),
+        getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+        | faiss.IO_FLAG_READ_ONLY,
     )
+    # nprobe / efSearch only matter for the approximate (ivf / hnsw) index types
+    set_binary_search_params(binary_index, nprobe=nprobe, ef_search=ef_search)
     return title_text_dataset, model, int8_view, binary_index
 
 
+def lookup_titles_texts(title_text_dataset, ids):
+    """
+    Fetch the titles and texts of many rows with a single Arrow take.
+
+    The dataset is memory-mapped Arrow, so this gathers straight from the mapped
+    columns instead of materializing a Python dict per row.
+    """
+    rows = title_text_dataset.with_format("arrow")[ids]
+    return rows.column("title").to_pylist(), rows.column("text").to_pylist()
+
+
+def load_int8_embeddings(int8_view, ids):
+    """
+    int8 embeddings for an array of index ids, shaped ids.shape + (ndim,). The ivf
+    and hnsw binary indexes pad short results with id -1, whose embeddings are zeros.
+    """
+    flat_ids = ids.ravel()
+    valid = flat_ids >= 0
+    int8_embeddings = np.zeros((len(flat_ids), int8_view.ndim), dtype=np.int8)
+    if valid.any():
+        # Newer usearch returns one row per key as a tuple rather than a matrix
+        int8_embeddings[valid] = np.vstack(int8_view.get(flat_ids[valid]))
+    return int8_embeddings.reshape(*ids.shape, -1)
+
+
+def rescore(query_embeddings, int8_embeddings):
+    """
+    Dot product of each query with each of its candidates.
+
+    query_embeddings is (n, ndim) float32 or int8 and int8_embeddings is
+    (n, candidates, ndim) int8. int8 queries are scored exactly in int32, float
+    queries in float32, never through Python ints or float64.
+    """
+    if query_embeddings.dtype == np.int8:
+        return np.matmul(
+            int8_embeddings.astype(np.int32),
+            query_embeddings.astype(np.int32)[:, :, np.newaxis],
+        )[:, :, 0]
+
+    return np.matmul(
+        int8_embeddings.astype(np.float32),
+        query_embeddings.astype(np.float32, copy=False)[:, :, np.newaxis],
+    )[:, :, 0]
+
+
+def select_top_k(scores, candidate_ids, top_k):
+    """
+    Per row, the top_k (ids, scores) in descending score order.
+
+    argpartition finds the top_k in linear time, and only those get sorted. Padding
+    candidates (id -1) score -inf, so they come last and only when a row has fewer
+    than top_k real candidates.
+    """
+    if (candidate_ids < 0).any():
+        scores = np.where(candidate_ids < 0, -np.inf, scores)
+
+    k = min(top_k, scores.shape[1])
+    if k < scores.shape[1]:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top = np.broadcast_to(np.arange(k), scores.shape).copy()
+
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+
+    return (
+        np.take_along_axis(candidate_ids, top, axis=1),
+        np.take_along_axis(scores, top, axis=1),
+    )
+
+
+def results_dataframe(top_k_ids, top_k_scores, top_k_titles, top_k_texts):
+    # Padding candidates (id -1) aren't results
+    valid = top_k_ids >= 0
+    return pd.DataFrame(
+        {
+            "Id": top_k_ids[valid],
+            "Score": np.round(top_k_scores[valid], 2),
+            "Title": list(compress(top_k_titles, valid)),
+            "Text": list(compress(top_k_texts, valid)),
+        }
+    )
+
+
 def search(
     query,
     title_text_dataset,
@@ -88,10 +330,16 @@ def search(
     binary_index,
     top_k: int = 100,
     rescore_multiplier: int = 1,
+    embedding_cache: Optional[EmbeddingCache] = None,
+    as_dataframe: bool = True,
 ):
+    """
+    Search for one query. With as_dataframe=False the results are plain
+    (ids, scores) arrays and titles/texts aren't looked up.
+    """
     # 1. Embed the query as float32
     start_time = time.time()
-    query_embedding = model.encode(query)
+    query_embedding = encode_with_cache(model, [query], embedding_cache)[0]
     embed_time = time.time() - start_time
 
     # 2. Quantize the query to ubinary
@@ -104,43 +352,128 @@ def search(
     # 3. Search the binary index (either exact or approximate)
     index = binary_index
     start_time = time.time()
-    _scores, binary_ids = index.search(
-        query_embedding_ubinary, top_k * rescore_multiplier
-    )
-    binary_ids = binary_ids[0]
+    with timed("index_search", items=1):
+        _scores, binary_ids = index.search(
+            query_embedding_ubinary, top_k * rescore_multiplier
+        )
     search_time = time.time() - start_time
 
     # 4. Load the corresponding int8 embeddings
     start_time = time.time()
-    int8_embeddings = int8_view[binary_ids].astype(int)
+    int8_embeddings = load_int8_embeddings(int8_view, binary_ids)
     load_time = time.time() - start_time
 
     # 5. Rescore the top_k * rescore_multiplier using the float32 query embedding and the int8 document embeddings
     start_time = time.time()
-    scores = query_embedding @ int8_embeddings.T
+    scores = rescore(query_embedding.reshape(1, -1), int8_embeddings)
     rescore_time = time.time() - start_time
 
-    # 6. Sort the scores and return the top_k
+    # 6. Select the top_k
     start_time = time.time()
-    indices = scores.argsort()[::-1][:top_k]
-    top_k_indices = binary_ids[indices]
-    top_k_scores = scores[indices]
-    top_k_titles, top_k_texts = zip(
-        *[
-            (title_text_dataset[idx]["title"], title_text_dataset[idx]["text"])
-            for idx in top_k_indices.tolist()
+    top_k_ids, top_k_scores = select_top_k(scores, binary_ids, top_k)
+    top_k_ids, top_k_scores = top_k_ids[0], top_k_scores[0]
+    if as_dataframe:
+        result = results_dataframe(
+            top_k_ids,
+            top_k_scores,
+            *lookup_titles_texts(title_text_dataset, np.maximum(top_k_ids, 0).tolist()),
+        )
+    else:
+        result = (top_k_ids, top_k_scores)
+    sort_time = time.time() - start_time
+
+    return result, {
+        "Embed Time": f"{embed_time:.4f} s",
+        "Quantize Time": f"{quantize_time:.4f} s",
+        "Search Time": f"{search_time:.4f} s",
+        "Load Time": f"{load_time:.4f} s",
+        "Rescore Time": f"{rescore_time:.4f} s",
+        "Sort Time": f"{sort_time:.4f} s",
+        "Total Retrieval Time": f"{quantize_time + search_time + load_time + rescore_time + sort_time:.4f} s",
+    }
+
+
+def search_batch(
+    queries,
+    title_text_dataset,
+    model,
+    int8_view,
+    binary_index,
+    top_k: int = 100,
+    rescore_multiplier: int = 1,
+    batch_size: int = 256,
+    embedding_cache: Optional[EmbeddingCache] = None,
+    query_embeddings: Optional[np.ndarray] = None,
+    as_dataframe: bool = True,
+):
+    """
+    Search for many queries at once.
+
+    Same steps as `search`, but each step runs once over the whole batch of queries
+    instead of once per query. Returns one results DataFrame per query, in order,
+    or with as_dataframe=False a pair of (queries, top_k) ids and scores arrays.
+    Pass precomputed float32 `query_embeddings` (e.g. from the clue embedding store)
+    to skip the model entirely.
+    """
+    if len(queries) == 0:
+        return [], {}
+
+    # 1. Embed all queries as float32, in model-sized batches
+    start_time = time.time()
+    if query_embeddings is None:
+        query_embeddings = encode_with_cache(
+            model, queries, embedding_cache, batch_size=batch_size
+        )
+    embed_time = time.time() - start_time
+
+    # 2. Quantize the queries to ubinary
+    start_time = time.time()
+    query_embeddings_ubinary = quantize_embeddings(query_embeddings, "ubinary")
+    quantize_time = time.time() - start_time
+
+    # 3. Search the binary index with the whole query matrix in a single call
+    index = binary_index
+    start_time = time.time()
+    with timed("index_search", items=len(queries)):
+        _scores, binary_ids = index.search(
+            query_embeddings_ubinary, top_k * rescore_multiplier
+        )
+    search_time = time.time() - start_time
+
+    # 4. Load the int8 embeddings of every candidate for every query in one lookup
+    start_time = time.time()
+    int8_embeddings = load_int8_embeddings(int8_view, binary_ids)
+    load_time = time.time() - start_time
+
+    # 5. Rescore every query's candidates with one batched matmul
+    start_time = time.time()
+    scores = rescore(query_embeddings, int8_embeddings)
+    rescore_time = time.time() - start_time
+
+    # 6. Select each query's top_k
+    start_time = time.time()
+    top_k_ids, top_k_scores = select_top_k(scores, binary_ids, top_k)
+    if as_dataframe:
+        # One take for every query's results, then split back out per query
+        all_titles, all_texts = lookup_titles_texts(
+            title_text_dataset, np.maximum(top_k_ids, 0).ravel().tolist()
+        )
+        n_results = top_k_ids.shape[1]
+        results = [
+            results_dataframe(
+                top_k_ids[i],
+                top_k_scores[i],
+                all_titles[i * n_results : (i + 1) * n_results],
+                all_texts[i * n_results : (i + 1) * n_results],
+            )
+            for i in range(len(top_k_ids))
         ]
-    )
-    df = pd.DataFrame(
-        {
-            "Score": [round(value, 2) for value in top_k_scores],
-            "Title": top_k_titles,
-            "Text": top_k_texts,
-        }
-    )
+    else:
+        results = (top_k_ids, top_k_scores)
     sort_time = time.time() - start_time
 
-    return df, {
+    return results, {
+        "Queries": len(queries),
         "Embed Time": f"{embed_time:.4f} s",
         "Quantize Time": f"{quantize_time:.4f} s",
         "Search Time": f"{search_time:.4f} s",
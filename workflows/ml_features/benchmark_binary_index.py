@@ -0,0 +1,158 @@
+"""
+Recall/latency benchmark for the approximate binary index types.
+
+Builds flat, IVF and HNSW binary indices over synthetic embeddings, then reports
+recall@k against the exhaustive flat index plus p50/p99 single-query latency for
+each nprobe / efSearch setting.
+
+    python -m workflows.ml_features.benchmark_binary_index --n-base 1000000
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from workflows.ml_features.binary_index import (
+    build_binary_index,
+    set_binary_search_params,
+)
+
+
+def synthetic_ubinary_embeddings(n, ndim=1024, n_clusters=1000, noise=0.3, seed=0):
+    """
+    Clustered random embeddings, packed to ubinary like `quantize_embeddings` does.
+
+    Uniform random vectors have no neighbourhood structure at all, which makes every
+    approximate index look far worse than it will on real embeddings.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, ndim), dtype=np.float32)
+
+    packed = np.empty((n, ndim // 8), dtype=np.uint8)
+    for start in range(0, n, 100_000):
+        end = min(start + 100_000, n)
+        assignments = rng.integers(0, n_clusters, end - start)
+        embeddings = centers[assignments] + noise * rng.standard_normal(
+            (end - start, ndim), dtype=np.float32
+        )
+        packed[start:end] = np.packbits(embeddings > 0, axis=-1)
+
+    return packed
+
+
+def recall_at_k(distances, flat_distances, k):
+    # Distance-based so that Hamming ties with the k-th true neighbour aren't misses
+    kth_distance = flat_distances[:, k - 1 : k]
+    return float(np.mean(np.sum(distances[:, :k] <= kth_distance, axis=1) / k))
+
+
+def query_latencies(index, queries, k):
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        index.search(query.reshape(1, -1), k)
+        latencies.append(time.perf_counter() - start_time)
+
+    return np.array(latencies)
+
+
+def benchmark_setting(index, label, queries, flat_distances, k):
+    distances, _ids = index.search(queries, k)
+    latencies = query_latencies(index, queries, k)
+
+    return {
+        "index": label,
+        f"recall@{k}": round(recall_at_k(distances, flat_distances, k), 4),
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 3),
+    }
+
+
+def run_benchmark(
+    n_base=1_000_000,
+    n_queries=1000,
+    ndim=1024,
+    k=100,
+    nlist=4096,
+    nprobes=(1, 4, 16, 64, 256),
+    hnsw_m=32,
+    ef_searches=(128, 256, 512, 1024),
+    seed=0,
+):
+    data = synthetic_ubinary_embeddings(n_base + n_queries, ndim, seed=seed)
+    base, queries = data[:n_base], data[n_base:]
+
+    results = []
+
+    start_time = time.time()
+    flat = build_binary_index("flat", ndim)
+    flat.add(base)
+    print(f"Built flat index in {time.time() - start_time:.1f} s")
+
+    flat_distances, _ids = flat.search(queries, k)
+    results.append(benchmark_setting(flat, "flat", queries, flat_distances, k))
+
+    start_time = time.time()
+    train_size = min(n_base, 40 * nlist)
+    ivf = build_binary_index(
+        "ivf", ndim, nlist=nlist, train_embeddings=base[:train_size]
+    )
+    ivf.add(base)
+    print(f"Built ivf index (nlist={nlist}) in {time.time() - start_time:.1f} s")
+
+    for nprobe in nprobes:
+        set_binary_search_params(ivf, nprobe=nprobe)
+        results.append(
+            benchmark_setting(ivf, f"ivf nprobe={nprobe}", queries, flat_distances, k)
+        )
+
+    start_time = time.time()
+    hnsw = build_binary_index("hnsw", ndim, hnsw_m=hnsw_m)
+    hnsw.add(base)
+    print(f"Built hnsw index (M={hnsw_m}) in {time.time() - start_time:.1f} s")
+
+    for ef_search in ef_searches:
+        if ef_search < k:
+            continue
+        set_binary_search_params(hnsw, ef_search=ef_search)
+        results.append(
+            benchmark_setting(
+                hnsw, f"hnsw efSearch={ef_search}", queries, flat_distances, k
+            )
+        )
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--n-base", type=int, default=1_000_000)
+    parser.add_argument("--n-queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=100)
+    parser.add_argument("--nlist", type=int, default=4096)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64, 256])
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    parser.add_argument(
+        "--ef-search", type=int, nargs="+", default=[128, 256, 512, 1024]
+    )
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        n_base=args.n_base,
+        n_queries=args.n_queries,
+        k=args.k,
+        nlist=args.nlist,
+        nprobes=args.nprobe,
+        hnsw_m=args.hnsw_m,
+        ef_searches=args.ef_search,
+    )
+
+    for result in results:
+        print(result)
+
+    if args.json:
+        with open(args.json, "w+") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,77 @@
+"""
+Binary (ubinary) faiss index construction and search settings.
+
+"flat" is the exhaustive Hamming scan. "ivf" and "hnsw" are approximate, trading
+recall for query latency through nprobe / efSearch. See benchmark_binary_index.py
+for picking those values.
+"""
+
+from typing import Optional
+
+import faiss
+
+BINARY_INDEX_TYPES = ("flat", "ivf", "hnsw")
+
+DEFAULT_NLIST = 65536
+DEFAULT_HNSW_M = 32
+DEFAULT_EF_CONSTRUCTION = 40
+
+
+def binary_index_path(index_type: str = "flat") -> str:
+    if index_type == "flat":
+        return "wikipedia_ubinary_faiss_1m.index"
+
+    return f"wikipedia_ubinary_faiss_{index_type}_1m.index"
+
+
+def build_binary_index(
+    index_type: str = "flat",
+    ndim: int = 1024,
+    nlist: int = DEFAULT_NLIST,
+    hnsw_m: int = DEFAULT_HNSW_M,
+    ef_construction: int = DEFAULT_EF_CONSTRUCTION,
+    train_embeddings=None,
+) -> faiss.IndexBinary:
+    """
+    Create an empty binary index of the given type, ready for `add`.
+
+    "ivf" needs ubinary `train_embeddings` to learn its nlist centroids, a few
+    hundred rows per list is plenty.
+    """
+    if index_type == "flat":
+        return faiss.IndexBinaryFlat(ndim)
+
+    if index_type == "ivf":
+        if train_embeddings is None:
+            raise ValueError("An IVF binary index needs train_embeddings")
+
+        quantizer = faiss.IndexBinaryFlat(ndim)
+        index = faiss.IndexBinaryIVF(quantizer, ndim, nlist)
+        index.train(train_embeddings)
+        return index
+
+    if index_type == "hnsw":
+        index = faiss.IndexBinaryHNSW(ndim, hnsw_m)
+        index.hnsw.efConstruction = ef_construction
+        return index
+
+    raise ValueError(
+        f"Unknown binary index type {index_type}, expected one of {BINARY_INDEX_TYPES}"
+    )
+
+
+def set_binary_search_params(
+    index: faiss.IndexBinary,
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+) -> faiss.IndexBinary:
+    """
+    Apply query-time recall/latency knobs. Ignored for index types they don't apply to.
+    """
+    if nprobe is not None and hasattr(index, "nprobe"):
+        index.nprobe = nprobe
+
+    if ef_search is not None and hasattr(index, "hnsw"):
+        index.hnsw.efSearch = ef_search
+
+    return index
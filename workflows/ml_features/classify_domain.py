@@ -1,3 +1,4 @@
+import itertools
 from logging import getLogger
 from typing import Tuple
 
@@ -10,6 +11,10 @@ from pymongo import MongoClient, UpdateOne
 from torch import nn
 from transformers import AutoConfig, AutoModel, AutoTokenizer
 
+from src.clues import clue_model_text
+from src.memory import profile_memory
+from src.metrics import publish_stage_metrics, timed
+
 file_logger = getLogger(__name__)
 
 
@@ -30,6 +35,7 @@ class CustomModel(nn.Module, PyTorchModelHubMixin):
 
 
 @flow
+@publish_stage_metrics
 def classify_domains(overwrite=False):
     model_config, tokenizer, model = setup_model()
 
@@ -101,8 +107,7 @@ def predict_all_domains(
     if overwrite:
         exists_filter = {}
 
-    clues = [clue for clue in db.clues.find(exists_filter)]
-    clue_count = len(clues)
+    clue_count = db.clues.count_documents(exists_filter)
     logger.info(f"Predicting for {clue_count} clues")
 
     if torch.cuda.is_available():
@@ -110,26 +115,33 @@ def predict_all_domains(
     else:
         batch_size = 1
 
-    for i in range(0, clue_count, batch_size):
-        batch_clues = clues[i : i + batch_size]
+    # Streamed from the cursor, the whole collection doesn't fit in a small worker
+    clues = db.clues.find(exists_filter, batch_size=max(batch_size, 1000))
+    with profile_memory("predict_all_domains", logger=logger) as profile:
+        for i in itertools.count(0, batch_size):
+            batch_clues = list(itertools.islice(clues, batch_size))
+            if not batch_clues:
+                break
 
-        logger.debug(f"Clues {i}:{i+batch_size}: {batch_clues}")
-        classify_texts = [
-            f"{clue['clueText']}: {clue['solution']}" for clue in batch_clues
-        ]
+            logger.debug(f"Clues {i}:{i+batch_size}: {batch_clues}")
+            classify_texts = [clue_model_text(clue) for clue in batch_clues]
 
-        logger.debug(f"Classifying batch of clues {i} to {i + batch_size}")
-        predicted_domains = predict(
-            classify_texts, model_config, tokenizer, model, logger=logger
-        )
+            logger.debug(f"Classifying batch of clues {i} to {i + batch_size}")
+            predicted_domains = predict(
+                classify_texts, model_config, tokenizer, model, logger=logger
+            )
+
+            update_requests = [
+                UpdateOne({"_id": clue["_id"]}, {"$set": {"domain": predicted_domain}})
+                for clue, predicted_domain in zip(batch_clues, predicted_domains)
+            ]
+            logger.debug(update_requests)
+            with timed("mongo_write", items=len(update_requests)):
+                result = db.clues.bulk_write(update_requests)
+            logger.debug(result)
 
-        update_requests = [
-            UpdateOne({"_id": clue["_id"]}, {"$set": {"domain": predicted_domain}})
-            for clue, predicted_domain in zip(batch_clues, predicted_domains)
-        ]
-        logger.debug(update_requests)
-        result = db.clues.bulk_write(update_requests)
-        logger.debug(result)
+            if i == 0:
+                profile.checkpoint()
 
 
 @torch.inference_mode()
@@ -140,7 +152,8 @@ def predict(texts_to_classify, config, tokenizer, model, logger=file_logger):
     )
     if torch.cuda.is_available():
         inputs = inputs.to("cuda")
-    outputs = model(inputs["input_ids"], inputs["attention_mask"])
+    with timed("model_inference", items=len(texts_to_classify)):
+        outputs = model(inputs["input_ids"], inputs["attention_mask"])
 
     predicted_class_idxs = torch.topk(outputs, 5, dim=1).indices
 
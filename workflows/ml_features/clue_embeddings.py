@@ -0,0 +1,184 @@
+"""
+On-disk store of clue embeddings, aligned to clue `_id`s.
+
+Each clue's mxbai-embed-large embedding is kept as int8 (for rescoring) and
+ubinary (for Hamming search) rows in flat append-only files, so downstream
+features read vectors instead of running the model again:
+
+    ids.txt       one clue _id per line, row i of the matrices is line i
+    int8.bin      (rows, ndim) int8
+    ubinary.bin   (rows, ndim / 8) uint8, packed sign bits
+    ranges.npy    (2, ndim) float32 int8 quantization ranges, fixed on first append
+    dropped.txt   one discarded row per line, of clues deleted or whose text changed
+
+Appends write the matrices before the ids, so rows past the last id (from an
+interrupted append) are ignored and overwritten by the next append. A discarded
+clue can be appended again, and its latest row is the one used.
+"""
+
+import os
+
+import faiss
+import numpy as np
+
+STORE_FILES = ("ids.txt", "int8.bin", "ubinary.bin", "ranges.npy", "dropped.txt")
+
+
+class ClueEmbeddingStore:
+    def __init__(self, store_dir, ndim=1024):
+        self.store_dir = store_dir
+        self.ndim = ndim
+        os.makedirs(store_dir, exist_ok=True)
+
+        self.ids = []
+        if os.path.exists(self.path("ids.txt")):
+            with open(self.path("ids.txt"), "r") as f:
+                self.ids = f.read().splitlines()
+        self.dropped = set()
+        if os.path.exists(self.path("dropped.txt")):
+            with open(self.path("dropped.txt"), "r") as f:
+                self.dropped = {int(row) for row in f.read().split()}
+        self.rows = {
+            clue_id: row
+            for row, clue_id in enumerate(self.ids)
+            if row not in self.dropped
+        }
+
+        self.ranges = None
+        if os.path.exists(self.path("ranges.npy")):
+            self.ranges = np.load(self.path("ranges.npy"))
+
+        self._binary_index = None
+        self._live_rows = None
+
+    def path(self, filename):
+        return os.path.join(self.store_dir, filename)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, clue_id):
+        return clue_id in self.rows
+
+    def _matrix(self, filename, dtype, width):
+        if not self.ids:
+            return np.empty((0, width), dtype=dtype)
+
+        return np.memmap(
+            self.path(filename), dtype=dtype, mode="r", shape=(len(self.ids), width)
+        )
+
+    @property
+    def int8(self):
+        return self._matrix("int8.bin", np.int8, self.ndim)
+
+    @property
+    def ubinary(self):
+        return self._matrix("ubinary.bin", np.uint8, self.ndim // 8)
+
+    def quantize_int8(self, embeddings):
+        # Same mapping as sentence-transformers' int8 quantization, clipped so
+        # values outside the fixed ranges don't wrap
+        starts = self.ranges[0]
+        steps = (self.ranges[1] - self.ranges[0]) / 255
+        clipped = np.clip(embeddings, self.ranges[0], self.ranges[1])
+        return ((clipped - starts) / steps - 128).astype(np.int8)
+
+    def dequantize_int8(self, int8_embeddings):
+        steps = (self.ranges[1] - self.ranges[0]) / 255
+        return self.ranges[0] + (int8_embeddings.astype(np.float32) + 128) * steps
+
+    def append(self, clue_ids, embeddings):
+        """
+        Add float32 embeddings for clues not already in the store. The first append
+        also fixes the int8 ranges, so make it a reasonably sized sample.
+        """
+        new_rows = [i for i, clue_id in enumerate(clue_ids) if clue_id not in self]
+        if not new_rows:
+            return 0
+
+        clue_ids = [clue_ids[i] for i in new_rows]
+        embeddings = np.asarray(embeddings, dtype=np.float32)[new_rows]
+
+        if self.ranges is None:
+            self.ranges = np.vstack((embeddings.min(axis=0), embeddings.max(axis=0)))
+            np.save(self.path("ranges.npy"), self.ranges)
+
+        for filename, matrix in [
+            ("int8.bin", self.quantize_int8(embeddings)),
+            ("ubinary.bin", np.packbits(embeddings > 0, axis=-1)),
+        ]:
+            with open(self.path(filename), "ab") as f:
+                f.truncate(len(self.ids) * matrix.shape[1])
+                f.write(matrix.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+        with open(self.path("ids.txt"), "a") as f:
+            f.writelines(f"{clue_id}\n" for clue_id in clue_ids)
+
+        for clue_id in clue_ids:
+            self.rows[clue_id] = len(self.ids)
+            self.ids.append(clue_id)
+        self._binary_index = None
+
+        return len(clue_ids)
+
+    def discard(self, clue_ids):
+        """
+        Drop the rows of clues that were deleted or whose text changed, so they're
+        no longer returned and can be appended again.
+        """
+        rows = [self.rows.pop(clue_id) for clue_id in clue_ids if clue_id in self]
+        if not rows:
+            return 0
+
+        with open(self.path("dropped.txt"), "a") as f:
+            f.writelines(f"{row}\n" for row in rows)
+        self.dropped.update(rows)
+        self._binary_index = None
+
+        return len(rows)
+
+    def get(self, clue_ids, precision="float32"):
+        """
+        Vectors for the given clues as "int8", "ubinary", or dequantized "float32".
+        """
+        rows = np.array([self.rows[clue_id] for clue_id in clue_ids], dtype=np.int64)
+
+        if precision == "ubinary":
+            return np.asarray(self.ubinary[rows])
+
+        int8_embeddings = np.asarray(self.int8[rows])
+        if precision == "int8":
+            return int8_embeddings
+
+        return self.dequantize_int8(int8_embeddings)
+
+    def similar_clues(self, clue_id, top_k=10, rescore_multiplier=4):
+        """
+        The top_k clues most similar to clue_id, as (clue_id, score) pairs.
+
+        Hamming search over the ubinary rows, rescored with the int8 rows.
+        """
+        if self._binary_index is None:
+            self._binary_index = faiss.IndexBinaryFlat(self.ndim)
+            self._binary_index.add(np.ascontiguousarray(self.ubinary))
+            self._live_rows = np.zeros(len(self.ids), dtype=bool)
+            self._live_rows[list(self.rows.values())] = True
+
+        # Extra candidates in place of dropped rows, which are still in the index
+        _distances, candidates = self._binary_index.search(
+            self.get([clue_id], "ubinary"),
+            top_k * rescore_multiplier + 1 + len(self.dropped),
+        )
+        candidates = candidates[0][candidates[0] >= 0]
+        candidates = candidates[
+            self._live_rows[candidates] & (candidates != self.rows[clue_id])
+        ][: top_k * rescore_multiplier]
+
+        query = self.get([clue_id], "float32")[0]
+        scores = self.dequantize_int8(np.asarray(self.int8[candidates])) @ query
+        order = np.argsort(-scores)[:top_k]
+
+        return [(self.ids[candidates[i]], float(scores[i])) for i in order]
@@ -0,0 +1,170 @@
+import os
+from logging import getLogger
+
+from botocore.exceptions import ClientError
+from prefect import flow, task
+from prefect.blocks.system import Secret
+from prefect.logging import get_run_logger
+from pymongo import MongoClient
+
+from src.clues import clue_model_text
+from src.io_utils import (
+    ack_clue_changes,
+    download_object_if_changed,
+    get_s3_bucket,
+    pending_clue_changes,
+)
+from src.metrics import publish_stage_metrics, timed
+from workflows.ml_features.add_relevant_links import load_embedding_model
+from workflows.ml_features.clue_embeddings import STORE_FILES, ClueEmbeddingStore
+
+file_logger = getLogger(__name__)
+
+CLUE_EMBEDDINGS_DIR = "clue_embeddings"
+CLUE_EMBEDDINGS_S3_PREFIX = "models/clue_embeddings"
+# The first batch also calibrates the store's int8 ranges
+CALIBRATION_SIZE = 10_000
+# This flow's name in clue_changes, see src/io_utils.py
+EMBEDDINGS_CONSUMER = "embeddings"
+
+
+@flow
+@publish_stage_metrics
+def embed_clues(
+    store_dir=CLUE_EMBEDDINGS_DIR,
+    bucket_name="cluebase",
+    s3_prefix=CLUE_EMBEDDINGS_S3_PREFIX,
+    batch_size=256,
+    mongo_secret_block="mongo-connection-string",
+):
+    download_clue_embeddings(store_dir, bucket_name, s3_prefix)
+
+    # Clues whose text changed are embedded again as new clues
+    changes = discard_changed_clues(store_dir, mongo_secret_block)
+    added = embed_new_clues(store_dir, batch_size, mongo_secret_block)
+
+    if added or changes:
+        upload_clue_embeddings(store_dir, bucket_name, s3_prefix)
+        ack_discarded_clues(changes, mongo_secret_block)
+
+
+@task
+def download_clue_embeddings(
+    store_dir=CLUE_EMBEDDINGS_DIR,
+    bucket_name="cluebase",
+    s3_prefix=CLUE_EMBEDDINGS_S3_PREFIX,
+):
+    logger = get_run_logger()
+    bucket = get_s3_bucket(bucket_name)
+    os.makedirs(store_dir, exist_ok=True)
+
+    for filename in STORE_FILES:
+        try:
+            download_object_if_changed(
+                bucket,
+                f"{s3_prefix}/{filename}",
+                os.path.join(store_dir, filename),
+                logger=logger,
+            )
+        except ClientError as e:
+            # Nothing uploaded yet, start a new store
+            logger.info(f"No {s3_prefix}/{filename} in s3: {e}")
+
+
+@task
+def upload_clue_embeddings(
+    store_dir=CLUE_EMBEDDINGS_DIR,
+    bucket_name="cluebase",
+    s3_prefix=CLUE_EMBEDDINGS_S3_PREFIX,
+):
+    logger = get_run_logger()
+    bucket = get_s3_bucket(bucket_name)
+
+    # ids last, so a reader never sees ids without their rows
+    for filename in ["ranges.npy", "int8.bin", "ubinary.bin", "dropped.txt", "ids.txt"]:
+        if not os.path.exists(os.path.join(store_dir, filename)):
+            continue
+        logger.info(f"Uploading {filename} to {s3_prefix}/{filename}")
+        bucket.upload_from_path(
+            os.path.join(store_dir, filename), f"{s3_prefix}/{filename}"
+        )
+
+
+@task
+def discard_changed_clues(
+    store_dir=CLUE_EMBEDDINGS_DIR,
+    mongo_secret_block="mongo-connection-string",
+):
+    """
+    Drop the embeddings of clues queued in clue_changes, deleted or with new text.
+    Returns the changes, to acknowledge once the store is uploaded.
+    """
+    logger = get_run_logger()
+    store = ClueEmbeddingStore(store_dir)
+
+    mongo_conn_str = Secret.load(mongo_secret_block).get()
+    db = MongoClient(mongo_conn_str).cluebase
+
+    changes = pending_clue_changes(db, EMBEDDINGS_CONSUMER)
+    discarded = store.discard(changes)
+    logger.info(f"Discarded {discarded} of {len(changes)} changed or deleted clues")
+    return changes
+
+
+@task
+def ack_discarded_clues(changes, mongo_secret_block="mongo-connection-string"):
+    mongo_conn_str = Secret.load(mongo_secret_block).get()
+    db = MongoClient(mongo_conn_str).cluebase
+
+    ack_clue_changes(db, EMBEDDINGS_CONSUMER, changes)
+
+
+@task
+def embed_new_clues(
+    store_dir=CLUE_EMBEDDINGS_DIR,
+    batch_size=256,
+    mongo_secret_block="mongo-connection-string",
+):
+    logger = get_run_logger()
+    store = ClueEmbeddingStore(store_dir)
+
+    logger.info(f"Getting Mongo connection using secret block {mongo_secret_block}")
+    mongo_conn_str = Secret.load(mongo_secret_block).get()
+    mongo_client = MongoClient(mongo_conn_str)
+    db = mongo_client.cluebase
+
+    new_ids = [
+        clue["_id"]
+        for clue in db.clues.find({}, {"_id": 1})
+        if clue["_id"] not in store
+    ]
+    logger.info(f"{len(store)} clues already embedded, {len(new_ids)} to embed")
+    if not new_ids:
+        return 0
+
+    model = load_embedding_model()
+
+    added = 0
+    start = 0
+    while start < len(new_ids):
+        chunk_size = batch_size if len(store) else max(batch_size, CALIBRATION_SIZE)
+        chunk_ids = new_ids[start : start + chunk_size]
+        start += chunk_size
+
+        clues_by_id = {
+            clue["_id"]: clue
+            for clue in db.clues.find(
+                {"_id": {"$in": chunk_ids}}, {"clueText": 1, "solution": 1}
+            )
+        }
+        chunk_ids = [clue_id for clue_id in chunk_ids if clue_id in clues_by_id]
+
+        with timed("model_inference", items=len(chunk_ids)):
+            embeddings = model.encode(
+                [clue_model_text(clues_by_id[clue_id]) for clue_id in chunk_ids],
+                batch_size=batch_size,
+            )
+        added += store.append(chunk_ids, embeddings)
+        logger.info(f"Embedded {added}/{len(new_ids)} clues")
+
+    return added
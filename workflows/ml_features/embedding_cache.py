@@ -0,0 +1,210 @@
+"""
+Persistent cache of text embeddings.
+
+Vectors live in a memory-mapped .npy array of fixed capacity, and a JSON offset
+index maps each key (a hash of the model name and text) to its row. Rows are
+reused least-recently-used first once the cache reaches its size budget.
+
+Each row's key is also stored next to its vector, cleared while the vector is
+rewritten, and a lookup only hits when the row still holds its key. So an index
+left stale by a crash, or by another process sharing the cache directory, gives
+misses rather than another text's embedding. Writes hold an flock.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging import getLogger
+
+import numpy as np
+
+from src.metrics import timed
+
+file_logger = getLogger(__name__)
+
+DEFAULT_CACHE_BYTES = 1024**3
+# Bytes of a key, a sha1 digest
+KEY_BYTES = 20
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        cache_dir,
+        model_name,
+        ndim=1024,
+        dtype="float32",
+        max_bytes=DEFAULT_CACHE_BYTES,
+        ranges=None,
+    ):
+        """
+        dtype is "float32", or "int8" to store 4x as many vectors in the same budget.
+        int8 needs the (2, ndim) quantization `ranges` the vectors are stored with,
+        and lookups return them dequantized to float32.
+        """
+        if dtype not in ("float32", "int8"):
+            raise ValueError(f"Unsupported embedding cache dtype {dtype}")
+        if dtype == "int8" and ranges is None:
+            raise ValueError("An int8 embedding cache needs quantization ranges")
+
+        self.model_name = model_name
+        self.ndim = ndim
+        self.dtype = np.dtype(dtype)
+        self.ranges = None if ranges is None else np.asarray(ranges, np.float32)
+        self.capacity = max(1, max_bytes // (ndim * self.dtype.itemsize))
+
+        os.makedirs(cache_dir, exist_ok=True)
+        name = hashlib.sha1(model_name.encode("utf-8")).hexdigest()[:16]
+        self.vectors_path = os.path.join(cache_dir, f"{name}-{dtype}.npy")
+        self.index_path = os.path.join(cache_dir, f"{name}-{dtype}.index.json")
+        self.keys_path = os.path.join(cache_dir, f"{name}-{dtype}.keys.npy")
+        self.lock_path = os.path.join(cache_dir, f"{name}-{dtype}.lock")
+
+        # key -> row, least recently used first
+        self.slots = OrderedDict()
+        with self.locked():
+            self.vectors = open_array(
+                self.vectors_path, self.dtype, (self.capacity, ndim)
+            )
+            self.row_keys = open_array(
+                self.keys_path, np.uint8, (self.capacity, KEY_BYTES)
+            )
+            if self.vectors is None or self.row_keys is None:
+                file_logger.info("No embedding cache of this size yet, starting empty")
+                self.vectors = np.lib.format.open_memmap(
+                    self.vectors_path, "w+", self.dtype, (self.capacity, ndim)
+                )
+                self.row_keys = np.lib.format.open_memmap(
+                    self.keys_path, "w+", np.uint8, (self.capacity, KEY_BYTES)
+                )
+            elif os.path.exists(self.index_path):
+                with open(self.index_path, "r") as f:
+                    self.slots = OrderedDict(json.load(f)["slots"])
+        # Rows no key is in, popped lowest first
+        self.free_slots = sorted(
+            set(range(self.capacity)) - set(self.slots.values()), reverse=True
+        )
+
+    @contextmanager
+    def locked(self):
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def key(self, text):
+        return hashlib.sha1(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, texts):
+        """
+        Returns a (len(texts), ndim) float32 array filled in for cached texts, and
+        the positions of the texts that weren't cached.
+        """
+        embeddings = np.zeros((len(texts), self.ndim), dtype=np.float32)
+        missing = []
+        for i, text in enumerate(texts):
+            key = self.key(text)
+            slot = self.slots.get(key)
+            if slot is not None and self.row_keys[slot].tobytes() == bytes.fromhex(key):
+                self.slots.move_to_end(key)
+                embeddings[i] = self.decode(self.vectors[slot])
+            else:
+                if slot is not None:
+                    # The row was reused since the index was written
+                    del self.slots[key]
+                    self.free_slots.append(slot)
+                missing.append(i)
+
+        return embeddings, missing
+
+    def put_many(self, texts, embeddings):
+        with self.locked():
+            for text, embedding in zip(texts, embeddings):
+                key = self.key(text)
+                if key in self.slots:
+                    slot = self.slots[key]
+                    self.slots.move_to_end(key)
+                elif self.free_slots:
+                    slot = self.free_slots.pop()
+                    self.slots[key] = slot
+                else:
+                    _evicted, slot = self.slots.popitem(last=False)
+                    self.slots[key] = slot
+
+                # Until the row holds the new key, it matches no key
+                self.row_keys[slot] = 0
+                self.vectors[slot] = self.encode(embedding)
+                self.row_keys[slot] = np.frombuffer(bytes.fromhex(key), np.uint8)
+
+    def encode(self, embedding):
+        if self.dtype == np.int8:
+            starts = self.ranges[0]
+            steps = (self.ranges[1] - self.ranges[0]) / 255
+            clipped = np.clip(embedding, self.ranges[0], self.ranges[1])
+            return np.round((clipped - starts) / steps - 128).astype(np.int8)
+
+        return embedding
+
+    def decode(self, vector):
+        if self.dtype == np.int8:
+            steps = (self.ranges[1] - self.ranges[0]) / 255
+            return self.ranges[0] + (vector.astype(np.float32) + 128) * steps
+
+        return vector
+
+    def save(self):
+        with self.locked():
+            self.vectors.flush()
+            self.row_keys.flush()
+
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, "w+") as f:
+                json.dump(
+                    {
+                        "model": self.model_name,
+                        "ndim": self.ndim,
+                        "capacity": self.capacity,
+                        "slots": list(self.slots.items()),
+                    },
+                    f,
+                )
+            os.replace(tmp_path, self.index_path)
+
+    def __len__(self):
+        return len(self.slots)
+
+
+def open_array(path, dtype, shape):
+    """
+    Memory-map an existing .npy array for writing, None if it's missing or of
+    another dtype or shape.
+    """
+    if not os.path.exists(path):
+        return None
+    array = np.lib.format.open_memmap(path, mode="r+")
+    if array.dtype != dtype or array.shape != shape:
+        return None
+    return array
+
+
+def encode_with_cache(model, texts, cache=None, batch_size=256):
+    """
+    `model.encode(texts)`, only running the model on texts missing from the cache.
+    """
+    if cache is None:
+        with timed("model_inference", items=len(texts)):
+            return model.encode(texts, batch_size=batch_size)
+
+    embeddings, missing = cache.get_many(texts)
+    if missing:
+        missing_texts = [texts[i] for i in missing]
+        with timed("model_inference", items=len(missing_texts)):
+            new_embeddings = model.encode(missing_texts, batch_size=batch_size)
+        embeddings[missing] = new_embeddings
+        cache.put_many(missing_texts, new_embeddings)
+        cache.save()
+
+    file_logger.debug(f"Embedding cache hits: {len(texts) - len(missing)}/{len(texts)}")
+    return embeddings
@@ -1,48 +1,538 @@
+import argparse
 import contextlib
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from contextvars import ContextVar
+from itertools import repeat
 
+import faiss
 import numpy as np
+import pyarrow as pa
 from datasets import load_dataset
 from datasets.utils.tqdm import disable_progress_bars
-from faiss import IndexBinaryFlat, write_index_binary
+from faiss import write_index_binary
 from sentence_transformers.quantization import quantize_embeddings
 from tqdm import tqdm
 from usearch.index import Index
 
+from src.memory import get_memory_budget, profile_memory
+from workflows.ml_features.binary_index import (
+    DEFAULT_HNSW_M,
+    DEFAULT_NLIST,
+    binary_index_path,
+    build_binary_index,
+)
+
 disable_progress_bars()
 
+EMBEDDING_DATASET = "mixedbread-ai/wikipedia-embed-en-2023-11"
+
 BATCH_SIZE = 10000
-TOTAL_RECORDS = 41_500_000
+QUANTIZE_WORKERS = max(1, (os.cpu_count() or 1) - 1)
+INT8_MEMORY_BUDGET = 4 * 1024**3
+
+INT8_INDEX_PATH = "wikipedia_int8_usearch_1m.index"
+INT8_RANGES_PATH = "wikipedia_int8_ranges.npy"
+# faiss wants roughly 39+ training points per IVF list
+IVF_TRAIN_SIZE = 40 * DEFAULT_NLIST
+
+
+def load_embedding_dataset():
+    # Memory-mapped Arrow, opening it once is cheap however large it is
+    return load_dataset(EMBEDDING_DATASET, split="train")
+
+
+def embeddings_to_numpy(emb_column) -> np.ndarray:
+    """
+    Arrow list<float> column to a (rows, ndim) float32 array, without going through
+    Python lists.
+    """
+    if isinstance(emb_column, pa.ChunkedArray):
+        emb_column = emb_column.combine_chunks()
+
+    values = emb_column.flatten().to_numpy(zero_copy_only=False)
+    return values.astype(np.float32, copy=False).reshape(len(emb_column), -1)
+
+
+def iter_embedding_batches(dataset, batch_size=BATCH_SIZE, start=0, stop=None):
+    """
+    Yield (batch_start, float32 embeddings) over rows [start, stop) of the dataset.
+
+    Batches are zero-copy slices of the memory-mapped table, so the dataset is read
+    once, front to back.
+    """
+    table = dataset.with_format("arrow")
+    stop = len(dataset) if stop is None else min(stop, len(dataset))
+
+    for batch_start in range(start, stop, batch_size):
+        batch = table[batch_start : min(batch_start + batch_size, stop)]
+        yield batch_start, embeddings_to_numpy(batch.column("emb"))
+
 
+def quantize(embeddings, precision, ranges=None):
+    """
+    `quantize_embeddings`, but clipping to fixed int8 ranges first.
 
-def save_int8_index():
-    dataset = load_dataset("mixedbread-ai/wikipedia-embed-en-2023-11", split="train")
-    embeddings = np.array(dataset["emb"], dtype=np.float32)
+    Ranges from a calibration sample don't cover every row, and values outside them
+    would otherwise wrap around when cast to int8.
+    """
+    if ranges is not None and precision in ("int8", "uint8"):
+        embeddings = np.clip(embeddings, ranges[0], ranges[1])
 
-    int8_embeddings = quantize_embeddings(embeddings, "int8")
-    index = Index(ndim=1024, metric="ip", dtype="i8")
-    index.add(np.arange(len(int8_embeddings)), int8_embeddings)
-    index.save("wikipedia_int8_usearch_1m.index")
+    return quantize_embeddings(embeddings, precision, ranges=ranges)
 
 
-def save_binary_index():
-    index = IndexBinaryFlat(1024)
+def quantize_batches(batches, precision, workers=QUANTIZE_WORKERS, ranges=None):
+    """
+    Quantize embedding batches in a thread pool, yielding (batch_start, quantized)
+    in input order.
 
-    print("Loading batches into arrays for quantization")
-    print(f"Total batches: {TOTAL_RECORDS // BATCH_SIZE + 1}")
-    for i in tqdm(range(TOTAL_RECORDS // BATCH_SIZE + 1)):
-        dataset = load_dataset(
-            "mixedbread-ai/wikipedia-embed-en-2023-11",
-            split=f"train[{i * BATCH_SIZE}:{(i+1)*10000}]",
+    Up to 2 * workers batches are in flight, so reading the next batches overlaps
+    with quantizing the current ones without holding the whole dataset in memory.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for batch_start, embeddings in batches:
+            pending.append(
+                (
+                    batch_start,
+                    pool.submit(quantize, embeddings, precision, ranges=ranges),
+                )
+            )
+
+            if len(pending) >= 2 * workers:
+                done_start, future = pending.popleft()
+                yield done_start, future.result()
+
+        while pending:
+            done_start, future = pending.popleft()
+            yield done_start, future.result()
+
+
+def report_throughput(rows, elapsed):
+    print(
+        f"Indexed {rows} rows in {elapsed:.1f} s ({rows / max(elapsed, 1e-9):,.0f} rows/s)"
+    )
+
+
+def int8_batch_size(memory_budget_bytes, ndim=1024, workers=QUANTIZE_WORKERS):
+    """
+    Rows per batch so that every batch in flight fits in the memory budget.
+
+    Each in-flight row holds float32 embeddings plus their int8 copy, and
+    `quantize_batches` keeps up to 2 * workers batches in flight plus the one being
+    read. The usearch index itself is not counted, it needs ~ndim bytes per row
+    however it's built.
+    """
+    bytes_per_row = ndim * (4 + 1)
+    in_flight_batches = 2 * workers + 1
+
+    return max(1, memory_budget_bytes // (bytes_per_row * in_flight_batches))
+
+
+def compute_int8_ranges(dataset, calibration_size=None, batch_size=BATCH_SIZE):
+    """
+    Per-dimension [min, max] of the embeddings, shape (2, ndim), for int8 quantization.
+
+    Without a calibration_size this is a full streaming pass over the dataset and gives
+    exactly the ranges `quantize_embeddings` would compute over the whole matrix.
+    Otherwise it uses a seeded random sample of that many rows.
+    """
+    if calibration_size:
+        rng = np.random.default_rng(0)
+        rows = np.sort(
+            rng.choice(
+                len(dataset), size=min(calibration_size, len(dataset)), replace=False
+            )
+        )
+        table = dataset.with_format("arrow")
+        batches = (
+            embeddings_to_numpy(table[batch_rows.tolist()].column("emb"))
+            for batch_rows in np.array_split(rows, max(1, len(rows) // batch_size))
         )
-        print(f"Loaded dataset batch {i}")
-        embeddings = np.array(dataset["emb"], dtype=np.float32)
-        print(f"Embedding batch is in np array")
-        ubinary_embeddings = quantize_embeddings(embeddings, "ubinary")
+    else:
+        batches = (
+            embeddings
+            for _start, embeddings in iter_embedding_batches(dataset, batch_size)
+        )
+
+    return combine_int8_ranges(
+        np.vstack((embeddings.min(axis=0), embeddings.max(axis=0)))
+        for embeddings in tqdm(batches, desc="int8 ranges", unit="batches")
+    )
+
+
+def combine_int8_ranges(partial_ranges):
+    ranges = None
+    for batch_ranges in partial_ranges:
+        if ranges is None:
+            ranges = batch_ranges.copy()
+        else:
+            np.minimum(ranges[0], batch_ranges[0], out=ranges[0])
+            np.maximum(ranges[1], batch_ranges[1], out=ranges[1])
+
+    return ranges
+
+
+def int8_memory_budget(rows, ndim=1024):
+    """
+    Bytes for int8 batches in flight: INT8_MEMORY_BUDGET, or with
+    CLUEBASE_MEMORY_BUDGET set, what it leaves once the index's ~ndim bytes per row
+    are set aside.
+    """
+    budget = get_memory_budget()
+    if budget is None:
+        return INT8_MEMORY_BUDGET
+
+    available = budget.headroom() - rows * ndim
+    if available <= 0:
+        raise MemoryError(
+            f"An int8 index of {rows} rows needs {rows * ndim} bytes, more than the "
+            f"{budget.headroom()} left in the memory budget"
+        )
+    return available
+
+
+def save_int8_index(
+    calibration_size=None,
+    memory_budget_bytes=None,
+    staging_path=None,
+    workers=QUANTIZE_WORKERS,
+    ndim=1024,
+):
+    """
+    Build the int8 usearch index batch by batch, never holding all embeddings at once.
+
+    Quantization ranges come from a first streaming pass (or a calibration sample) and
+    are saved next to the index so later int8 vectors can be quantized consistently.
+    With a staging_path, the int8 vectors are first written to a numpy memmap and
+    added to the index from there.
+    """
+    dataset = load_embedding_dataset()
+    if memory_budget_bytes is None:
+        memory_budget_bytes = int8_memory_budget(len(dataset), ndim)
+    batch_size = int8_batch_size(memory_budget_bytes, ndim, workers)
+    print(f"Using batches of {batch_size} rows for a {memory_budget_bytes} byte budget")
+
+    ranges = compute_int8_ranges(dataset, calibration_size, batch_size)
+    np.save(INT8_RANGES_PATH, ranges)
+
+    batches = quantize_batches(
+        iter_embedding_batches(dataset, batch_size), "int8", workers, ranges=ranges
+    )
+
+    if staging_path:
+        staged = np.lib.format.open_memmap(
+            staging_path, mode="w+", dtype=np.int8, shape=(len(dataset), ndim)
+        )
+        for batch_start, int8_embeddings in tqdm(
+            batches, desc="staging", unit="batches"
+        ):
+            staged[batch_start : batch_start + len(int8_embeddings)] = int8_embeddings
+        staged.flush()
+
+        batches = (
+            (batch_start, staged[batch_start : batch_start + batch_size])
+            for batch_start in range(0, len(dataset), batch_size)
+        )
+
+    index = Index(ndim=ndim, metric="ip", dtype="i8")
+
+    start_time = time.time()
+    with profile_memory("save_int8_index") as profile, tqdm(
+        total=len(dataset), unit="rows", unit_scale=True
+    ) as progress:
+        for batch_start, int8_embeddings in batches:
+            index.add(
+                np.arange(batch_start, batch_start + len(int8_embeddings)),
+                int8_embeddings,
+            )
+            progress.update(len(int8_embeddings))
+            if batch_start == 0:
+                profile.checkpoint()
+    report_throughput(len(index), time.time() - start_time)
+
+    index.save(INT8_INDEX_PATH)
+
+
+def save_binary_index(
+    index_type="flat",
+    nlist=DEFAULT_NLIST,
+    hnsw_m=DEFAULT_HNSW_M,
+    train_size=IVF_TRAIN_SIZE,
+    batch_size=BATCH_SIZE,
+    workers=QUANTIZE_WORKERS,
+):
+    dataset = load_embedding_dataset()
+
+    train_embeddings = None
+    if index_type == "ivf":
+        print(f"Quantizing {train_size} embeddings to train IVF centroids")
+        train_rows = dataset.with_format("arrow")[:train_size]
+        train_embeddings = quantize_embeddings(
+            embeddings_to_numpy(train_rows.column("emb")), "ubinary"
+        )
+
+    index = build_binary_index(
+        index_type, nlist=nlist, hnsw_m=hnsw_m, train_embeddings=train_embeddings
+    )
+
+    print(f"Streaming {len(dataset)} embeddings in batches of {batch_size}")
+    start_time = time.time()
+    with tqdm(total=len(dataset), unit="rows", unit_scale=True) as progress:
+        for _batch_start, ubinary_embeddings in quantize_batches(
+            iter_embedding_batches(dataset, batch_size), "ubinary", workers=workers
+        ):
+            index.add(ubinary_embeddings)
+            progress.update(len(ubinary_embeddings))
+    report_throughput(index.ntotal, time.time() - start_time)
+
+    write_index_binary(index, binary_index_path(index_type))
+
+
+# *****************************************************
+# Sharded builds
+# *****************************************************
+#
+# Row ranges are built in parallel processes, each writing its own partial file
+# next to the final index. A shard whose file exists is done, so a failed shard can
+# be rebuilt on its own, and the merge runs once every shard file is present.
+# Binary shards are flat faiss indices merged by concatenating their codes in shard
+# order. Int8 shards are quantized .npy blocks, added to the one usearch index in
+# shard order during the merge (usearch parallelizes that add itself).
+
+
+def shard_bounds(total_rows, num_shards, shard):
+    rows_per_shard = -(-total_rows // num_shards)
+    start = shard * rows_per_shard
+    return start, min(start + rows_per_shard, total_rows)
+
+
+def shard_path(index_path, shard, num_shards):
+    return f"{index_path}.shard-{shard:05d}-of-{num_shards:05d}"
+
+
+def int8_shard_path(shard, num_shards):
+    return shard_path(INT8_INDEX_PATH, shard, num_shards) + ".npy"
+
+
+def shard_output_path(kind, shard, num_shards):
+    if kind == "binary":
+        return shard_path(binary_index_path("flat"), shard, num_shards)
+
+    return int8_shard_path(shard, num_shards)
+
+
+def build_binary_shard(shard, num_shards, batch_size=BATCH_SIZE):
+    dataset = load_embedding_dataset()
+    start, stop = shard_bounds(len(dataset), num_shards, shard)
+
+    index = build_binary_index("flat")
+    for _batch_start, ubinary_embeddings in quantize_batches(
+        iter_embedding_batches(dataset, batch_size, start, stop), "ubinary", workers=1
+    ):
         index.add(ubinary_embeddings)
 
-    write_index_binary(index, "wikipedia_ubinary_faiss_1m.index")
+    path = shard_output_path("binary", shard, num_shards)
+    write_index_binary(index, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+    print(f"Wrote shard {shard} (rows {start}:{stop}) to {path}")
+    return path
+
+
+def compute_int8_shard_ranges(shard, num_shards, batch_size=BATCH_SIZE):
+    dataset = load_embedding_dataset()
+    start, stop = shard_bounds(len(dataset), num_shards, shard)
+
+    return combine_int8_ranges(
+        np.vstack((embeddings.min(axis=0), embeddings.max(axis=0)))
+        for _batch_start, embeddings in iter_embedding_batches(
+            dataset, batch_size, start, stop
+        )
+    )
+
+
+def build_int8_shard(shard, num_shards, batch_size=BATCH_SIZE):
+    ranges = np.load(INT8_RANGES_PATH)
+    dataset = load_embedding_dataset()
+    start, stop = shard_bounds(len(dataset), num_shards, shard)
+
+    path = shard_output_path("int8", shard, num_shards)
+    # open_memmap only appends .npy when it's missing, so keep it on the temp name
+    tmp_path = f"{path}.tmp.npy"
+    staged = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype=np.int8, shape=(stop - start, ranges.shape[1])
+    )
+    for batch_start, int8_embeddings in quantize_batches(
+        iter_embedding_batches(dataset, batch_size, start, stop),
+        "int8",
+        workers=1,
+        ranges=ranges,
+    ):
+        offset = batch_start - start
+        staged[offset : offset + len(int8_embeddings)] = int8_embeddings
+    staged.flush()
+    del staged
+
+    os.replace(tmp_path, path)
+    print(f"Wrote shard {shard} (rows {start}:{stop}) to {path}")
+    return path
+
+
+def merge_binary_shards(num_shards, chunk_rows=1_000_000):
+    index = build_binary_index("flat")
+
+    for shard in tqdm(range(num_shards), desc="merging", unit="shards"):
+        shard_index = faiss.read_index_binary(
+            shard_output_path("binary", shard, num_shards),
+            getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+            | faiss.IO_FLAG_READ_ONLY,
+        )
+        for start in range(0, shard_index.ntotal, chunk_rows):
+            index.add(
+                shard_index.reconstruct_n(
+                    start, min(chunk_rows, shard_index.ntotal - start)
+                )
+            )
+
+    write_index_binary(index, binary_index_path("flat"))
+    return index.ntotal
+
+
+def merge_int8_shards(num_shards, total_rows, batch_size=BATCH_SIZE):
+    index = None
+
+    for shard in tqdm(range(num_shards), desc="merging", unit="shards"):
+        start, _stop = shard_bounds(total_rows, num_shards, shard)
+        staged = np.load(shard_output_path("int8", shard, num_shards), mmap_mode="r")
+        if index is None:
+            index = Index(ndim=staged.shape[1], metric="ip", dtype="i8")
+
+        for offset in range(0, len(staged), batch_size):
+            int8_embeddings = staged[offset : offset + batch_size]
+            index.add(
+                np.arange(start + offset, start + offset + len(int8_embeddings)),
+                int8_embeddings,
+            )
+
+    index.save(INT8_INDEX_PATH)
+    return len(index)
+
+
+def save_sharded_index(
+    kind="binary",
+    num_shards=16,
+    processes=None,
+    shards=None,
+    overwrite=False,
+    calibration_size=None,
+    batch_size=BATCH_SIZE,
+):
+    """
+    Build the flat binary ("binary") or int8 usearch ("int8") index from row-range
+    shards built in parallel processes, then merge them in shard order.
+
+    Pass `shards` to (re)build only those shards, e.g. one that failed.
+    """
+    if kind not in ("binary", "int8"):
+        raise ValueError(f"Unknown sharded index kind {kind}")
+
+    shards = range(num_shards) if shards is None else shards
+    todo = [
+        shard
+        for shard in shards
+        if overwrite or not os.path.exists(shard_output_path(kind, shard, num_shards))
+    ]
+    build_shard = build_binary_shard if kind == "binary" else build_int8_shard
+    total_rows = len(load_embedding_dataset())
+
+    start_time = time.time()
+    # spawn rather than fork, faiss and usearch thread pools don't survive a fork
+    with ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        if kind == "int8" and (overwrite or not os.path.exists(INT8_RANGES_PATH)):
+            # Every shard has to quantize with the same ranges
+            if calibration_size:
+                ranges = compute_int8_ranges(
+                    load_embedding_dataset(), calibration_size, batch_size
+                )
+            else:
+                ranges = combine_int8_ranges(
+                    pool.map(
+                        compute_int8_shard_ranges,
+                        range(num_shards),
+                        repeat(num_shards),
+                        repeat(batch_size),
+                    )
+                )
+            np.save(INT8_RANGES_PATH, ranges)
+
+        print(f"Building {len(todo)} of {num_shards} {kind} shards")
+        for path in pool.map(build_shard, todo, repeat(num_shards), repeat(batch_size)):
+            print(f"Finished {path}")
+    report_throughput(
+        sum(
+            shard_bounds(total_rows, num_shards, shard)[1]
+            - shard_bounds(total_rows, num_shards, shard)[0]
+            for shard in todo
+        ),
+        time.time() - start_time,
+    )
+
+    missing = [
+        shard
+        for shard in range(num_shards)
+        if not os.path.exists(shard_output_path(kind, shard, num_shards))
+    ]
+    if missing:
+        print(f"Not merging, shards still missing: {missing}")
+        return None
+
+    if kind == "binary":
+        return merge_binary_shards(num_shards)
+
+    return merge_int8_shards(num_shards, total_rows, batch_size)
 
 
 if __name__ == "__main__":
-    save_binary_index()
+    parser = argparse.ArgumentParser(description="Build the wikipedia search indices")
+    parser.add_argument("kind", choices=["binary", "int8"])
+    parser.add_argument("--index-type", default="flat", help="binary index type")
+    parser.add_argument("--calibration-size", type=int)
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        help="Bytes for int8 batches in flight, by default from CLUEBASE_MEMORY_BUDGET",
+    )
+    parser.add_argument("--staging-path")
+    parser.add_argument(
+        "--num-shards", type=int, help="Build from this many shards in parallel"
+    )
+    parser.add_argument("--processes", type=int)
+    parser.add_argument(
+        "--shard", type=int, nargs="+", help="Only (re)build these shards"
+    )
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    if args.num_shards:
+        save_sharded_index(
+            args.kind,
+            args.num_shards,
+            processes=args.processes,
+            shards=args.shard,
+            overwrite=args.overwrite,
+            calibration_size=args.calibration_size,
+        )
+    elif args.kind == "binary":
+        save_binary_index(args.index_type)
+    else:
+        save_int8_index(
+            calibration_size=args.calibration_size,
+            memory_budget_bytes=args.memory_budget,
+            staging_path=args.staging_path,
+        )
@@ -0,0 +1,229 @@
+"""
+Resident relevant-link search service.
+
+Loads the embedding model and the int8/binary indices once, then answers batched
+search requests over HTTP for as long as the process lives, so flows don't pay the
+download and load cost on every run.
+
+Run with `python -m workflows.ml_features.search_service --port 8765`, then point
+`add_relevant_links` at it with `search_service_url="http://localhost:8765"`.
+"""
+
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+import requests
+
+file_logger = getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+def search_remote(
+    queries,
+    service_url,
+    top_k: int = 100,
+    rescore_multiplier: int = 1,
+    timeout: float = 600,
+    query_embeddings=None,
+):
+    """
+    Client side of the search service. Same return shape as `search_batch`.
+    """
+    request = {
+        "queries": list(queries),
+        "top_k": top_k,
+        "rescore_multiplier": rescore_multiplier,
+    }
+    if query_embeddings is not None:
+        request["query_embeddings"] = query_embeddings.tolist()
+
+    r = requests.post(
+        f"{service_url.rstrip('/')}/search", json=request, timeout=timeout
+    )
+    if not r.ok:
+        try:
+            error = r.json()["error"]
+        except (ValueError, KeyError):
+            error = r.text
+        raise RuntimeError(f"Search service returned {r.status_code}: {error}")
+    body = r.json()
+
+    return [pd.DataFrame(result) for result in body["results"]], body["timings"]
+
+
+def parse_search_request(request):
+    """
+    search_fn kwargs from a request body, raising ValueError, KeyError or TypeError
+    when it's malformed.
+    """
+    if not isinstance(request, dict):
+        raise TypeError("expected a JSON object")
+
+    queries = request["queries"]
+    if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+        raise TypeError("queries must be a list of strings")
+
+    top_k = int(request.get("top_k", 100))
+    rescore_multiplier = int(request.get("rescore_multiplier", 1))
+    if top_k < 1 or rescore_multiplier < 1:
+        raise ValueError("top_k and rescore_multiplier must be at least 1")
+
+    query_embeddings = request.get("query_embeddings")
+    if query_embeddings is not None:
+        query_embeddings = np.array(query_embeddings, dtype=np.float32)
+        if query_embeddings.ndim != 2 or len(query_embeddings) != len(queries):
+            raise ValueError("query_embeddings must have one row per query")
+
+    return {
+        "queries": queries,
+        "top_k": top_k,
+        "rescore_multiplier": rescore_multiplier,
+        "query_embeddings": query_embeddings,
+    }
+
+
+def build_handler(search_fn):
+    # one query batch at a time, the model and index already use every core
+    search_lock = threading.Lock()
+
+    class SearchHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/health":
+                self.send_error(404)
+                return
+
+            self._send_json({"status": "ok"})
+
+        def do_POST(self):
+            if self.path != "/search":
+                self.send_error(404)
+                return
+
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = parse_search_request(json.loads(self.rfile.read(length)))
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json({"error": f"Bad search request: {e!r}"}, status=400)
+                return
+
+            try:
+                with search_lock:
+                    results, timings = search_fn(**request)
+            except Exception as e:
+                file_logger.exception("Search failed")
+                self._send_json({"error": f"Search failed: {e!r}"}, status=500)
+                return
+
+            self._send_json(
+                {
+                    "results": [df.to_dict(orient="list") for df in results],
+                    "timings": timings,
+                }
+            )
+
+        def _send_json(self, body, status=200):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            file_logger.debug(format % args)
+
+    return SearchHandler
+
+
+def serve(
+    host=DEFAULT_HOST,
+    port=DEFAULT_PORT,
+    bucket_name="cluebase",
+    download=True,
+    binary_index_type="flat",
+    nprobe=None,
+    ef_search=None,
+    embedding_cache_dir=None,
+):
+    # Imported here so that flows only using the client don't load the ML stack
+    from workflows.ml_features.add_relevant_links import (
+        EMBEDDING_MODEL,
+        download_indices,
+        load_model_and_indices,
+        search_batch,
+    )
+    from workflows.ml_features.embedding_cache import EmbeddingCache
+
+    if download:
+        file_logger.info("Downloading indices")
+        download_indices.fn(bucket_name, binary_index_type=binary_index_type)
+
+    file_logger.info("Loading model and indices")
+    title_text_dataset, model, int8_view, binary_index = load_model_and_indices.fn(
+        binary_index_type, nprobe=nprobe, ef_search=ef_search
+    )
+
+    embedding_cache = (
+        EmbeddingCache(embedding_cache_dir, EMBEDDING_MODEL)
+        if embedding_cache_dir
+        else None
+    )
+
+    def search_fn(queries, top_k, rescore_multiplier, query_embeddings=None):
+        return search_batch(
+            queries,
+            title_text_dataset,
+            model,
+            int8_view,
+            binary_index,
+            top_k=top_k,
+            rescore_multiplier=rescore_multiplier,
+            embedding_cache=embedding_cache,
+            query_embeddings=query_embeddings,
+        )
+
+    server = ThreadingHTTPServer((host, port), build_handler(search_fn))
+    file_logger.info(f"Serving relevant-link search on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    import logging
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--bucket-name", default="cluebase")
+    parser.add_argument(
+        "--no-download",
+        action="store_true",
+        help="Use index files already in the working directory",
+    )
+    parser.add_argument("--binary-index-type", default="flat")
+    parser.add_argument("--nprobe", type=int)
+    parser.add_argument("--ef-search", type=int)
+    parser.add_argument("--embedding-cache-dir")
+    args = parser.parse_args()
+
+    serve(
+        args.host,
+        args.port,
+        args.bucket_name,
+        download=not args.no_download,
+        binary_index_type=args.binary_index_type,
+        nprobe=args.nprobe,
+        ef_search=args.ef_search,
+        embedding_cache_dir=args.embedding_cache_dir,
+    )
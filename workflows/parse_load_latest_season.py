@@ -1,17 +1,57 @@
 from prefect import flow
+from prefect.logging import get_run_logger
 
+from src.metrics import publish_stage_metrics
+from workflows.dedup_clues import dedup_clues
 from workflows.load_to_mongo.load_clues_set import load_clues_from_set_s3
 
 # from workflows.ml_features.classify_domain import classify_domains
-from workflows.scrape.refresh_latest_season import refresh_latest_season
+from workflows.scrape.refresh_latest_season import (
+    read_latest_season_game_ids,
+    refresh_latest_season,
+)
 
 
 @flow
+@publish_stage_metrics
 def parse_and_load_latest_season(
-    bucket_name="cluebase", s3_games_path="raw/games", overwrite: bool = True
+    bucket_name="cluebase",
+    s3_games_path="raw/games",
+    overwrite: bool = True,
+    full_reconcile: bool = False,
 ):
-    game_ids = refresh_latest_season(bucket_name, overwrite)
+    """
+    Refresh the latest season and load the games that were new or changed. Changed
+    games have their clues in Mongo updated to match.
 
-    load_clues_from_set_s3(game_ids, bucket_name, s3_games_path)
+    full_reconcile also loads the rest of the season's games, for catching up after
+    failed runs. Their clues already in Mongo are skipped as duplicates.
+    """
+    logger = get_run_logger()
+
+    changed_game_ids = refresh_latest_season(bucket_name, overwrite)
+
+    other_game_ids = []
+    if full_reconcile:
+        changed = set(changed_game_ids)
+        other_game_ids = [
+            game_id
+            for game_id in read_latest_season_game_ids(bucket_name)
+            if game_id not in changed
+        ]
+
+    logger.info(
+        f"{len(changed_game_ids)} new or changed games, loading "
+        f"{len(changed_game_ids) + len(other_game_ids)} games"
+    )
+    if changed_game_ids:
+        # Inserts would skip the clues of changed games as duplicates
+        load_clues_from_set_s3(
+            changed_game_ids, bucket_name, s3_games_path, replace=True
+        )
+    if other_game_ids:
+        load_clues_from_set_s3(other_game_ids, bucket_name, s3_games_path)
+    if changed_game_ids or other_game_ids:
+        dedup_clues(bucket_name)
 
     # classify_domains()
@@ -0,0 +1,388 @@
+"""
+Backfill that crawls, parses and loads games as one pipeline.
+
+refresh_all only crawls, and loading is a separate deployment, so no clue reaches
+Mongo until the whole crawl is done. Here each game page moves on as soon as it's
+fetched:
+
+    crawl / read from s3  -> parse_queue ->  parse workers  -> load_queue ->  loader
+
+The queues are bounded, so a slow stage holds back the ones before it instead of
+buffering the archive in memory. With a memory budget (see src/memory.py), readers
+and parsers also wait for the stages after them when RSS nears it. The loader
+inserts whatever has queued up whenever it catches up, so batches stay small while
+the crawl is the bottleneck. Parse workers also BSON-encode each game's clues, so
+the event loop only ships bytes to Mongo.
+
+With overwrite, pages of games already in Mongo are crawled again: unchanged pages
+go no further, and changed ones replace their game's clues instead of being
+inserted.
+"""
+
+import asyncio
+import os
+import random
+from logging import getLogger
+
+import pymongo
+from prefect import flow, task
+from prefect.blocks.system import Secret
+from prefect.logging import get_run_logger
+
+from src.async_s3 import async_s3_client
+from src.clues import parse_and_encode_clues
+from src.io_utils import (
+    get_loaded_game_ids,
+    get_mongo_client,
+    get_s3_bucket,
+    insert_clue_bulk,
+    ls_s3,
+    object_exists,
+    quarantine_game,
+    read_s3_object_async,
+    release_quarantined_games,
+    replace_game_clues,
+)
+from src.memory import get_memory_budget, profile_memory
+from src.metrics import publish_stage_metrics
+from src.paths import RAW_GAMES_DIR
+from src.scrape_raw import fetch_game_page_to_s3, parse_all_game_ids_from_s3
+from src.text_index import index_loaded_clues, loaded_clues
+from workflows.scrape.shared import refresh_all_seasons, refresh_season_list
+
+file_logger = getLogger(__name__)
+
+PARSE_QUEUE_SIZE = 64
+LOAD_QUEUE_SIZE = 64
+PARSE_WORKERS = 4
+# Concurrent reads of game pages that are already in s3
+READ_WORKERS = 16
+LOAD_BATCH_SIZE = 5000
+# Loaded clues per text index segment, batches are too small while crawling
+INDEX_SEGMENT_SIZE = 50_000
+
+
+@flow
+@publish_stage_metrics
+def refresh_and_load_all(
+    bucket_name="cluebase",
+    overwrite: bool = False,
+    load_existing: bool = True,
+    sleep="random",
+    mongo_secret_block="mongo-connection-string",
+    database_name="cluebase",
+):
+    """
+    Refresh the season pages, then crawl every game page and load its clues as it
+    arrives. Game pages already in s3 are only re-downloaded with overwrite, and
+    are loaded straight from s3 with load_existing, unless their clues are already
+    in Mongo. Re-downloaded pages of games in Mongo replace their clues if the page
+    changed.
+    """
+    logger = get_run_logger()
+
+    refresh_season_list(bucket_name, overwrite=True, logger=logger)
+    refresh_all_seasons(bucket_name, overwrite=True, sleep=sleep, logger=logger)
+    # The cached listing of the seasons dir predates the pages just refreshed
+    ls_s3.cache_clear()
+
+    crawl_ids, read_ids = plan_games(bucket_name, overwrite, load_existing)
+
+    return asyncio.run(
+        crawl_parse_load(
+            crawl_ids,
+            read_ids,
+            bucket_name,
+            sleep,
+            mongo_secret_block,
+            database_name,
+        )
+    )
+
+
+@task
+def plan_games(
+    bucket_name="cluebase", overwrite=False, load_existing=True, games_dir=RAW_GAMES_DIR
+):
+    """
+    Split every game id into the games to crawl and the games to read from s3.
+    """
+    logger = get_run_logger()
+    bucket = get_s3_bucket(bucket_name)
+
+    game_ids = list(dict.fromkeys(parse_all_game_ids_from_s3(bucket, logger=logger)))
+    exists = {
+        game_id: object_exists(bucket, os.path.join(games_dir, f"{game_id}.html"))
+        for game_id in game_ids
+    }
+    crawl_ids = [game_id for game_id in game_ids if overwrite or not exists[game_id]]
+    read_ids = [
+        game_id
+        for game_id in game_ids
+        if exists[game_id] and not overwrite and load_existing
+    ]
+    logger.info(
+        f"{len(game_ids)} games: crawling {len(crawl_ids)}, "
+        f"loading {len(read_ids)} from s3"
+    )
+
+    return crawl_ids, read_ids
+
+
+@task
+async def crawl_parse_load(
+    crawl_ids,
+    read_ids,
+    bucket_name="cluebase",
+    sleep="random",
+    mongo_secret_block="mongo-connection-string",
+    database_name="cluebase",
+    games_dir=RAW_GAMES_DIR,
+    parse_workers=PARSE_WORKERS,
+    load_batch_size=LOAD_BATCH_SIZE,
+):
+    logger = get_run_logger()
+    bucket = get_s3_bucket(bucket_name)
+
+    logger.info(f"Getting Mongo connection using secret block {mongo_secret_block}")
+    mongo_conn_str = (await Secret.load(mongo_secret_block)).get()
+    mongo_client = await get_mongo_client(mongo_conn_str)
+    db = mongo_client.get_database(database_name)
+
+    # Reruns only read the games that aren't loaded yet, instead of re-inserting
+    # every clue as a duplicate
+    loaded_game_ids = await get_loaded_game_ids(db)
+    read_ids = [game_id for game_id in read_ids if game_id not in loaded_game_ids]
+    logger.info(f"Reading {len(read_ids)} games from s3 that aren't loaded yet")
+
+    parse_queue = asyncio.Queue(PARSE_QUEUE_SIZE)
+    load_queue = asyncio.Queue(LOAD_QUEUE_SIZE)
+    progress = {
+        "crawled": 0,
+        "unchanged": 0,
+        "read": 0,
+        "parsed": 0,
+        "quarantined": 0,
+        "loaded": 0,
+        "replaced": 0,
+    }
+    budget = get_memory_budget()
+
+    async def fetch_stage():
+        read_iter = iter(read_ids)
+        await asyncio.gather(
+            crawl_games(
+                crawl_ids,
+                bucket,
+                parse_queue,
+                progress,
+                sleep,
+                logger,
+                loaded_game_ids,
+            ),
+            *[
+                read_games(
+                    read_iter,
+                    bucket,
+                    games_dir,
+                    db,
+                    parse_queue,
+                    progress,
+                    logger,
+                    budget,
+                    downstream=(parse_queue, load_queue),
+                )
+                for _ in range(READ_WORKERS)
+            ],
+        )
+        for _ in range(parse_workers):
+            await parse_queue.put(None)
+
+    async def parse_stage():
+        await asyncio.gather(
+            *[
+                parse_games(parse_queue, load_queue, db, progress, logger, budget)
+                for _ in range(parse_workers)
+            ]
+        )
+        await load_queue.put(None)
+
+    with profile_memory("crawl_parse_load", logger=logger):
+        async with async_s3_client(bucket.credentials):
+            # If any stage fails, the error propagates and asyncio.run cancels the rest
+            await asyncio.gather(
+                fetch_stage(),
+                parse_stage(),
+                load_clues(db, bucket, load_queue, progress, load_batch_size, logger),
+            )
+
+    logger.info(f"Done: {progress}")
+    return progress
+
+
+async def crawl_games(
+    game_ids, bucket, parse_queue, progress, sleep, logger, loaded_game_ids=()
+):
+    """
+    Fetch the games' pages. Pages of loaded games go on to replace their clues if
+    they changed, and no further if they didn't.
+    """
+    for game_id in game_ids:
+        html, path = await asyncio.to_thread(
+            fetch_game_page_to_s3, game_id, bucket, logger=logger
+        )
+        if html is None:
+            continue
+
+        progress["crawled"] += 1
+        replace = game_id in loaded_game_ids
+        if replace and path is None:
+            progress["unchanged"] += 1
+        else:
+            await parse_queue.put((game_id, html, replace))
+
+        await asyncio.sleep(random.uniform(0.2, 2.0) if sleep == "random" else sleep)
+
+
+async def read_games(
+    game_ids,
+    bucket,
+    games_dir,
+    db,
+    parse_queue,
+    progress,
+    logger=file_logger,
+    budget=None,
+    downstream=(),
+):
+    # game_ids is an iterator shared by all the readers
+    for game_id in game_ids:
+        await wait_for_memory(budget, downstream, logger)
+        s3_path = os.path.join(games_dir, f"{game_id}.html")
+        try:
+            html = await read_s3_object_async(bucket, s3_path)
+        except Exception as e:
+            logger.error(f"Quarantining game {game_id}: {e!r}")
+            await quarantine_game(db, game_id, e, s3_path)
+            progress["quarantined"] += 1
+            continue
+
+        progress["read"] += 1
+        await parse_queue.put((game_id, html, False))
+
+
+async def parse_games(
+    parse_queue, load_queue, db, progress, logger=file_logger, budget=None
+):
+    while (item := await parse_queue.get()) is not None:
+        await wait_for_memory(budget, (load_queue,), logger)
+        game_id, html, replace = item
+        try:
+            # In a thread so the event loop keeps fetching and loading meanwhile
+            clues, documents = await asyncio.to_thread(
+                parse_and_encode_clues, html, game_id
+            )
+        except Exception as e:
+            logger.error(f"Quarantining game {game_id}: {e!r}")
+            await quarantine_game(db, game_id, e)
+            progress["quarantined"] += 1
+            continue
+
+        progress["parsed"] += 1
+        await load_queue.put((game_id, clues, documents, replace))
+
+
+async def wait_for_memory(budget, downstream, logger=file_logger):
+    """
+    Over the memory budget, hold off taking on more pages while the stages after
+    this one still have pages queued up to work through.
+    """
+    if budget is not None:
+        await budget.wait_for_headroom(
+            draining=lambda: any(not queue.empty() for queue in downstream),
+            logger=logger,
+        )
+
+
+async def load_clues(db, bucket, load_queue, progress, batch_size, logger=file_logger):
+    """
+    Insert new games' clues, and replace the clues of loaded games whose page
+    changed, in separate batches.
+    """
+    batch = []
+    batch_documents = []
+    batch_game_ids = []
+    replace_batch = []
+    replace_game_ids = []
+    to_index = []
+    to_delete = []
+    while True:
+        item = await load_queue.get()
+        if item is not None:
+            game_id, clues, documents, replace = item
+            if replace:
+                replace_batch += clues
+                replace_game_ids.append(game_id)
+            else:
+                batch += clues
+                batch_documents += documents
+                batch_game_ids.append(game_id)
+
+        # Write once the loader has caught up, or the batch is full
+        if (batch_game_ids or replace_game_ids) and (
+            item is None
+            or load_queue.empty()
+            or len(batch) + len(replace_batch) >= batch_size
+        ):
+            if batch:
+                inserted = await insert_batch(db, batch, batch_documents, logger)
+                progress["loaded"] += len(inserted)
+                to_index += inserted
+            if replace_game_ids:
+                clue_ids, deleted_ids = await replace_game_clues(
+                    db, replace_game_ids, replace_batch
+                )
+                progress["loaded"] += len(clue_ids)
+                progress["replaced"] += len(replace_game_ids)
+                to_index += replace_batch
+                to_delete += deleted_ids
+            await release_quarantined_games(db, batch_game_ids + replace_game_ids)
+            batch = []
+            batch_documents = []
+            batch_game_ids = []
+            replace_batch = []
+            replace_game_ids = []
+            logger.info(f"Progress: {progress}")
+
+        if (to_index or to_delete) and (
+            item is None or len(to_index) >= INDEX_SEGMENT_SIZE
+        ):
+            await asyncio.to_thread(
+                index_loaded_clues,
+                bucket,
+                to_index,
+                deleted_ids=to_delete,
+                logger=logger,
+            )
+            to_index = []
+            to_delete = []
+
+        if item is None:
+            return progress["loaded"]
+
+
+async def insert_batch(db, clues, documents=None, logger=file_logger):
+    """
+    Insert the clues, or their encoded documents where given, returning the clues
+    that were inserted.
+    """
+    try:
+        await insert_clue_bulk(db, clues, documents)
+        return clues
+    except pymongo.errors.BulkWriteError as e:
+        write_errors = e.details["writeErrors"]
+        logger.warning(
+            f"{len(write_errors)} of {len(clues)} clues not loaded, first error: "
+            f"{write_errors[0]['errmsg'] if write_errors else e}"
+        )
+        return loaded_clues(clues, e)
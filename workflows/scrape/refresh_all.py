@@ -1,6 +1,7 @@
 from prefect import flow
 from prefect.logging import get_run_logger
 
+from src.metrics import publish_stage_metrics
 from workflows.scrape.shared import (
     refresh_all_games,
     refresh_all_seasons,
@@ -9,6 +10,7 @@ from workflows.scrape.shared import (
 
 
 @flow
+@publish_stage_metrics
 def refresh_all(bucket_name="cluebase", overwrite: bool = True):
     if bucket_name:
         print("Refreshing files in bucket: {cluebase}")
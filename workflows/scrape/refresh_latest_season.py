@@ -2,12 +2,18 @@ from prefect import flow, task
 from prefect.logging import get_run_logger
 
 from src.io_utils import get_s3_bucket, read_s3_object
-from src.paths import RAW_LIST_SEASONS
-from src.scrape_raw import download_season_page_to_s3, parse_season_ids
+from src.metrics import publish_stage_metrics
+from src.paths import RAW_LIST_SEASONS, RAW_SEASONS_DIR
+from src.scrape_raw import (
+    download_season_page_to_s3,
+    parse_game_ids,
+    parse_season_ids,
+)
 from workflows.scrape.shared import refresh_games, refresh_season_list
 
 
 @flow
+@publish_stage_metrics
 def refresh_latest_season(bucket_name="cluebase", overwrite: bool = True):
     if bucket_name:
         print("Refreshing files in bucket: {cluebase}")
@@ -18,11 +24,11 @@ def refresh_latest_season(bucket_name="cluebase", overwrite: bool = True):
 
     latest_season = download_latest_season(bucket_name)
 
-    game_ids = refresh_games(
+    changed_game_ids = refresh_games(
         latest_season, bucket_name, overwrite=overwrite, logger=prefect_logger
     )
 
-    return game_ids
+    return changed_game_ids
 
 
 @task
@@ -38,3 +44,16 @@ def download_latest_season(bucket_name="cluebase", list_seasons_path=RAW_LIST_SE
     download_season_page_to_s3(recent_season_id, bucket, overwrite=True)
 
     return recent_season_id
+
+
+@task
+def read_latest_season_game_ids(
+    bucket_name="cluebase", list_seasons_path=RAW_LIST_SEASONS
+):
+    bucket = get_s3_bucket(bucket_name)
+    list_seasons_html = read_s3_object(bucket, list_seasons_path)
+    recent_season_id = parse_season_ids(list_seasons_html)[0]
+
+    season_html = read_s3_object(bucket, f"{RAW_SEASONS_DIR}/{recent_season_id}.html")
+
+    return parse_game_ids(season_html)
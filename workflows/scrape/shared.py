@@ -76,9 +76,16 @@ def refresh_all_seasons(
 
 @task
 def refresh_games(
-    season_id, s3_bucket_name="cluebase", overwrite=False, logger=file_logger
+    season_id,
+    s3_bucket_name="cluebase",
+    overwrite=False,
+    sleep="random",
+    logger=file_logger,
 ):
-
+    """
+    Download a season's game pages, returning the ids of the games that were new or
+    whose page changed.
+    """
     bucket = get_s3_bucket(bucket_name=s3_bucket_name)
 
     season_s3_path = f"{RAW_SEASONS_DIR}/{season_id}.html"
@@ -92,19 +99,25 @@ def refresh_games(
     logger.debug(game_ids)
 
     skipped = 0
-    downloaded = 0
+    changed_game_ids = []
     for game_id in tqdm(game_ids):
         success = download_game_page_to_s3(
             game_id, bucket, overwrite=overwrite, logger=logger
         )
         if success:
-            downloaded += 1
-            time.sleep(random.uniform(0.2, 2.0))
+            changed_game_ids.append(game_id)
+            if sleep == "random":
+                time.sleep(random.uniform(0.2, 2.0))
+            else:
+                time.sleep(sleep)
         else:
             skipped += 1
 
-    logger.info(f"Downloaded {downloaded} games, skipped {skipped} games")
-    return game_ids
+    logger.info(
+        f"Downloaded {len(changed_game_ids)} new or changed games, "
+        f"skipped {skipped} games"
+    )
+    return changed_game_ids
 
 
 @task
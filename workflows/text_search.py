@@ -0,0 +1,164 @@
+"""
+Flows for the keyword search index in src/text_index.py.
+
+The load flows add a segment per load, so the index grows a segment at a time;
+compact_text_index merges them back into one so searches don't scan hundreds of
+small segments, or with rebuild, indexes the whole clues collection from scratch.
+Compaction also drops the clues queued as deleted in clue_changes, in case a load
+failed to write their tombstones.
+"""
+
+from logging import getLogger
+
+from prefect import flow, task
+from prefect.blocks.system import Secret
+from prefect.logging import get_run_logger
+from pymongo import MongoClient
+
+from src.io_utils import ack_clue_changes, get_s3_bucket, pending_clue_changes
+from src.metrics import publish_stage_metrics, timed
+from src.text_index import (
+    INDEXED_FIELDS,
+    TEXT_INDEX_DIR,
+    TEXT_INDEX_S3_PREFIX,
+    Segment,
+    download_text_index,
+    list_text_index_segments,
+    merge_segments,
+    new_segment_name,
+    upload_text_index_segment,
+)
+
+file_logger = getLogger(__name__)
+
+# DeleteObjects takes at most 1000 keys
+DELETE_BATCH_SIZE = 1000
+# This flow's name in clue_changes, see src/io_utils.py
+TEXT_INDEX_CONSUMER = "text_index"
+
+
+@flow
+@publish_stage_metrics
+def compact_text_index(
+    bucket_name="cluebase",
+    s3_prefix=TEXT_INDEX_S3_PREFIX,
+    index_dir=TEXT_INDEX_DIR,
+    rebuild: bool = False,
+    mongo_secret_block="mongo-connection-string",
+    database_name="cluebase",
+):
+    """
+    Replace the index's segments with one merged segment, without superseded or
+    deleted clues. Segments written by loads while this runs are left alone.
+    """
+    logger = get_run_logger()
+    bucket = get_s3_bucket(bucket_name)
+
+    changes = read_clue_changes(mongo_secret_block, database_name)
+    if rebuild:
+        replaced = list_text_index_segments(bucket, s3_prefix)
+        segment = index_all_clues(mongo_secret_block, database_name)
+    else:
+        index = download_text_index(bucket, index_dir, s3_prefix, logger=logger)
+        deleted_ids = [
+            clue_id
+            for clue_id, change in changes.items()
+            if change["deleted"] and clue_id.encode("ascii") in index.latest
+        ]
+        if len(index.segments) < 2 and not deleted_ids:
+            logger.info(f"{len(index.segments)} segments, nothing to compact")
+            ack_text_index_changes(changes, mongo_secret_block, database_name)
+            return
+
+        replaced = [segment.name for segment in index.segments]
+        logger.info(f"Dropping {len(deleted_ids)} deleted clues")
+        with timed("index_merge", items=len(index)):
+            segment = merge_segments(
+                index.segments, name=new_segment_name(), deleted_ids=deleted_ids
+            )
+
+    logger.info(f"Uploading {segment.name} with {len(segment)} clues")
+    upload_text_index_segment(bucket, segment, s3_prefix)
+
+    delete_text_index_segments(bucket_name, replaced, s3_prefix)
+    ack_text_index_changes(changes, mongo_secret_block, database_name)
+
+
+@task
+def read_clue_changes(
+    mongo_secret_block="mongo-connection-string", database_name="cluebase"
+):
+    mongo_conn_str = Secret.load(mongo_secret_block).get()
+    db = MongoClient(mongo_conn_str).get_database(database_name)
+
+    return pending_clue_changes(db, TEXT_INDEX_CONSUMER)
+
+
+@task
+def ack_text_index_changes(
+    changes, mongo_secret_block="mongo-connection-string", database_name="cluebase"
+):
+    mongo_conn_str = Secret.load(mongo_secret_block).get()
+    db = MongoClient(mongo_conn_str).get_database(database_name)
+
+    ack_clue_changes(db, TEXT_INDEX_CONSUMER, changes)
+
+
+@task
+def index_all_clues(
+    mongo_secret_block="mongo-connection-string", database_name="cluebase"
+):
+    logger = get_run_logger()
+
+    logger.info(f"Getting Mongo connection using secret block {mongo_secret_block}")
+    mongo_conn_str = Secret.load(mongo_secret_block).get()
+    mongo_client = MongoClient(mongo_conn_str)
+    db = mongo_client.get_database(database_name)
+
+    clues = list(db.clues.find({}, {field: 1 for field in INDEXED_FIELDS}))
+    logger.info(f"Indexing {len(clues)} clues")
+    with timed("index_build", items=len(clues)):
+        return Segment.from_clues(clues, name=new_segment_name())
+
+
+@task
+def delete_text_index_segments(
+    bucket_name, segment_names, s3_prefix=TEXT_INDEX_S3_PREFIX
+):
+    logger = get_run_logger()
+    bucket = get_s3_bucket(bucket_name)
+    client = bucket.credentials.get_s3_client()
+
+    keys = [
+        bucket._resolve_path(f"{s3_prefix}/{segment_name}")
+        for segment_name in segment_names
+    ]
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        client.delete_objects(
+            Bucket=bucket.bucket_name,
+            Delete={
+                "Objects": [
+                    {"Key": key} for key in keys[start : start + DELETE_BATCH_SIZE]
+                ]
+            },
+        )
+    logger.info(f"Deleted {len(keys)} replaced segments")
+
+
+@flow
+def search_clues(
+    query: str,
+    k: int = 10,
+    bucket_name="cluebase",
+    s3_prefix=TEXT_INDEX_S3_PREFIX,
+    index_dir=TEXT_INDEX_DIR,
+):
+    logger = get_run_logger()
+    bucket = get_s3_bucket(bucket_name)
+
+    index = download_text_index(bucket, index_dir, s3_prefix, logger=logger)
+    results = index.search(query, k)
+    for clue_id, score in results:
+        logger.info(f"{score:.2f} {clue_id}")
+
+    return results